@@ -0,0 +1,589 @@
+import numpy as np, os, sys
+import time
+import torch
+import random
+import multiprocessing as mp
+import pandas as pd
+from torch import nn
+from torch.utils.flop_counter import FlopCounterMode
+from utils import load_yaml
+from run_model import load_args
+import train_model
+from src.modeling.predict_utils import Predicting
+from src.modeling.models.seresnet18 import resnet18
+from src.modeling.model_utils import compile_model, optimize_for_inference, model_architecture, build_model, load_architecture
+from src.modeling.tensor_file_utils import mmap_state_dict, build_mmap_model
+from src.modeling.serve_utils import InferenceModel
+from src.modeling.stream_utils import StreamingClassifier
+from src.modeling.output_utils import test_outputs_path, load_test_outputs
+from src.modeling.metrics import binarize_predictions
+from src.dataloader.dataset_utils import load_data
+
+# Architectures compared in the architecture benchmark if the training yaml file doesn't list them
+ARCHITECTURES = {
+    'resnet18': {},
+    'width_0.5': {'width_multiplier': 0.5},
+    'width_0.25': {'width_multiplier': 0.25},
+    'depth_1111': {'layers': [1, 1, 1, 1]},
+    'kernel_3': {'kernel_size': 3},
+    'no_se': {'se': False}
+}
+
+# Metrics compared between the variants
+METRICS = ['test_macro_auroc', 'test_micro_auroc', 'test_macro_avg_prec', 'test_micro_avg_prec', 'test_challenge_metric']
+
+
+def seed_everything(seed=123):
+    ''' Seed the random number generators so that each variant sees the same randomness
+    '''
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def compare_variants(file, csv_root, benchmark, variants, extra_metrics=[]):
+    ''' Make the predictions of a prediction yaml with each variant of the arguments.
+    Compare the throughput and the metrics of the variants against the first one, which
+    is the baseline. The comparison is saved as a csv file in the output directory of the yaml.
+
+    :param file: Absolute path for the yaml file wanted to read
+    :type file: str
+    :param csv_root: Absolute path for the csv file
+    :type csv_root: str
+    :param benchmark: Name of the benchmark
+    :type benchmark: str
+    :param variants: Names of the variants and the arguments overridden in each of them
+    :type variants: dict
+    :param extra_metrics: Other values of the testing history reported for the variants
+    :type extra_metrics: list
+
+    :return comparison: Throughput and metrics of the variants
+    :rtype: pandas.DataFrame
+    '''
+
+    rows = []
+    for variant, overrides in variants.items():
+        args = load_args(file, csv_root)
+        args.__dict__.update(overrides)
+
+        # Each variant has an own output directory so that the predictions are not overwritten
+        benchmark_dir = os.path.join(args.output_dir, 'benchmark_' + benchmark)
+        args.output_dir = os.path.join(benchmark_dir, variant)
+        args.pred_save_dir = os.path.join(args.output_dir, 'predictions')
+        if not os.path.isdir(args.pred_save_dir):
+            os.makedirs(args.pred_save_dir)
+
+        print('Benchmarking variant {}...'.format(variant))
+        seed_everything()
+        pred = Predicting(args)
+        pred.setup()
+        history = pred.predict()
+
+        row = {'variant': variant, 'records_per_sec': history['test_records_per_sec']}
+        row.update({metric: history[metric] for metric in METRICS})
+        row.update({metric: history.get(metric) for metric in extra_metrics})
+        rows.append(row)
+
+    comparison = pd.DataFrame(rows).set_index('variant')
+
+    # Deltas against the baseline
+    comparison['speedup'] = comparison['records_per_sec'] / comparison['records_per_sec'].iloc[0]
+    for metric in METRICS:
+        comparison[metric + '_delta'] = comparison[metric] - comparison[metric].iloc[0]
+
+    comparison_path = os.path.join(benchmark_dir, 'benchmark_' + benchmark + '.csv')
+    comparison.to_csv(comparison_path)
+
+    print('\nBenchmark {} (baseline: {})\n'.format(benchmark, comparison.index[0]) + '-'*10)
+    print(comparison.to_string(float_format=lambda x: '{:.4f}'.format(x)))
+    print('-'*10)
+    print('Saved to', comparison_path)
+
+    return comparison
+
+
+def benchmark_precision(file, csv_root):
+    ''' Compare bfloat16 autocast against float32 predictions
+    '''
+    variants = {
+        'fp32': {'precision': 'fp32'},
+        'bf16': {'precision': 'bf16'}
+    }
+    return compare_variants(file, csv_root, 'precision', variants)
+
+
+def measure_latency(step, steps=20, warmup=3):
+    ''' Latency of a step function, e.g. a forward pass of a model. The first call is timed
+    separately as it includes e.g. compiling the model.
+
+    :param step: Function running one step
+    :type step: function
+    :param steps: Number of the timed steps
+    :type steps: int
+    :param warmup: Number of the steps before the timed ones
+    :type warmup: int
+
+    :return latency: Time of the first step (sec) and the mean, p50 and p90 latency of the steps (ms)
+    :rtype: dict
+    '''
+
+    start = time.perf_counter()
+    step()
+    first_step_sec = time.perf_counter() - start
+
+    for _ in range(warmup - 1):
+        step()
+
+    timings = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        step()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {'first_step_sec': first_step_sec,
+            'mean_ms': np.mean(timings),
+            'p50_ms': np.percentile(timings, 50),
+            'p90_ms': np.percentile(timings, 90)}
+
+
+def benchmark_compile(file, csv_root, channels=12, seq_length=4096, train_batch_size=10):
+    ''' Compare the step latency of the eager model against the compiled ones on the
+    12x4096 input shape used in training and prediction: a prediction step (batch of one
+    record, no gradients) and a training step (forward and backward pass and optimizer step).
+    The random weights of the models are the same for all the variants.
+    '''
+
+    args = load_args(file, csv_root)
+    compile_cache_dir = getattr(args, 'compile_cache_dir', os.path.join(os.getcwd(), 'experiments', 'compile_cache'))
+    benchmark_dir = os.path.join(args.output_dir, 'benchmark_compile')
+    os.makedirs(benchmark_dir, exist_ok=True)
+
+    seed_everything()
+    state_dict = resnet18(in_channel=channels, out_channel=len(args.labels)).state_dict()
+    criterion = nn.BCEWithLogitsLoss()
+
+    predict_inputs = (torch.randn(1, channels, seq_length), torch.randn(1, 3))
+    train_inputs = (torch.randn(train_batch_size, channels, seq_length), torch.randn(train_batch_size, 3))
+    train_labels = torch.randint(0, 2, (train_batch_size, len(args.labels))).float()
+
+    rows = []
+    for variant in ['eager', 'torchscript', 'inductor']:
+        print('Benchmarking variant {}...'.format(variant))
+
+        # Prediction step
+        model = resnet18(in_channel=channels, out_channel=len(args.labels))
+        model.load_state_dict(state_dict)
+        model.eval()
+        model = compile_model(model, variant, compile_cache_dir)
+
+        def predict_step():
+            with torch.no_grad():
+                model(*predict_inputs)
+        rows.append(dict(variant=variant, step='predict', batch_size=1, **measure_latency(predict_step)))
+
+        # Training step
+        model = resnet18(in_channel=channels, out_channel=len(args.labels))
+        model.load_state_dict(state_dict)
+        model.train()
+        model = compile_model(model, variant, compile_cache_dir)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr if hasattr(args, 'lr') else 0.003)
+
+        def train_step():
+            loss = criterion(model(*train_inputs), train_labels)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        rows.append(dict(variant=variant, step='train', batch_size=train_batch_size, **measure_latency(train_step, steps=5)))
+
+    comparison = pd.DataFrame(rows).set_index(['step', 'variant']).sort_index(level=0, sort_remaining=False)
+    for step in comparison.index.levels[0]:
+        comparison.loc[step, 'speedup'] = (comparison.loc[(step, 'eager'), 'mean_ms'] / comparison.loc[step, 'mean_ms']).values
+
+    comparison_path = os.path.join(benchmark_dir, 'benchmark_compile.csv')
+    comparison.to_csv(comparison_path)
+
+    print('\nBenchmark compile (baseline: eager, input {}x{})\n'.format(channels, seq_length) + '-'*10)
+    print(comparison.to_string(float_format=lambda x: '{:.4f}'.format(x)))
+    print('-'*10)
+    print('Saved to', comparison_path)
+
+    return comparison
+
+
+def benchmark_optimize(file, csv_root, channels=12, seq_length=4096, batch_sizes=[1, 10]):
+    ''' Check that the model optimized for inference gives the same outputs as the original
+    one on random inputs, compare their latency on the 12x4096 input shape, and compare
+    their throughput and metrics on the test data of a prediction yaml
+    '''
+
+    args = load_args(file, csv_root)
+    benchmark_dir = os.path.join(args.output_dir, 'benchmark_optimize')
+    os.makedirs(benchmark_dir, exist_ok=True)
+
+    # Random weights and batch normalization statistics so that the folding is not trivial
+    seed_everything()
+    model = resnet18(in_channel=channels, out_channel=len(args.labels))
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm1d):
+            module.running_mean.normal_()
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.normal_()
+            module.bias.data.normal_()
+    model.eval()
+    optimized = optimize_for_inference(model)
+
+    rows = []
+    for batch_size in batch_sizes:
+        ecgs, ag = torch.randn(batch_size, channels, seq_length), torch.randn(batch_size, 3)
+        with torch.no_grad():
+            max_abs_diff = (model(ecgs, ag) - optimized(ecgs, ag)).abs().max().item()
+        assert max_abs_diff < 1e-4, 'Outputs of the optimized model differ by {}'.format(max_abs_diff)
+
+        for variant, variant_model in [('original', model), ('optimized', optimized)]:
+            def predict_step():
+                with torch.no_grad():
+                    variant_model(ecgs, ag)
+            rows.append(dict(variant=variant, batch_size=batch_size, max_abs_diff=max_abs_diff,
+                             **measure_latency(predict_step, steps=(20 if batch_size == 1 else 5))))
+
+    latency = pd.DataFrame(rows).set_index(['batch_size', 'variant'])
+    for batch_size in batch_sizes:
+        latency.loc[batch_size, 'speedup'] = (latency.loc[(batch_size, 'original'), 'mean_ms'] / latency.loc[batch_size, 'mean_ms']).values
+
+    latency_path = os.path.join(benchmark_dir, 'benchmark_optimize_latency.csv')
+    latency.to_csv(latency_path)
+
+    print('\nLatency of the optimized model (input {}x{})\n'.format(channels, seq_length) + '-'*10)
+    print(latency.to_string(float_format=lambda x: '{:.4g}'.format(x)))
+    print('-'*10)
+    print('Saved to', latency_path)
+
+    # Predictions with the trained model
+    variants = {
+        'original': {'optimize_for_inference': False},
+        'optimized': {'optimize_for_inference': True}
+    }
+    return compare_variants(file, csv_root, 'optimize', variants)
+
+
+def benchmark_quantize(file, csv_root):
+    ''' Compare the dynamically and statically int8 quantized models against the float32
+    model. The static quantization is calibrated on `calibration_file` of the yaml file.
+    '''
+    variants = {
+        'fp32': {'quantize': 'none'},
+        'int8_dynamic': {'quantize': 'dynamic'},
+        'int8_static': {'quantize': 'static'}
+    }
+    return compare_variants(file, csv_root, 'quantize', variants)
+
+
+def benchmark_tta(file, csv_root, tta_ks=[1, 2, 4, 8]):
+    ''' Compare the throughput and the metrics of the test-time augmentation with different
+    numbers of views per recording, the views are set with `tta_views` in the yaml file
+    '''
+    variants = {'tta_k{}'.format(k): {'tta_k': k} for k in tta_ks}
+    return compare_variants(file, csv_root, 'tta', variants)
+
+
+def benchmark_cascade(file, csv_root, thresholds=[]):
+    ''' Compare the early-exit cascade against the whole model: the throughput, the share
+    of the recordings exiting early and the recall of each class, which is what the early
+    exits can cost. The model has to be trained with `early_exit` in its architecture.
+    Besides the calibrated threshold, the cascade can be run with the given `thresholds`.
+    '''
+    variants = {'full': {'cascade': False}, 'cascade': {'cascade': True}}
+    variants.update({'cascade_{}'.format(threshold): {'cascade': True, 'cascade_threshold': threshold}
+                     for threshold in thresholds})
+    comparison = compare_variants(file, csv_root, 'cascade', variants, extra_metrics=['cascade_exit_rate'])
+
+    # Recall of each class from the saved outputs of the variants
+    args = load_args(file, csv_root)
+    benchmark_dir = os.path.join(args.output_dir, 'benchmark_cascade')
+    recalls = {}
+    for variant in variants:
+        _, labels, y_true, y_prob = load_test_outputs(test_outputs_path(os.path.join(benchmark_dir, variant), args.yaml_file_name))
+        y_pred = binarize_predictions(y_prob, args.threshold)
+        recalls[variant] = (y_pred * y_true).sum(0) / np.maximum(y_true.sum(0), 1)
+    recalls = pd.DataFrame(recalls, index=labels)
+    recalls['positives'] = y_true.sum(0).astype(int)
+    for variant in list(variants)[1:]:
+        recalls[variant + '_delta'] = recalls[variant] - recalls['full']
+
+    recall_path = os.path.join(benchmark_dir, 'benchmark_cascade_recall.csv')
+    recalls.to_csv(recall_path)
+
+    print('\nRecall per class\n' + '-'*10)
+    print(recalls.to_string(float_format=lambda x: '{:.4f}'.format(x)))
+    print('-'*10)
+    print('Saved to', recall_path)
+
+    return comparison, recalls
+
+
+def benchmark_streaming(file, csv_root, stream_counts=[1, 20, 200], chunk_size=250, hops=4):
+    ''' Stream the test recordings of a prediction yaml in chunks of `chunk_size` samples to
+    the streaming classifier with different numbers of concurrent streams, and compare the
+    windows predicted per second and the latency of pushing the chunks of all the streams.
+    The predictions of a stream are first checked to be the same as predicting its windows
+    offline from the whole filtered recording. The hop and the band-pass filtering are set with
+    `stream_hop` and `stream_bandpass` in the yaml file.
+    '''
+
+    args = load_args(file, csv_root)
+    benchmark_dir = os.path.join(args.output_dir, 'benchmark_streaming')
+    os.makedirs(benchmark_dir, exist_ok=True)
+
+    model = InferenceModel(args)
+    window_size = getattr(args, 'window_size', 4096)
+    hop = getattr(args, 'stream_hop', 500)
+    fs = getattr(args, 'stream_fs', 500)
+    bandpass = getattr(args, 'stream_bandpass', True)
+
+    # Recordings long enough for a few hops, the short ones are repeated
+    df = pd.read_csv(args.test_path, usecols=['path', 'age', 'gender'])
+    length = window_size + hops * hop
+    recordings = [(np.resize(load_data(path), (12, length)), age, gender) for path, age, gender in df.itertuples(index=False)]
+
+    # Streamed predictions against predicting the windows offline
+    classifier = StreamingClassifier(model, window_size, hop, fs, bandpass)
+    ecg, age, gender = recordings[0]
+    classifier.open_stream(0, age, gender)
+    emissions = []
+    for start in range(0, length, chunk_size):
+        emissions += classifier.push({0: ecg[:, start:start + chunk_size]})
+    filtered = ecg
+    if bandpass:
+        filtered, _ = classifier.filter.stream(ecg, classifier.filter.initial_state(ecg[:, 0]))
+    offline = model.predict_batch([model.preprocess(filtered[:, e['sample'] - window_size:e['sample']], age, gender) for e in emissions])
+    max_abs_diff = max(np.abs(np.array(list(e['probabilities'].values())) - np.array(list(o['probabilities'].values()))).max()
+                       for e, o in zip(emissions, offline))
+    assert max_abs_diff < 1e-5, 'Streamed predictions differ from the offline ones by {}'.format(max_abs_diff)
+    print('{} streamed predictions match the offline ones (max abs diff {:.2g})'.format(len(emissions), max_abs_diff))
+
+    rows = []
+    for num_streams in stream_counts:
+        classifier = StreamingClassifier(model, window_size, hop, fs, bandpass)
+        for stream_id in range(num_streams):
+            classifier.open_stream(stream_id, *recordings[stream_id % len(recordings)][1:])
+
+        num_windows, timings = 0, []
+        start_time = time.perf_counter()
+        for start in range(0, length, chunk_size):
+            chunks = {stream_id: recordings[stream_id % len(recordings)][0][:, start:start + chunk_size]
+                      for stream_id in range(num_streams)}
+            push_start = time.perf_counter()
+            num_windows += len(classifier.push(chunks))
+            timings.append((time.perf_counter() - push_start) * 1000)
+        total_time = time.perf_counter() - start_time
+
+        windows_per_sec = num_windows / total_time
+        rows.append({'streams': num_streams, 'windows': num_windows, 'windows_per_sec': windows_per_sec,
+                     # Streams which can be followed in real time, each needing a window every hop
+                     'realtime_streams': windows_per_sec * hop / fs,
+                     'push_p50_ms': np.percentile(timings, 50), 'push_p99_ms': np.percentile(timings, 99),
+                     'max_abs_diff': max_abs_diff})
+        print('Streamed {} streams: {:.1f} windows/sec'.format(num_streams, windows_per_sec))
+
+    comparison = pd.DataFrame(rows).set_index('streams')
+    comparison_path = os.path.join(benchmark_dir, 'benchmark_streaming.csv')
+    comparison.to_csv(comparison_path)
+
+    print('\nStreaming (window {}, hop {}, chunk {} samples, band-pass {})\n'.format(window_size, hop, chunk_size, bandpass) + '-'*10)
+    print(comparison.to_string(float_format=lambda x: '{:.4g}'.format(x)))
+    print('-'*10)
+    print('Saved to', comparison_path)
+
+    return comparison
+
+
+def memory_usage():
+    ''' Resident and proportional set sizes of the current process in megabytes. The
+    proportional set size splits the pages shared between processes among them.
+    '''
+    usage = {'rss_mb': float('nan'), 'pss_mb': float('nan')}
+    if os.path.exists('/proc/self/smaps_rollup'):
+        with open('/proc/self/smaps_rollup', 'r') as file:
+            for line in file:
+                if line.startswith(('Rss:', 'Pss:')):
+                    usage[line.split(':')[0].lower() + '_mb'] = int(line.split()[1]) / 1024
+    return usage
+
+
+def _load_weights_worker(model_path, num_labels, mmap, barrier, results, channels=12, seq_length=4096):
+    ''' Load a trained model in a process of its own, predict one input and measure the
+    memory while all the processes hold their models
+    '''
+    torch.set_num_threads(1)
+    start = time.perf_counter()
+    if mmap:
+        model = build_mmap_model(load_architecture(model_path), model_path, channels, num_labels)
+    else:
+        model = build_model(load_architecture(model_path), channels, num_labels)
+        model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    load_sec = time.perf_counter() - start
+
+    model.eval()
+    with torch.no_grad():
+        outputs = model(torch.ones(1, channels, seq_length), torch.ones(1, 3)).numpy()
+
+    barrier.wait()
+    results.put(dict(memory_usage(), load_ms=load_sec * 1000, outputs=outputs))
+    barrier.wait()
+
+
+def benchmark_weights(file, csv_root, num_processes=4):
+    ''' Load the trained model of a prediction yaml in `num_processes` processes at the same
+    time, from the .pth file and memory-mapped from the flat tensor file (made if there's none),
+    and compare the load time and the memory of the processes. The memory-mapped weights are
+    shared between the processes, which shows in their proportional set size. The outputs of
+    the models are checked to be the same.
+    '''
+
+    args = load_args(file, csv_root)
+    benchmark_dir = os.path.join(args.output_dir, 'benchmark_weights')
+    os.makedirs(benchmark_dir, exist_ok=True)
+    mmap_state_dict(args.model_path)
+
+    context = mp.get_context('spawn')
+    rows, outputs = [], {}
+    for variant, mmap in [('pth', False), ('mmap', True)]:
+        barrier, results = context.Barrier(num_processes), context.Queue()
+        processes = [context.Process(target=_load_weights_worker,
+                                     args=(args.model_path, len(args.labels), mmap, barrier, results))
+                     for _ in range(num_processes)]
+        for process in processes:
+            process.start()
+        process_results = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        outputs[variant] = process_results[0]['outputs']
+        rows.append({'variant': variant,
+                     'processes': num_processes,
+                     'load_ms': np.mean([result['load_ms'] for result in process_results]),
+                     'rss_mb_per_process': np.mean([result['rss_mb'] for result in process_results]),
+                     'pss_mb_total': np.sum([result['pss_mb'] for result in process_results])})
+        print('Loaded the model in {} processes from {}'.format(num_processes, variant))
+
+    max_abs_diff = float(np.abs(outputs['pth'] - outputs['mmap']).max())
+    assert max_abs_diff == 0, 'The memory-mapped model gives different outputs, max abs diff {}'.format(max_abs_diff)
+
+    comparison = pd.DataFrame(rows).set_index('variant')
+    comparison['weights_mb'] = os.path.getsize(args.model_path) / (1024 * 1024)
+    comparison_path = os.path.join(benchmark_dir, 'benchmark_weights.csv')
+    comparison.to_csv(comparison_path)
+
+    print('\nWeights ({} processes)\n'.format(num_processes) + '-'*10)
+    print(comparison.to_string(float_format=lambda x: '{:.2f}'.format(x)))
+    print('-'*10)
+    print('Saved to', comparison_path)
+
+    return comparison
+
+
+def benchmark_architecture(file, csv_root, channels=12, seq_length=4096):
+    ''' Compare SE-ResNet architectures by their size, speed and accuracy: the number of the
+    parameters, the FLOPs and the latency of a prediction step (batch of one 12x4096 record),
+    and the validation metrics of the last epoch when trained with a training yaml file.
+    The architectures are listed in `benchmark_architectures` of the yaml file (names and
+    their `architecture` options), by default resnet18 and its narrower, shallower, smaller
+    kernel and SE-less variants.
+    '''
+
+    args = load_yaml(file)
+    architectures = getattr(args, 'benchmark_architectures', None)
+    architectures = ARCHITECTURES if architectures is None else {name: vars(options) for name, options in vars(architectures).items()}
+    yaml_file_name = os.path.basename(os.path.splitext(file)[0])
+    benchmark_dir = os.path.join(os.getcwd(), 'experiments', yaml_file_name, 'benchmark_architecture')
+    os.makedirs(benchmark_dir, exist_ok=True)
+
+    labels = pd.read_csv(os.path.join(csv_root, args.train_file), nrows=0).columns.tolist()[4:]
+    inputs = (torch.randn(1, channels, seq_length), torch.randn(1, 3))
+
+    rows = []
+    for name, options in architectures.items():
+        architecture = model_architecture(options)
+        print('Benchmarking architecture {}: {}'.format(name, architecture))
+
+        seed_everything()
+        model = build_model(architecture, channels, len(labels)).eval()
+        flop_counter = FlopCounterMode(display=False)
+        with torch.no_grad(), flop_counter:
+            model(*inputs)
+
+        def predict_step():
+            with torch.no_grad():
+                model(*inputs)
+        latency = measure_latency(predict_step)
+
+        # Training with the architecture, each into its own subdirectory
+        seed_everything()
+        history = train_model.read_yaml(file, csv_root, os.path.join(benchmark_dir, name), True,
+                                        overrides={'architecture': architecture})
+
+        rows.append(dict(architecture=name,
+                         params=sum(p.numel() for p in model.parameters()),
+                         gflops=flop_counter.get_total_flops() / 1e9,
+                         latency_ms=latency['mean_ms'],
+                         p90_ms=latency['p90_ms'],
+                         **{metric: history[metric][-1] for metric in ['val_macro_auroc', 'val_micro_auroc', 'val_challenge_metric']},
+                         options=architecture))
+
+    comparison = pd.DataFrame(rows).set_index('architecture')
+    comparison['speedup'] = comparison['latency_ms'].iloc[0] / comparison['latency_ms']
+
+    comparison_path = os.path.join(benchmark_dir, 'benchmark_architecture.csv')
+    comparison.to_csv(comparison_path)
+
+    print('\nBenchmark architecture (baseline: {}, input {}x{})\n'.format(comparison.index[0], channels, seq_length) + '-'*10)
+    print(comparison.drop(columns=['options']).to_string(float_format=lambda x: '{:.4g}'.format(x)))
+    print('-'*10)
+    print('Saved to', comparison_path)
+
+    return comparison
+
+
+# Available benchmarks
+BENCHMARKS = {
+    'precision': benchmark_precision,
+    'compile': benchmark_compile,
+    'optimize': benchmark_optimize,
+    'quantize': benchmark_quantize,
+    'tta': benchmark_tta,
+    'cascade': benchmark_cascade,
+    'architecture': benchmark_architecture,
+    'streaming': benchmark_streaming,
+    'weights': benchmark_weights
+}
+
+# Benchmarks run with a training yaml file instead of a prediction yaml file
+TRAINING_BENCHMARKS = ['architecture']
+
+
+if __name__ == '__main__':
+
+    # ----- Set the path here! -----
+
+    # Root where the needed CSV file exists
+    csv_root = os.path.join(os.getcwd(), 'data', 'split_csvs', 'stratified_smoke')
+
+    # ------------------------------
+
+    # Load args
+    benchmark = sys.argv[1]
+    given_arg = sys.argv[2]
+    print('Running benchmark {} with arguments from {}'.format(benchmark, given_arg))
+    arg_path = os.path.join(os.getcwd(), 'configs', 'training' if benchmark in TRAINING_BENCHMARKS else 'predicting', given_arg)
+
+    if benchmark not in BENCHMARKS:
+        raise Exception('No such benchmark! Use one of {}'.format(list(BENCHMARKS)))
+
+    if os.path.exists(arg_path) and 'yaml' in given_arg:
+        BENCHMARKS[benchmark](arg_path, csv_root)
+    else:
+        raise Exception('No such yaml file exists! Check the arguments.')
+
+    print('Done.')
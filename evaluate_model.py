@@ -0,0 +1,75 @@
+import os, sys
+from run_model import load_args
+from src.modeling.predict_utils import Predicting
+
+def read_yaml(file, csv_root, model_save_dir='', multiple=False):
+    ''' Read a given yaml and evaluate the predictions saved by `run_model.py`
+    again, e.g. with a different decision threshold. The trained model and the
+    ECG recordings are not needed.
+
+    :param file: Absolute path for the yaml file wanted to read
+    :type file: str
+    :param csv_root: Absolute path for the csv file
+    :type csv_root: str
+    :param model_save_dir: If multiple yamls are read, the model directory is
+                           a subdirectory of the 'experiments' directory
+    :type model_save_dir: str
+    :param multiple: Check if multiple yamls are read
+    :type multiple: boolean
+    '''
+
+    args = load_args(file, csv_root, model_save_dir, multiple)
+
+    print('Evaluating saved predictions...')
+
+    pred = Predicting(args)
+    return pred.evaluate_saved()
+
+
+def read_multiple_yamls(path, csv_root):
+    ''' Read multiple yaml files from the given directory
+
+    :param directory: Absolute path for the directory
+    :type path: str
+    '''
+    # All yaml files
+    yaml_files = [os.path.join(path, file) for file in os.listdir(path) if os.path.isfile(os.path.join(path, file))]
+
+    # The predictions are saved in the same subdirectory in the 'experiments' directory
+    dir_name = os.path.basename(path)
+    model_save_dir = os.path.join(os.getcwd(),'experiments', dir_name)
+
+    # Evaluating the predictions of each yaml file
+    for file in yaml_files:
+        read_yaml(file, csv_root, model_save_dir, True)
+
+
+if __name__ == '__main__':
+
+    # ----- Set the path here! -----
+
+    # Root where the needed CSV file exists
+    csv_root = os.path.join(os.getcwd(), 'data', 'split_csvs', 'stratified_smoke')
+
+    # ------------------------------
+
+    # Load args
+    given_arg = sys.argv[1]
+    print('Loading arguments from', given_arg)
+    arg_path = os.path.join(os.getcwd(), 'configs', 'predicting', given_arg)
+
+    # Check if a yaml file or a directory given as an argument
+    # The same yamls which were used to make the predictions!
+    if os.path.exists(arg_path):
+
+        if 'yaml' in given_arg:
+            # Evaluate one yaml
+            read_yaml(arg_path, csv_root)
+        else:
+            # Evaluate multiple yamls from a directory
+            read_multiple_yamls(arg_path, csv_root)
+
+    else:
+        raise Exception('No such file nor directory exists! Check the arguments.')
+
+    print('Done.')
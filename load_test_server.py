@@ -0,0 +1,132 @@
+import os, sys
+import time
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import urllib.request
+import urllib.error
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+def make_requests(test_path, num_requests):
+    ''' Requests uploading the recordings of a csv file, repeated until there are enough of them
+
+    :param test_path: Absolute path for the csv file of the recordings
+    :type test_path: str
+    :param num_requests: Number of the requests
+    :type num_requests: int
+
+    :return requests: Query strings and the file contents of the requests
+    :rtype: list
+    '''
+
+    df = pd.read_csv(test_path, usecols=['path', 'age', 'gender'])
+    uploads = []
+    for path, age, gender in df.itertuples(index=False):
+        query = urlencode({'format': os.path.splitext(path)[1].lstrip('.'),
+                           'age': '' if pd.isna(age) else age,
+                           'gender': gender})
+        uploads.append((query, file_contents(path)))
+    return [uploads[i % len(uploads)] for i in range(num_requests)]
+
+
+def file_contents(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def send_request(url, query, body):
+    ''' Send one prediction request and time it
+
+    :return: Latency in seconds, the batch size the request was predicted in (0 on an error)
+    :rtype: tuple
+    '''
+    request = urllib.request.Request('{}/predict?{}'.format(url, query), data=body,
+                                     headers={'Content-Type': 'application/octet-stream'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            result = json.loads(response.read())
+        return time.perf_counter() - start, result['batch_size']
+    except urllib.error.URLError as e:
+        print('Request failed:', e)
+        return time.perf_counter() - start, 0
+
+
+def load_test(url, test_path, num_requests=200, concurrency=16, output_path=None):
+    ''' Send concurrent prediction requests to a running server (`serve_model.py`) and
+    report the latency percentiles and the throughput.
+
+    :param url: Address of the server, e.g. http://127.0.0.1:8000
+    :type url: str
+    :param test_path: Absolute path for the csv file of the uploaded recordings
+    :type test_path: str
+    :param num_requests: Number of the requests
+    :type num_requests: int
+    :param concurrency: Number of the clients sending requests at the same time
+    :type concurrency: int
+    :param output_path: Absolute path for a csv file of the latencies
+    :type output_path: str
+
+    :return report: Latency percentiles (ms), throughput and the mean batch size
+    :rtype: dict
+    '''
+
+    requests = make_requests(test_path, num_requests)
+
+    # Warm up the server before timing
+    send_request(url, *requests[0])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda request: send_request(url, *request), requests))
+    total_time = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    batch_sizes = np.array([batch_size for _, batch_size in results])
+    ok = batch_sizes > 0
+
+    report = {'requests': num_requests,
+              'concurrency': concurrency,
+              'errors': int((~ok).sum()),
+              'p50_ms': float(np.percentile(latencies[ok], 50)) if ok.any() else float('nan'),
+              'p90_ms': float(np.percentile(latencies[ok], 90)) if ok.any() else float('nan'),
+              'p99_ms': float(np.percentile(latencies[ok], 99)) if ok.any() else float('nan'),
+              'mean_ms': float(latencies[ok].mean()) if ok.any() else float('nan'),
+              'requests_per_sec': int(ok.sum()) / total_time,
+              'mean_batch_size': float(batch_sizes[ok].mean()) if ok.any() else float('nan')}
+
+    print('\nLoad test\n' + '-'*10)
+    for k, v in report.items():
+        print('{:<18} {:.2f}'.format(k + ':', v) if isinstance(v, float) else '{:<18} {}'.format(k + ':', v))
+    print('-'*10)
+
+    if output_path is not None:
+        pd.DataFrame({'latency_ms': latencies, 'batch_size': batch_sizes}).to_csv(output_path, index=False)
+        print('Saved the latencies to', output_path)
+
+    return report
+
+
+if __name__ == '__main__':
+
+    # ----- Set the path here! -----
+
+    # Root where the needed CSV file exists
+    csv_root = os.path.join(os.getcwd(), 'data', 'split_csvs', 'stratified_smoke')
+
+    # ------------------------------
+
+    parser = argparse.ArgumentParser(description='Load test a running prediction server')
+    parser.add_argument('test_file', help='csv file in the csv root of the recordings uploaded to the server')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='address of the server')
+    parser.add_argument('--requests', type=int, default=200, help='number of requests')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--output', help='csv file for the latencies of the requests')
+    cli_args = parser.parse_args()
+
+    load_test(cli_args.url, os.path.join(csv_root, cli_args.test_file),
+              cli_args.requests, cli_args.concurrency, cli_args.output)
+
+    print('Done.')
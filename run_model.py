@@ -1,13 +1,19 @@
 import numpy as np, os, sys
+import time
+import argparse
 import torch
 import random
 import pandas as pd
 from utils import load_yaml
 from src.modeling.predict_utils import Predicting
+from src.modeling.schedule_utils import run_concurrently
+from src.modeling.shard_utils import split_test_csv, merge_test_outputs
+from src.modeling.output_utils import test_outputs_path
+from src.modeling.registry_utils import resolve_model
 
-def read_yaml(file, csv_root, model_save_dir='', multiple=False):
-    ''' Read a given yaml and perform classification predictions.
-    Evaluate the predictions.
+def load_args(file, csv_root, model_save_dir='', multiple=False, overrides=None):
+    ''' Read a given yaml and set up the paths needed in the prediction and
+    evaluation phase.
     
     :param file: Absolute path for the yaml file wanted to read
     :type file: str
@@ -18,10 +24,17 @@ def read_yaml(file, csv_root, model_save_dir='', multiple=False):
     :type model_save_dir: str
     :param multiple: Check if multiple yamls are read
     :type multiple: boolean
+    :param overrides: Arguments replacing the ones in the yaml file, e.g. the number of workers
+    :type overrides: dict
+    
+    :return args: Arguments for the prediction phase
+    :rtype: utils.obj
     '''
     
     # Load yaml
     args = load_yaml(file)
+    if overrides:
+        args.__dict__.update(overrides)
     
     # Update paths
     args.test_path = os.path.join(csv_root, args.test_file)
@@ -42,16 +55,19 @@ def read_yaml(file, csv_root, model_save_dir='', multiple=False):
     if not os.path.isdir(args.pred_save_dir):
         os.makedirs(args.pred_save_dir)    
 
-    # Find the trained model from the ´experiments´ directory as it should be saved there
-    for root, dirs, files in os.walk(os.path.join(os.getcwd(), 'experiments')):
-                if args.model in files:
-                    args.model_path = os.path.join(root, args.model)
+    # Find the trained model, or the models of an ensemble given as a list ´models´
+    models = args.models if hasattr(args, 'models') else [args.model]
+    model_paths = [find_model(model) for model in models]
+    if all(model_paths):
+        args.model_paths = model_paths
+        args.model_path = model_paths[0]
     
     # Check if model_path never set, i.e., the trained model was found
     try:
         args.model_path
     except AttributeError as ne:
-        print('AttributeError:', ne, 'I.e. model not found. Check if you´ve trained one.')
+        print('AttributeError:', ne, 'I.e. model not found. Check if you´ve trained one.',
+              'Missing:', [model for model, path in zip(models, model_paths) if path is None])
 
     # Load labels
     args.labels = pd.read_csv(args.test_path, nrows=0).columns.tolist()[4:]
@@ -61,18 +77,142 @@ def read_yaml(file, csv_root, model_save_dir='', multiple=False):
         print(k + ':', v)
     print('-'*10) 
 
+    return args
+
+
+def find_model(model):
+    ''' Find a trained model from the model registry, or from the ´experiments´ directory
+    as it should be saved there if it's not registered (e.g. trained before the registry)
+    
+    :param model: Filename or relative path of the model
+    :type model: str
+    
+    :return model_path: Absolute path for the model, None if it's not found
+    :rtype: str
+    '''
+    entry = resolve_model(model)
+    if entry is not None:
+        return entry['path']
+
+    model_path = None
+    for root, dirs, files in os.walk(os.path.join(os.getcwd(), 'experiments')):
+        if model in files:
+            model_path = os.path.join(root, model)
+    return model_path
+
+
+def read_yaml(file, csv_root, model_save_dir='', multiple=False, overrides=None):
+    ''' Read a given yaml and perform classification predictions.
+    Evaluate the predictions.
+    
+    :param file: Absolute path for the yaml file wanted to read
+    :type file: str
+    :param csv_root: Absolute path for the csv file
+    :type csv_root: str
+    :param model_save_dir: If multiple yamls are read, the model directory is  
+                           a subdirectory of the 'experiments' directory
+    :type model_save_dir: str
+    :param multiple: Check if multiple yamls are read
+    :type multiple: boolean
+    :param overrides: Arguments replacing the ones in the yaml file
+    :type overrides: dict
+    
+    :return history: Testing history
+    :rtype: dict
+    '''
+    
+    args = load_args(file, csv_root, model_save_dir, multiple, overrides)
+
+    # Split the test data between processes
+    if getattr(args, 'shards', 1) > 1:
+        return predict_sharded(args, file, csv_root, overrides)
+
     print('Making predictions...')
 
     pred = Predicting(args)
     pred.setup()
-    pred.predict()
+    return pred.predict()
+
+
+def predict_shard(file, csv_root, shard_dir, test_path, run_overrides=None, overrides=None):
+    ''' Predict one shard of the test data in a process of its own, saving only the raw outputs
+    
+    :param file: Absolute path for the yaml file
+    :type file: str
+    :param csv_root: Absolute path for the csv file
+    :type csv_root: str
+    :param shard_dir: Directory of the shard, the outputs are saved into its subdirectory
+    :type shard_dir: str
+    :param test_path: Absolute path for the csv file of the shard
+    :type test_path: str
+    :param run_overrides: Arguments replacing the ones in the yaml file in the whole sharded run
+    :type run_overrides: dict
+    :param overrides: Arguments replacing the ones in the yaml file in this shard, e.g. the number of workers
+    :type overrides: dict
+    
+    :return history: Testing history of the shard
+    :rtype: dict
+    '''
+    overrides = dict(run_overrides or {}, **(overrides or {}),
+                     test_file=test_path, shards=1, outputs_only=True, chunked_evaluation=False)
+    return read_yaml(file, csv_root, shard_dir, True, overrides)
+
 
+def predict_sharded(args, file, csv_root, overrides=None):
+    ''' Split the test data into `shards` contiguous shards which are predicted concurrently
+    in separate processes, each pinned to its own CPUs with its own copy of the model and
+    its own number of threads. The raw outputs of the shards are merged in the order of the
+    test csv file, and the challenge predictions and the metrics are computed once for the
+    whole test data, as in a single-process prediction.
     
-def read_multiple_yamls(path, csv_root):
+    :param args: Arguments for the prediction phase
+    :type args: utils.obj
+    :param file: Absolute path for the yaml file
+    :type file: str
+    :param csv_root: Absolute path for the csv file
+    :type csv_root: str
+    :param overrides: Arguments replacing the ones in the yaml file, also in the shards
+    :type overrides: dict
+    
+    :return history: Testing history
+    :rtype: dict
+    '''
+
+    start_time_sec = time.time()
+    shard_root = os.path.join(args.output_dir, 'shards')
+    shard_paths = split_test_csv(args.test_path, args.shards, shard_root, getattr(args, 'batch_size', 1))
+    print('Making predictions in {} shards...'.format(len(shard_paths)))
+
+    shard_jobs = []
+    for shard_path in shard_paths:
+        name = os.path.splitext(os.path.basename(shard_path))[0]
+        shard_jobs.append((name, (file, csv_root, os.path.join(shard_root, name), shard_path, overrides)))
+    run_concurrently(predict_shard, shard_jobs, len(shard_jobs),
+                     log_dir=os.path.join(shard_root, 'logs'),
+                     summary_path=os.path.join(shard_root, args.yaml_file_name + '_shard_summary.csv'))
+
+    # The outputs of the shards as the outputs of the whole run, evaluated as saved predictions
+    merge_test_outputs([test_outputs_path(os.path.join(shard_root, name, args.yaml_file_name), args.yaml_file_name)
+                        for name, _ in shard_jobs],
+                       args.output_dir, args.yaml_file_name, getattr(args, 'chunked_evaluation', False))
+    history = Predicting(args).evaluate_saved()
+
+    total_time_sec = time.time() - start_time_sec
+    records_per_sec = len(pd.read_csv(args.test_path, usecols=['path'])) / total_time_sec
+    print('Throughput:     %5.2f records/sec (%d shards)' % (records_per_sec, len(shard_paths)))
+    history['test_time_sec'] = total_time_sec
+    history['test_records_per_sec'] = records_per_sec
+    history['shards'] = len(shard_paths)
+    return history
+
+    
+def read_multiple_yamls(path, csv_root, jobs=1):
     ''' Read multiple yaml files from the given directory
     
     :param directory: Absolute path for the directory
     :type path: str
+    :param jobs: Number of yamls run concurrently in separate processes
+    :type jobs: int
     '''
     # All yaml files
     yaml_files = [os.path.join(path, file) for file in os.listdir(path) if os.path.isfile(os.path.join(path, file))]
@@ -81,6 +221,14 @@ def read_multiple_yamls(path, csv_root):
     dir_name = os.path.basename(path)
     model_save_dir = os.path.join(os.getcwd(),'experiments', dir_name) 
 
+    # Running the yaml files concurrently, each with its own share of the CPUs and its own log
+    if jobs > 1:
+        fold_jobs = [(os.path.splitext(os.path.basename(file))[0], (file, csv_root, model_save_dir, True))
+                     for file in yaml_files]
+        return run_concurrently(read_yaml, fold_jobs, jobs,
+                                log_dir=os.path.join(model_save_dir, 'logs'),
+                                summary_path=os.path.join(model_save_dir, dir_name + '_test_summary.csv'))
+
     # Running the yaml files and training models for each
     for file in yaml_files:
         read_yaml(file, csv_root, model_save_dir, True)
@@ -106,7 +254,16 @@ if __name__ == '__main__':
     # ------------------------------
 
     # Load args
-    given_arg = sys.argv[1]
+    parser = argparse.ArgumentParser(description='Make predictions with the given yaml file or a directory of yaml files')
+    parser.add_argument('config', help='yaml file or directory in configs/predicting')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of yamls of a directory run concurrently')
+    parser.add_argument('--shards', type=int,
+                        help='number of processes the test data of a yaml is split between')
+    cli_args = parser.parse_args()
+    overrides = {'shards': cli_args.shards} if cli_args.shards else None
+
+    given_arg = cli_args.config
     print('Loading arguments from', given_arg)
     arg_path = os.path.join(os.getcwd(), 'configs', 'predicting', given_arg)
     
@@ -116,10 +273,10 @@ if __name__ == '__main__':
 
         if 'yaml' in given_arg:
             # Run one yaml
-            read_yaml(arg_path, csv_root)
+            read_yaml(arg_path, csv_root, overrides=overrides)
         else:
             # Run multiple yamls from a directory
-            read_multiple_yamls(arg_path, csv_root)
+            read_multiple_yamls(arg_path, csv_root, cli_args.jobs)
 
     else:
         raise Exception('No such file nor directory exists! Check the arguments.')
@@ -0,0 +1,94 @@
+import os, sys
+import argparse
+import pandas as pd
+from utils import load_yaml
+from src.modeling.serve_utils import make_server
+from src.modeling.registry_utils import resolve_model
+
+def load_args(file, csv_root):
+    ''' Read a given yaml and find the trained model and its labels for serving.
+    
+    :param file: Absolute path for the yaml file wanted to read
+    :type file: str
+    :param csv_root: Absolute path for the csv file with the labels, used if the
+                     model isn't in the model registry
+    :type csv_root: str
+    
+    :return args: Arguments for the server
+    :rtype: utils.obj
+    '''
+
+    # Load yaml
+    args = load_yaml(file)
+    args.yaml_file_name = os.path.basename(os.path.splitext(file)[0])
+
+    # Find the trained model and its labels from the model registry, or the model from
+    # the ´experiments´ directory and the labels from the header of the label file
+    entry = resolve_model(args.model)
+    if entry is not None:
+        args.model_path = entry['path']
+        args.labels = entry['labels']
+    else:
+        for root, dirs, files in os.walk(os.path.join(os.getcwd(), 'experiments')):
+            if args.model in files:
+                args.model_path = os.path.join(root, args.model)
+        if not hasattr(args, 'model_path'):
+            raise Exception('Model {} not found. Check if you´ve trained one.'.format(args.model))
+        args.labels = pd.read_csv(os.path.join(csv_root, args.label_file), nrows=0).columns.tolist()[4:]
+
+    print('Arguments:\n' + '-'*10)
+    for k, v in args.__dict__.items():
+        print(k + ':', v)
+    print('-'*10)
+
+    return args
+
+
+def serve(file, csv_root, host=None, port=None):
+    ''' Load the trained model of a given yaml once and serve its predictions over HTTP
+    until interrupted.
+    '''
+
+    args = load_args(file, csv_root)
+    if host is not None:
+        args.host = host
+    if port is not None:
+        args.port = port
+
+    server = make_server(args)
+    print('Serving {} on http://{}:{}/predict'.format(args.model, *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+
+
+if __name__ == '__main__':
+
+    # ----- Set the path here! -----
+
+    # Root where the needed CSV file exists
+    csv_root = os.path.join(os.getcwd(), 'data', 'split_csvs', 'stratified_smoke')
+
+    # ------------------------------
+
+    # Load args
+    parser = argparse.ArgumentParser(description='Serve the predictions of a trained model over HTTP')
+    parser.add_argument('config', help='yaml file in configs/serving')
+    parser.add_argument('--host', help='host to listen on, by default the one in the yaml file')
+    parser.add_argument('--port', type=int, help='port to listen on, by default the one in the yaml file')
+    cli_args = parser.parse_args()
+
+    given_arg = cli_args.config
+    print('Loading arguments from', given_arg)
+    arg_path = os.path.join(os.getcwd(), 'configs', 'serving', given_arg)
+
+    if os.path.exists(arg_path) and 'yaml' in given_arg:
+        serve(arg_path, csv_root, cli_args.host, cli_args.port)
+    else:
+        raise Exception('No such yaml file exists! Check the arguments.')
+
+    print('Done.')
@@ -1,8 +1,10 @@
+import time
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 import pandas as pd
 from .dataset_utils import load_data, encode_metadata
-from .transforms import Compose, RandomClip, Normalize, ValClip, Retype
+from .transforms import Compose, RandomClip, Normalize, ValClip, Retype, Flipy, Roll, TTAViews
 
 
 def get_transforms(dataset_type):
@@ -34,6 +36,52 @@ def get_transforms(dataset_type):
     return data_transforms[dataset_type]
 
 
+def get_tta_transforms(views, k):
+    ''' Get transforms giving `k` views of an ECG recording for test-time augmentation,
+    the views being the recording itself and its random crops ('clip'), polarity flips
+    ('flipy') or small shifts ('roll') in the given order. If `k - 1` is more than the
+    number of the views, the repeated views are also shifted randomly so that they aren't
+    copies of the earlier ones.
+    '''
+    seq_length = 4096
+    
+    tta_views = {
+        'clip': RandomClip(w=seq_length),
+        'flipy': Flipy(p=1.0),
+        'roll': Roll(n=250, p=1.0)
+    }
+    unknown = [view for view in views if view not in tta_views]
+    if unknown:
+        raise NameError('These test-time augmentation views are not included: {}! Use {}'.format(unknown, list(tta_views)))
+    return TTAViews([tta_views[view] for view in views], get_transforms('test'), k, jitter=Roll(n=250, p=1.0))
+
+
+def collate_by_length(batch):
+    ''' Collate a batch of ECG recordings which can be of different lengths, as the test
+    transforms pad the short recordings but don't clip the long ones. The recordings
+    are grouped by their length and each group is collated into tensors, so that every
+    recording is run through the model as it is, without extra padding. With test-time
+    augmentation, each view of a recording is an item of its own with the position of
+    the recording, so a position can be in a group several times.
+    
+    :param batch: Items of the ECGDataset
+    :type batch: list
+    
+    :return groups: Groups of equal-length recordings as tuples of the positions of the
+                    recordings in the batch and the collated items
+    :rtype: list
+    '''
+
+    groups = {}
+    for position, item in enumerate(batch):
+        views = item[0] if isinstance(item[0], list) else [item[0]]
+        for view in views:
+            groups.setdefault(view.shape[-1], []).append((position, (view,) + tuple(item[1:])))
+
+    return [(torch.tensor([position for position, _ in group]), *default_collate([item for _, item in group]))
+            for group in groups.values()]
+
+
 class ECGDataset(Dataset):
     ''' Class implementation of Dataset of ECG recordings
     
@@ -43,9 +91,12 @@ class ECGDataset(Dataset):
     :type preprocess: datasets.transforms.Compose
     :param transform: The other transforms used for ECG recording
     :type transform: datasets.transforms.Compose
+    :param timing: If True, the time spent in loading and transforming the recording 
+                   is returned as the fourth item
+    :type timing: boolean
     '''
 
-    def __init__(self, path, transforms):
+    def __init__(self, path, transforms, timing=False):
         df = pd.read_csv(path)
         self.data = df['path'].tolist()
         labels = df.iloc[:, 4:].values
@@ -57,6 +108,7 @@ class ECGDataset(Dataset):
 
         self.transforms = transforms
         self.channels = 12
+        self.timing = timing
         
     def __len__(self):
         return len(self.data)
@@ -64,14 +116,21 @@ class ECGDataset(Dataset):
     def __getitem__(self, item):
         file_name = self.data[item]
         fs = self.fs[item]
+        start_time = time.perf_counter()
         ecg = load_data(file_name)
+        load_time = time.perf_counter()
         
         ecg = self.transforms(ecg)
+        transform_time = time.perf_counter()
         
         label = self.multi_labels[item]
         
         age = self.age[item]
         gender = self.gender[item]
         age_gender = encode_metadata(age, gender)
+
+        if self.timing:
+            timings = torch.tensor([load_time - start_time, transform_time - load_time], dtype=torch.float64)
+            return ecg, torch.from_numpy(age_gender).float(), torch.from_numpy(label).float(), timings
         return ecg, torch.from_numpy(age_gender).float(), torch.from_numpy(label).float()
       
\ No newline at end of file
@@ -71,6 +71,7 @@ class BandPassFilter(object):
         self.lf = lf
         self.hf = hf
         self.order = order
+        self.sos = signal.butter(order, [2*lf/fs, 2*hf/fs], btype = 'bandpass', output = 'sos')
         
     def bpf(self, arr, fs, lf=0.5, hf=50, order=2):
         wbut = [2*lf/fs, 2*hf/fs]
@@ -81,6 +82,23 @@ class BandPassFilter(object):
         for i, row in enumerate(mseq):
             mseq[i,:] = self.bpf(row, self.fs, self.lf, self.hf, self.order)
         return mseq    
+
+    def initial_state(self, first_samples):
+        ''' Initial state of the causal filter for streaming, the steady state of the
+        first samples of each channel so that the start of a stream doesn't ring
+        '''
+        zi = signal.sosfilt_zi(self.sos)
+        return zi[:, None, :] * np.asarray(first_samples, dtype=np.float64)[None, :, None]
+
+    def stream(self, chunk, zi):
+        ''' Filter a chunk of a stream causally, continuing from the state of the previous
+        chunks. Filtering a recording chunk by chunk gives the same output as filtering it
+        at once. The zero-phase `sosfiltfilt` needs the future samples and can't stream.
+        
+        :return: The filtered chunk and the state for the next chunk
+        :rtype: tuple
+        '''
+        return signal.sosfilt(self.sos, chunk, axis=-1, zi=zi)
     
     
 class Normalize(object):
@@ -308,6 +326,29 @@ class NotchFilter(object):
         return mseq  
 
     
+class TTAViews(object):
+    ''' Views of a recording for test-time augmentation: the recording itself and `k - 1`
+    augmented copies, each augmented with the next transform of `views` in turn. Once all
+    the views are used, the next rounds of the views are also augmented with `jitter`, e.g.
+    a random shift, so that a deterministic view such as a polarity flip isn't repeated as
+    it is. Every view is then transformed like a test recording.
+    '''
+    def __init__(self, views, transforms, k=4, jitter=None):
+        self.views = views
+        self.transforms = transforms
+        self.k = k
+        self.jitter = jitter
+
+    def __call__(self, mseq):
+        views = [self.transforms(mseq.copy())]
+        for i in range(1, self.k):
+            view = self.views[(i - 1) % len(self.views)](mseq.copy())
+            if i > len(self.views) and self.jitter is not None:
+                view = self.jitter(view)
+            views.append(self.transforms(view))
+        return views
+
+
 class ValClip(object):
     def __init__(self, w=72000):
         self.w = w
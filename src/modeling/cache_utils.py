@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+
+def default_cache_path():
+    ''' The prediction cache in the 'experiments' directory
+    '''
+    return os.path.join(os.getcwd(), 'experiments', 'prediction_cache.sqlite')
+
+
+def describe_transforms(transform):
+    ''' Description of a transform and its parameters, e.g. the test transforms, which
+    is the same for transforms working in the same way
+    '''
+    if isinstance(transform, (list, tuple)):
+        return [describe_transforms(t) for t in transform]
+    if isinstance(transform, np.ndarray):
+        return transform.tolist()
+    if hasattr(transform, '__dict__'):
+        return {'type': type(transform).__name__,
+                **{k: describe_transforms(v) for k, v in sorted(vars(transform).items())}}
+    return transform
+
+
+def hash_prediction_config(transforms, **options):
+    ''' Hash of the transforms and the prediction options changing the probabilities of a
+    model, e.g. the precision or the test-time augmentation, the same config gives the same hash
+    '''
+    config = {'transforms': describe_transforms(transforms), **options}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def record_key(model_hash, config_hash, record_hash, age, gender):
+    ''' Key of the probabilities of a model for a recording. The age and gender of the csv
+    file are a part of the key, as the model is given them with the recording.
+    '''
+    return hashlib.sha1('{}|{}|{}|{}|{}'.format(model_hash, config_hash, record_hash, age, gender).encode()).hexdigest()
+
+
+class PredictionCache(object):
+    ''' Persistent cache of predicted probabilities in an sqlite database, keyed by the hash of
+    the model weights, the hash of the transforms and the prediction options and the hash of
+    the recording. The hashes of the files are kept with their size and modification time, so
+    that a file is read for hashing only when it's new or changed. When the probabilities take
+    more than `max_size_mb` megabytes, the least recently used ones are evicted.
+
+    :param path: Absolute path for the database, created if it doesn't exist
+    :type path: str
+    :param max_size_mb: Maximum size of the cached probabilities in megabytes
+    :type max_size_mb: float
+    '''
+
+    def __init__(self, path=None, max_size_mb=1024):
+        self.path = path or default_cache_path()
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS predictions '
+                                    '(key TEXT PRIMARY KEY, probs BLOB, size INTEGER, last_used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS files '
+                                    '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)')
+
+        # Counters of this run
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.hashed_files = 0
+
+    def file_digest(self, path):
+        ''' Hash of the contents of a file, e.g. a trained model or an ECG recording, read from
+        the cache if the file hasn't changed since it was hashed
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.connection.execute('SELECT size, mtime_ns, digest FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+        self.hashed_files += 1
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                    (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def get_many(self, keys):
+        ''' Cached probabilities of the keys which are in the cache
+
+        :param keys: Keys of the probabilities
+        :type keys: list
+
+        :return cached: Probabilities by their keys
+        :rtype: dict
+        '''
+
+        cached = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute('SELECT key, probs FROM predictions WHERE key IN ({})'.format(','.join('?' * len(chunk))), chunk)
+            cached.update({key: np.frombuffer(probs, dtype=np.float32) for key, probs in rows})
+
+        self.hits += len(cached)
+        self.misses += len(keys) - len(cached)
+
+        # Mark the found probabilities as used for the eviction
+        with self.connection:
+            self.connection.executemany('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                        [(time.time(), key) for key in cached])
+        return cached
+
+    def put_many(self, items):
+        ''' Add probabilities into the cache
+
+        :param items: Pairs of a key and the probabilities
+        :type items: list
+        '''
+        now = time.time()
+        rows = []
+        for key, probs in items:
+            blob = np.asarray(probs, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob) + len(key), now))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)', rows)
+
+    def size(self):
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+
+    def evict(self):
+        ''' Remove the least recently used probabilities until the cache fits in its maximum size
+        '''
+        excess = self.size() - self.max_size
+        if excess <= 0:
+            return 0
+
+        evicted, freed = [], 0
+        for key, size in self.connection.execute('SELECT key, size FROM predictions ORDER BY last_used'):
+            if freed >= excess:
+                break
+            evicted.append((key,))
+            freed += size
+        with self.connection:
+            self.connection.executemany('DELETE FROM predictions WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+        return len(evicted)
+
+    def stats(self):
+        ''' Counters of this run and the size of the whole cache
+        '''
+        entries = self.connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {'path': self.path,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'hashed_files': self.hashed_files,
+                'entries': entries,
+                'size_mb': self.size() / (1024 * 1024),
+                'max_size_mb': self.max_size / (1024 * 1024)}
+
+    def report(self):
+        print('\nPrediction cache\n' + '-'*10)
+        for k, v in self.stats().items():
+            print('{:<14} {:.2f}'.format(k + ':', v) if isinstance(v, float) else '{:<14} {}'.format(k + ':', v))
+        print('-'*10)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,136 @@
+import os
+import json
+import numpy as np
+import torch
+from torch import nn
+from torch import optim
+
+# Recordings called normal sinus rhythm by the early exit head skip the rest of the model
+EARLY_EXIT_CLASS = '426783006'
+
+
+def early_exit_index(labels):
+    ''' Index of the normal sinus rhythm in the labels the model is trained with
+    '''
+    labels = [str(label) for label in labels]
+    if EARLY_EXIT_CLASS not in labels:
+        raise Exception('The early exit needs the normal sinus rhythm ({}) among the labels.'.format(EARLY_EXIT_CLASS))
+    return labels.index(EARLY_EXIT_CLASS)
+
+
+def normal_targets(labels, normal_index):
+    ''' Targets of the early exit: the recordings whose only label is normal sinus rhythm.
+    A recording with any other diagnosis must go through the whole model.
+    '''
+    return ((labels[:, normal_index] == 1) & (labels.sum(dim=1) == 1)).float()
+
+
+def exit_head_parameters(model):
+    return getattr(model, 'module', model).exit_head.parameters()
+
+
+def train_exit_head(model, dataloader, normal_index, device, epochs=3, lr=0.003):
+    ''' Train the early exit head of a trained model with the rest of the model frozen
+
+    :param model: Trained model with an early exit head
+    :type model: torch.nn.Module
+    :param dataloader: Training data
+    :type dataloader: torch.utils.data.DataLoader
+    :param normal_index: Index of the normal sinus rhythm in the labels
+    :type normal_index: int
+    :param device: Device the model is on
+    :type device: torch.device
+    :param epochs: Number of the epochs
+    :type epochs: int
+    :param lr: Learning rate
+    :type lr: float
+    '''
+
+    model.eval()
+    for parameter in exit_head_parameters(model):
+        parameter.requires_grad_(True)
+    optimizer = optim.Adam(exit_head_parameters(model), lr=lr)
+    criterion = nn.BCEWithLogitsLoss()
+
+    for epoch in range(1, epochs + 1):
+        total_loss, count = 0.0, 0
+        for batch in dataloader:
+            ecgs, ag, labels = [tensor.to(device) for tensor in batch[:3]]
+            with torch.no_grad():
+                features = model.features(ecgs)
+            loss = criterion(model.exit_logits(features, ag).squeeze(1), normal_targets(labels, normal_index))
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * ecgs.size(0)
+            count += ecgs.size(0)
+        print('early exit epoch {:^3} train loss: {:>5.4f}'.format(epoch, total_loss / max(count, 1)))
+
+    for parameter in exit_head_parameters(model):
+        parameter.requires_grad_(False)
+
+
+def exit_probabilities(model, dataloader, normal_index, device):
+    ''' Early exit probabilities and targets of the recordings of a data loader
+    '''
+    model.eval()
+    probs, targets = [], []
+    with torch.no_grad():
+        for batch in dataloader:
+            ecgs, ag, labels = [tensor.to(device) for tensor in batch[:3]]
+            probs.append(torch.sigmoid(model.exit_logits(model.features(ecgs), ag)).squeeze(1).cpu())
+            targets.append(normal_targets(labels, normal_index).cpu())
+    return torch.cat(probs).numpy(), torch.cat(targets).numpy()
+
+
+def calibrate_exit_threshold(probs, targets, max_miss=0.01, min_threshold=0.5):
+    ''' Lowest exit threshold at which at most `max_miss` of the recordings which aren't
+    normal would exit early, i.e. skip the full model, but at least `min_threshold`
+
+    :param probs: Early exit probabilities, e.g. of the validation split
+    :type probs: numpy.ndarray
+    :param targets: 1 for the recordings which are only normal, 0 for the others
+    :type targets: numpy.ndarray
+    :param max_miss: Highest share of the other recordings allowed to exit
+    :type max_miss: float
+    :param min_threshold: Lowest threshold
+    :type min_threshold: float
+
+    :return calibration: The threshold and the shares of the recordings exiting with it
+    :rtype: dict
+    '''
+
+    others = np.sort(probs[targets == 0])[::-1]
+    allowed = int(np.floor(max_miss * len(others)))
+    threshold = min_threshold
+    if allowed < len(others):
+        # Just above the probability of the first recording over the allowed ones
+        threshold = max(min_threshold, float(np.nextafter(others[allowed], np.float32(np.inf))))
+
+    exits = probs >= threshold
+    return {'threshold': threshold,
+            'max_miss': max_miss,
+            'exit_rate': float(exits.mean()) if len(probs) else 0.0,
+            'normal_exit_rate': float(exits[targets == 1].mean()) if (targets == 1).any() else 0.0,
+            'miss_rate': float(exits[targets == 0].mean()) if (targets == 0).any() else 0.0,
+            'num_records': int(len(probs))}
+
+
+def cascade_path(model_path):
+    ''' Absolute path for the calibration of the early exit, saved next to the model
+    '''
+    return os.path.splitext(model_path)[0] + '_cascade.json'
+
+
+def save_cascade(model_path, calibration):
+    with open(cascade_path(model_path), 'w') as file:
+        json.dump(calibration, file, indent=1)
+
+
+def load_cascade(model_path):
+    path = cascade_path(model_path)
+    if not os.path.exists(path):
+        raise Exception('No early exit calibration found from {}. Train the model with early_exit in its architecture.'.format(path))
+    with open(path, 'r') as file:
+        return json.load(file)
@@ -0,0 +1,181 @@
+import os, re, glob
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    ''' Copy all the tensors of a (nested) state to the CPU memory so that the
+    training can keep updating the originals while the copy is written to the disk
+
+    :param obj: State, e.g. a state dictionary of a model or an optimizer
+    :type obj: dict, list, tuple or torch.Tensor
+
+    :return: Copy of the state with the tensors cloned
+    :rtype: dict, list, tuple or torch.Tensor
+    '''
+
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def rng_states():
+    ''' States of all the random number generators used in training
+    '''
+    states = {
+        'torch': torch.get_rng_state(),
+        'numpy': np.random.get_state(),
+        'random': random.getstate()
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    ''' Restore the states returned by `rng_states()`
+    '''
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['random'])
+    if torch.cuda.is_available() and 'cuda' in states:
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def checkpoint_path(checkpoint_dir, prefix, epoch):
+    return os.path.join(checkpoint_dir, '{}_epoch_{:04d}.pt'.format(prefix, epoch))
+
+
+def checkpoint_epoch(path, prefix):
+    ''' Epoch of a checkpoint file or None if it's not a checkpoint of the prefix
+    '''
+    match = re.search(re.escape(prefix) + r'_epoch_(\d+)\.pt$', os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def list_checkpoints(checkpoint_dir, prefix):
+    ''' List the checkpoints of a training run in the order of the epochs
+
+    :param checkpoint_dir: Directory of the checkpoints
+    :type checkpoint_dir: str
+    :param prefix: Prefix of the checkpoint files, i.e. the name of the training yaml
+    :type prefix: str
+
+    :return: Absolute paths for the checkpoints
+    :rtype: list
+    '''
+
+    checkpoints = []
+    for path in glob.glob(os.path.join(checkpoint_dir, glob.escape(prefix) + '_epoch_*.pt')):
+        epoch = checkpoint_epoch(path, prefix)
+        if epoch is not None:
+            checkpoints.append((epoch, path))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def latest_checkpoint(checkpoint_dir, prefix):
+    ''' The checkpoint of the latest epoch or None if there's no checkpoint
+    '''
+    checkpoints = list_checkpoints(checkpoint_dir, prefix)
+    return checkpoints[-1] if checkpoints else None
+
+
+class AsyncCheckpointer(object):
+    ''' Write checkpoints in a background thread so that the disk I/O doesn't stall
+    the training. The state is copied to the CPU memory in `save()`, and the writer thread
+    saves it into a temporary file which is atomically renamed, so a crash never leaves
+    a partially written checkpoint behind. Only the last `keep_last` checkpoints are kept.
+
+    The existing checkpoints of the prefix from the epoch `start_epoch` on are left by
+    another run, e.g. an earlier training of the same yaml file, and are removed so that
+    they are never resumed from. The earlier ones are the checkpoints the training resumed
+    from, and they are pruned together with the new ones; no other files are touched.
+
+    :param checkpoint_dir: Directory of the checkpoints
+    :type checkpoint_dir: str
+    :param prefix: Prefix of the checkpoint files, i.e. the name of the training yaml
+    :type prefix: str
+    :param keep_last: Number of the latest checkpoints kept, all of them if 0
+    :type keep_last: int
+    :param start_epoch: First epoch of this run, 1 if the training isn't resumed
+    :type start_epoch: int
+    '''
+
+    def __init__(self, checkpoint_dir, prefix, keep_last=3, start_epoch=1):
+        self.checkpoint_dir = checkpoint_dir
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.error = None
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        # Checkpoints of this run in the order of the epochs, the stale ones are removed
+        self.checkpoints = []
+        for path in list_checkpoints(self.checkpoint_dir, self.prefix):
+            if checkpoint_epoch(path, self.prefix) < start_epoch:
+                self.checkpoints.append(path)
+            else:
+                print('Removing the checkpoint of another run', path)
+                os.remove(path)
+
+        # At most two pending checkpoints in the memory at a time
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._write_loop, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, state, epoch):
+        ''' Queue a checkpoint to be written
+
+        :param state: State of the training, e.g. the state dictionaries of the model and the optimizer
+        :type state: dict
+        :param epoch: Epoch of the checkpoint
+        :type epoch: int
+        '''
+
+        self._raise_error()
+        self.queue.put((snapshot(state), epoch))
+
+    def close(self):
+        ''' Wait until all the queued checkpoints are written and stop the writer thread
+        '''
+
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            state, epoch = item
+            try:
+                path = checkpoint_path(self.checkpoint_dir, self.prefix, epoch)
+                tmp_path = path + '.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+                if path not in self.checkpoints:
+                    self.checkpoints.append(path)
+                self._remove_old()
+            except Exception as e:
+                self.error = e
+
+    def _remove_old(self):
+        if self.keep_last <= 0:
+            return
+        while len(self.checkpoints) > self.keep_last:
+            path = self.checkpoints.pop(0)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('Writing a checkpoint failed') from self.error
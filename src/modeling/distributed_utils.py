@@ -0,0 +1,96 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    ''' Initialize the default process group if the script was launched with
+    several processes, e.g. with `torchrun --nproc_per_node=4 train_model.py ...`.
+    The rank, world size and the address of the master process are read from
+    the environment variables set by the launcher, so the same code runs on one
+    or several nodes.
+
+    :param backend: Backend of the process group, 'gloo' works both on CPU and GPU
+    :type backend: str
+
+    :return: True if the training is distributed
+    :rtype: boolean
+    '''
+
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not is_distributed():
+        dist.init_process_group(backend=backend)
+    return is_distributed()
+
+
+def cleanup_distributed():
+    ''' Destroy the default process group if there is one
+    '''
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0)) if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def gather_tensor(tensor, dst=0):
+    ''' Gather tensors of the same shape from all the processes into one process.
+    The tensors are concatenated along the first dimension in the order of the ranks.
+
+    :param tensor: Tensor of the current process
+    :type tensor: torch.Tensor
+    :param dst: Rank of the process which gathers the tensors
+    :type dst: int
+
+    :return: Concatenated tensors in the process `dst`, None in the other processes
+    :rtype: torch.Tensor
+    '''
+
+    if not is_distributed():
+        return tensor
+
+    # Gloo gathers only CPU tensors
+    tensor = tensor.detach().cpu().contiguous()
+    gather_list = [torch.empty_like(tensor) for _ in range(get_world_size())] if get_rank() == dst else None
+    dist.gather(tensor, gather_list, dst=dst)
+
+    return torch.cat(gather_list, 0) if get_rank() == dst else None
+
+
+def all_reduce_sum(value):
+    ''' Sum a number over all the processes
+
+    :param value: Number of the current process
+    :type value: float
+
+    :return: Sum over the processes
+    :rtype: float
+    '''
+
+    if not is_distributed():
+        return value
+
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item()
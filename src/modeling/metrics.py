@@ -41,15 +41,60 @@ def cal_multilabel_metrics(y_true, y_pre, labels, threshold=0.5):
     return macro_avg_prec, micro_avg_prec, macro_auroc, micro_auroc, challenge_metric
 
     
+def to_numpy(y):
+    ''' Convert a tensor to a numpy array. Numpy arrays, e.g. the ones loaded
+    from the saved test outputs, are returned as they are.
+    
+    :param y: Labels or probabilities
+    :type y: torch.Tensor or numpy.ndarray
+    
+    :return: The values as a numpy array
+    :rtype: numpy.ndarray
+    '''
+    
+    if torch.is_tensor(y):
+        return y.cpu().detach().numpy()
+    return np.asarray(y)
+
+
+def binarize_predictions(pre_prob, threshold=0.5):
+    ''' One-hot-encode predicted probabilities. The likeliest diagnosis of each
+    recording is always predicted, and all the others that are above the decision
+    threshold are added to it.
+    
+    :param pre_prob: Predicted probabilities, one row per recording
+    :type pre_prob: numpy.ndarray
+    :param threshold: Decision threshold
+    :type threshold: float
+    
+    :return pre_binary: One-hot-encoded predicted labels
+    :rtype: numpy.ndarray
+    '''
+
+    pre_prob = np.atleast_2d(pre_prob)
+    pre_binary = np.zeros(pre_prob.shape, dtype=np.int32)
+
+    # Find the index of the maximum value within the logits
+    likeliest_dx = np.argmax(pre_prob, axis=1)
+
+    # First, add the most likeliest diagnosis to the predicted label
+    pre_binary[np.arange(pre_prob.shape[0]), likeliest_dx] = 1
+
+    # Then, add all the others that are above the decision threshold
+    pre_binary[pre_prob >= threshold] = 1
+
+    return pre_binary
+
+
 def preprocess_labels(y_true, y_pre, labels, threshold = 0.5, drop_missing = True):
     ''' Convert tensor variables to numpy and check the positive class labels. 
     If there's none, leave the columns out from actual labels, binary predictions,
     logits and class labels used in the classification.
     
     :param y_true: Actual class labels
-    :type y_true: torch.Tensor
+    :type y_true: torch.Tensor or numpy.ndarray
     :param y_pre: Logits of predicted labels
-    :type y_pre: torch.Tensor
+    :type y_pre: torch.Tensor or numpy.ndarray
     
     :return true_labels, pre_prob, pre_binary, labels: Converted (and possibly filtered) actual labels,
                                                        binary predictions and logits
@@ -58,27 +103,14 @@ def preprocess_labels(y_true, y_pre, labels, threshold = 0.5, drop_missing = Tru
     '''
 
     # Actual labels from tensor to numpy
-    true_labels = y_true.cpu().detach().numpy().astype(np.int32)  
+    true_labels = to_numpy(y_true).astype(np.int32)
 
     # Logits from tensor to numpy
-    pre_prob = y_pre.cpu().detach().numpy().astype(np.float32)
+    pre_prob = to_numpy(y_pre).astype(np.float32)
     
     # ------ One-hot-endcode predicted labels ------
 
-    pre_binary = np.zeros(pre_prob.shape, dtype=np.int32)
-
-    # Find the index of the maximum value within the logits
-    likeliest_dx = np.argmax(pre_prob, axis=1)
-
-    # First, add the most likeliest diagnosis to the predicted label
-    pre_binary[np.arange(true_labels.shape[0]), likeliest_dx] = 1
-
-    # Then, add all the others that are above the decision threshold
-    other_dx = pre_prob >= threshold
-
-    pre_binary = pre_binary + other_dx
-    pre_binary[pre_binary > 1.1] = 1
-    pre_binary = np.squeeze(pre_binary) 
+    pre_binary = binarize_predictions(pre_prob, threshold)
 
     if drop_missing:
         
@@ -118,6 +150,31 @@ def physionet_challenge_score(y_true, y_pre, labels):
     :rtype: float
     '''    
     
+    weights, classes = load_challenge_weights()
+
+    # ------------- Reshape actual and predicted labels -------------
+
+    true_labels, binary_outputs = challenge_labels(y_true, y_pre, labels, classes)
+
+    # ------------- Challenge metric -------------
+
+    sinus_rhythm = '426783006'
+    challenge_metric = compute_challenge_metric(weights,
+                                                true_labels,
+                                                binary_outputs,
+                                                classes,
+                                                sinus_rhythm)
+
+    return challenge_metric
+
+
+def load_challenge_weights():
+    ''' Load the classes scored in the PhysioNet Challenge 2021 and the weight
+    matrix used in the scoring.
+    
+    :return weights, classes: Weight matrix and the scored classes as SNOMED CT Codes
+    :rtype: numpy.ndarray, list
+    '''
 
    # -------- Load the Physionet Challenge scored classes --------
 
@@ -151,11 +208,28 @@ def physionet_challenge_score(y_true, y_pre, labels):
                     l = classes.index(b)
                     weights[k, l] = weights_df.values[i, j]
 
-    # ------------- Reshape actual and predicted labels -------------
+    return weights, classes
 
-    # We need the arrays of actual and perdicted labels to be in the shape of 
-    # <num of recording> X <num of scored labels in Physionet Challenge 2021>
 
+def challenge_labels(y_true, y_pre, labels, classes):
+    ''' Reshape the actual and predicted labels into the classes scored in the
+    PhysioNet Challenge 2021, i.e. into the shape of
+    <num of recording> X <num of scored labels in Physionet Challenge 2021>
+    
+    :param y_true: Actual class labels
+    :type y_true: numpy.ndarray
+    :param y_pre: One-hot-encoded predicted labels
+    :type y_pre: numpy.ndarray
+    :param labels: Class labels used in the classification as SNOMED CT Codes
+    :type labels: list
+    :param classes: Labels used in scoring as SNOMED CT Codes
+    :type classes: list
+    
+    :return true_labels, binary_outputs: Actual and predicted labels of the scored classes
+    :rtype: numpy.ndarrays
+    '''
+
+    num_classes = len(classes)
     true_labels = np.zeros((len(y_true), num_classes), dtype=np.bool_)
     binary_outputs = np.zeros((len(y_pre), num_classes), dtype=np.bool_)
     
@@ -167,16 +241,7 @@ def physionet_challenge_score(y_true, y_pre, labels):
             true_labels[:, class_index] = y_true[:, i]
             binary_outputs[:, class_index] = y_pre[:, i]
 
-    # ------------- Challenge metric -------------
-
-    sinus_rhythm = '426783006'
-    challenge_metric = compute_challenge_metric(weights,
-                                                true_labels,
-                                                binary_outputs,
-                                                classes,
-                                                sinus_rhythm)
-
-    return challenge_metric
+    return true_labels, binary_outputs
 
 
 def compute_modified_confusion_matrix(labels, outputs):
@@ -194,28 +259,24 @@ def compute_modified_confusion_matrix(labels, outputs):
 
     # Compute a binary multi-class, multi-label confusion matrix, where the rows
     # are the labels and the columns are the outputs.
-    num_recordings, num_classes = np.shape(labels)
-    A = np.zeros((num_classes, num_classes))
-
-    # Iterate over all of the recordings.
-    for i in range(num_recordings):
-        # Calculate the number of positive labels and/or outputs.
-        normalization = float(max(np.sum(np.any((labels[i, :], outputs[i, :]), axis=0)), 1))
-        # Iterate over all of the classes.
-        for j in range(num_classes):
-            # Assign full and/or partial credit for each positive class.
-            if labels[i, j]:
-                for k in range(num_classes):
-                    if outputs[i, k]:
-                        A[j, k] += 1.0/normalization
+    labels = np.asarray(labels, dtype=np.float64)
+    outputs = np.asarray(outputs, dtype=np.float64)
+
+    # Calculate the number of positive labels and/or outputs of each recording.
+    normalization = np.maximum(np.sum(np.logical_or(labels, outputs), axis=1), 1)
+
+    # Assign full and/or partial credit for each positive class,
+    # summed over all of the recordings.
+    A = (labels / normalization[:, np.newaxis]).T @ outputs
     return A
 
 
-def compute_challenge_metric(weights, labels, outputs, classes, sinus_rhythm):
-    ''' Compute the evaluation metric for the Challenge.
+def challenge_confusion_matrices(labels, outputs, classes, sinus_rhythm):
+    ''' Compute the modified confusion matrices of the observed outputs, of the
+    outputs that are always correct and of the outputs that always choose the sinus
+    rhythm class. All of them are sums over the recordings, so they can be
+    accumulated over chunks of recordings.
     
-    :param weights: Physionet Challenge weight for each label
-    :type weights: numpy.ndarray
     :param labels: Actual class labels
     :type labels: numpy.ndarray
     :param outputs: One-hot-encoded predicted labels
@@ -225,8 +286,8 @@ def compute_challenge_metric(weights, labels, outputs, classes, sinus_rhythm):
     :param sinus_rhythm: SNOMED CT Code of sinus rhythm
     :type sinus_rhythm: str
     
-    :return normalized_score: normalized challenge metric
-    :rtype: float
+    :return observed, correct, inactive: Confusion matrices
+    :rtype: numpy.ndarrays
     '''
     
     num_recordings, num_classes = np.shape(labels)
@@ -235,20 +296,35 @@ def compute_challenge_metric(weights, labels, outputs, classes, sinus_rhythm):
     else:
         raise ValueError('The sinus rhythm class is not available.')
 
-    # Compute the observed score.
-    A = compute_modified_confusion_matrix(labels, outputs)
-    observed_score = np.nansum(weights * A)
+    # The observed outputs
+    observed = compute_modified_confusion_matrix(labels, outputs)
 
-    # Compute the score for the model that always chooses the correct label(s).
-    correct_outputs = labels
-    A = compute_modified_confusion_matrix(labels, correct_outputs)
-    correct_score = np.nansum(weights * A)
+    # The model that always chooses the correct label(s)
+    correct = compute_modified_confusion_matrix(labels, labels)
 
-    # Compute the score for the model that always chooses the sinus rhythm class.
+    # The model that always chooses the sinus rhythm class
     inactive_outputs = np.zeros((num_recordings, num_classes), dtype=np.bool_)
     inactive_outputs[:, sinus_rhythm_index] = 1
-    A = compute_modified_confusion_matrix(labels, inactive_outputs)
-    inactive_score = np.nansum(weights * A)
+    inactive = compute_modified_confusion_matrix(labels, inactive_outputs)
+
+    return observed, correct, inactive
+
+
+def normalized_challenge_score(weights, observed, correct, inactive):
+    ''' Compute the normalized challenge metric from the modified confusion matrices
+    
+    :param weights: Physionet Challenge weight for each label
+    :type weights: numpy.ndarray
+    :param observed, correct, inactive: Confusion matrices from `challenge_confusion_matrices`
+    :type observed, correct, inactive: numpy.ndarray
+    
+    :return normalized_score: normalized challenge metric
+    :rtype: float
+    '''
+    
+    observed_score = np.nansum(weights * observed)
+    correct_score = np.nansum(weights * correct)
+    inactive_score = np.nansum(weights * inactive)
 
     if correct_score != inactive_score:
         normalized_score = float(observed_score - inactive_score) / float(correct_score - inactive_score)
@@ -258,6 +334,28 @@ def compute_challenge_metric(weights, labels, outputs, classes, sinus_rhythm):
     return normalized_score
 
 
+def compute_challenge_metric(weights, labels, outputs, classes, sinus_rhythm):
+    ''' Compute the evaluation metric for the Challenge.
+    
+    :param weights: Physionet Challenge weight for each label
+    :type weights: numpy.ndarray
+    :param labels: Actual class labels
+    :type labels: numpy.ndarray
+    :param outputs: One-hot-encoded predicted labels
+    :type outputs: numpy.ndarray
+    :param classes: Labels used in scoring as SNOMED CT Codes
+    :type classes: list
+    :param sinus_rhythm: SNOMED CT Code of sinus rhythm
+    :type sinus_rhythm: str
+    
+    :return normalized_score: normalized challenge metric
+    :rtype: float
+    '''
+    
+    observed, correct, inactive = challenge_confusion_matrices(labels, outputs, classes, sinus_rhythm)
+    return normalized_challenge_score(weights, observed, correct, inactive)
+
+
 def roc_curves(y_true, y_pre, labels, epoch=None, save_path='./experiments/'):
     '''Compute and plot the ROC Curves for each class, also macro and micro. Save as a png image.
     
@@ -284,6 +382,24 @@ def roc_curves(y_true, y_pre, labels, epoch=None, save_path='./experiments/'):
     fpr["micro"], tpr["micro"], _ = roc_curve(true_labels.ravel(), pre_prob.ravel())
     roc_auc["micro"] = auc(fpr["micro"], tpr["micro"])
 
+    plot_roc_curves(fpr, tpr, roc_auc, cls_labels, epoch, save_path)
+
+
+def plot_roc_curves(fpr, tpr, roc_auc, cls_labels, epoch=None, save_path='./experiments/'):
+    '''Plot the ROC Curves for each class, also macro and micro. Save as a png image.
+    
+    :param fpr: False positive rates of each class (indexes) and of the micro-average ("micro")
+    :type fpr: dict
+    :param tpr: True positive rates of each class (indexes) and of the micro-average ("micro")
+    :type tpr: dict
+    :param roc_auc: Areas under the ROC curves, keyed as fpr and tpr
+    :type roc_auc: dict
+    :param cls_labels: Class labels of the curves as SNOMED CT Codes
+    :type cls_labels: list
+    :param epoch: Epoch in which the predictions are made
+    :type epoch: int
+    '''
+
     # Interpolate all ROC curves at these points to compute macro-average ROC area
     fpr_grid = np.linspace(0.0, 1.0, 1000)
     mean_tpr = np.zeros_like(fpr_grid)
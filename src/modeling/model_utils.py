@@ -0,0 +1,239 @@
+import os
+import copy
+import json
+import inspect
+import hashlib
+import tempfile
+import contextlib
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from .models.seresnet18 import ARCHITECTURE, seresnet
+
+# Supported numerical precisions of the forward pass
+PRECISIONS = {
+    'fp32': None,
+    'bf16': torch.bfloat16
+}
+
+
+def autocast(device, precision='fp32'):
+    ''' Context manager for running the forward pass of a model in the given precision.
+    With 'fp32' nothing is changed, with 'bf16' the supported operations are run in
+    bfloat16 using `torch.autocast` on both CPU and CUDA.
+
+    :param device: Device the model is run on
+    :type device: torch.device
+    :param precision: Precision of the forward pass, 'fp32' or 'bf16'
+    :type precision: str
+
+    :return: The autocast context
+    :rtype: contextlib.AbstractContextManager
+    '''
+
+    if precision not in PRECISIONS:
+        raise NameError('This precision is not included! Use one of {}'.format(list(PRECISIONS)))
+
+    if PRECISIONS[precision] is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=PRECISIONS[precision])
+
+
+# Supported ways of compiling a model
+COMPILE_MODES = ['eager', 'inductor', 'torchscript']
+
+
+def compile_model(model, mode='eager', cache_dir=None):
+    ''' Compile a model to reduce the overhead of running its many small operations one by one.
+    With 'inductor' the model is compiled with `torch.compile`, which generates fused kernels
+    on the first call. With 'torchscript' the model is scripted with `torch.jit.script`.
+    With 'eager' the model is returned as it is.
+
+    The compiled graphs are cached on the disk so that the compile time is paid once: the
+    inductor caches are written to `cache_dir` and the scripted models are saved into it
+    with a key from the source code and the parameter shapes of the model. A scripted model
+    loaded from the cache is given the parameters and buffers of the model.
+
+    :param model: Model to compile
+    :type model: torch.nn.Module
+    :param mode: 'eager', 'inductor' or 'torchscript'
+    :type mode: str
+    :param cache_dir: Directory for the compiled graphs, not cached if None
+    :type cache_dir: str
+
+    :return: The compiled model sharing the parameters with the original one
+    :rtype: torch.nn.Module
+    '''
+
+    if mode in [None, False, 'eager']:
+        return model
+    if mode not in COMPILE_MODES:
+        raise NameError('This compile mode is not included! Use one of {}'.format(COMPILE_MODES))
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    if mode == 'inductor':
+        if cache_dir is not None:
+            from torch._inductor import config as inductor_config
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+            inductor_config.fx_graph_cache = True
+        return torch.compile(model)
+
+    # TorchScript
+    if cache_dir is None:
+        return torch.jit.script(model)
+
+    cache_path = os.path.join(cache_dir, '{}_{}.pt'.format(type(model).__name__, script_cache_key(model)))
+    if os.path.exists(cache_path):
+        scripted = torch.jit.load(cache_path, map_location=next(model.parameters()).device)
+        share_tensors(scripted, model)
+        scripted.train(model.training)
+        return scripted
+
+    # Each process saves into a temporary file of its own, e.g. the concurrent training jobs
+    # of the folds, and if another one has already saved the same model, its file is kept
+    scripted = torch.jit.script(model)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            torch.jit.save(scripted, file)
+        if os.path.exists(cache_path):
+            os.remove(tmp_path)
+        else:
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, cache_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return scripted
+
+
+def share_tensors(scripted, model):
+    ''' Replace the parameters and buffers of a scripted model loaded from the cache with
+    the ones of the original model, so that both are trained and updated together as
+    with a model scripted from the original one
+    '''
+    submodules = dict(scripted.named_modules())
+    for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+        module_name, _, attr = name.rpartition('.')
+        setattr(submodules[module_name], attr, tensor)
+
+
+def script_cache_key(model):
+    ''' Key of a scripted model in the cache, changes if the code or the architecture changes
+    '''
+    key = hashlib.sha1(torch.__version__.encode())
+    key.update(inspect.getsource(inspect.getmodule(type(model))).encode())
+    for name, tensor in model.state_dict().items():
+        key.update('{}:{}:{}'.format(name, tuple(tensor.shape), tensor.dtype).encode())
+    return key.hexdigest()[:16]
+
+
+def unwrap_compiled(model):
+    ''' The original model of a model compiled with `torch.compile`
+    '''
+    return getattr(model, '_orig_mod', model)
+
+
+def fold_conv_bn(parent, conv_name, bn_name):
+    ''' Fold a batch normalization into the preceding convolution of the same parent module.
+    The batch normalization is replaced with an identity.
+    '''
+    conv = getattr(parent, conv_name)
+    bn = getattr(parent, bn_name)
+    setattr(parent, conv_name, fuse_conv_bn_eval(conv, bn))
+    setattr(parent, bn_name, nn.Identity())
+
+
+def optimize_for_inference(model):
+    ''' Transform a model into an eval-only model with the same outputs but fewer operations.
+    Each batch normalization which follows a convolution, i.e. in the stem of the ResNet,
+    in the residual blocks and in the downsampling paths, is folded into the weights and the
+    bias of the convolution using the running statistics, and the dropouts are removed.
+    The original model is not changed.
+
+    :param model: Model to optimize
+    :type model: torch.nn.Module
+
+    :return: The optimized model in eval mode
+    :rtype: torch.nn.Module
+    '''
+
+    model = copy.deepcopy(model).eval()
+
+    for module in list(model.modules()):
+        # Named pairs of a convolution and a batch normalization, e.g. conv1 and bn1
+        for conv_name, conv in list(module.named_children()):
+            if not isinstance(conv, nn.Conv1d) or not conv_name.startswith('conv'):
+                continue
+            bn_name = 'bn' + conv_name[len('conv'):]
+            if isinstance(getattr(module, bn_name, None), nn.BatchNorm1d):
+                fold_conv_bn(module, conv_name, bn_name)
+
+        # Consecutive convolution and batch normalization, e.g. the downsampling path
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                if isinstance(module[i], nn.Conv1d) and isinstance(module[i+1], nn.BatchNorm1d):
+                    fold_conv_bn(module, str(i), str(i+1))
+
+        # Dropout is an identity in eval mode
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Dropout):
+                setattr(module, name, nn.Identity())
+
+    return model
+
+
+def model_architecture(config=None):
+    ''' Architecture of an SE-ResNet from the `architecture` section of a training yaml file,
+    the options not given are the ones of resnet18
+
+    :param config: Options of the architecture (layers, width_multiplier, kernel_size, se, se_reduction)
+    :type config: dict or utils.obj
+
+    :return architecture: All the options of the architecture
+    :rtype: dict
+    '''
+
+    config = dict(config if isinstance(config, dict) else vars(config)) if config is not None else {}
+    unknown = [key for key in config if key not in ARCHITECTURE]
+    if unknown:
+        raise NameError('These architecture options are not included: {}! Use {}'.format(unknown, list(ARCHITECTURE)))
+
+    architecture = dict(ARCHITECTURE, **config)
+    architecture['layers'] = [int(blocks) for blocks in architecture['layers']]
+    if len(architecture['layers']) != 4 or min(architecture['layers']) < 1:
+        raise Exception('The architecture needs at least one block in each of the four stages, got {}'.format(architecture['layers']))
+    if architecture['kernel_size'] % 2 == 0:
+        raise Exception('The kernel size of the residual blocks must be odd, got {}'.format(architecture['kernel_size']))
+    return architecture
+
+
+def build_model(architecture, in_channel, out_channel):
+    ''' Construct an SE-ResNet of the given architecture, see `model_architecture`
+    '''
+    return seresnet(in_channel=in_channel, out_channel=out_channel, **architecture)
+
+
+def architecture_path(model_path):
+    ''' Absolute path for the metadata of a trained model, saved next to the model
+    '''
+    return os.path.splitext(model_path)[0] + '_architecture.json'
+
+
+def save_architecture(model_path, architecture):
+    with open(architecture_path(model_path), 'w') as file:
+        json.dump(architecture, file, indent=1)
+
+
+def load_architecture(model_path):
+    ''' Architecture of a trained model from its metadata. The models saved without
+    the metadata (e.g. trained before the architecture was configurable) are resnet18.
+    '''
+    path = architecture_path(model_path)
+    if not os.path.exists(path):
+        return model_architecture()
+    with open(path, 'r') as file:
+        return model_architecture(json.load(file))
@@ -6,10 +6,11 @@ class SELayer(nn.Module):
     def __init__(self, channel, reduction=16):
         super(SELayer, self).__init__()
         self.avg_pool = nn.AdaptiveAvgPool1d(1)
+        hidden = max(1, channel // reduction)
         self.fc = nn.Sequential(
-            nn.Linear(channel, channel // reduction, bias=False),
+            nn.Linear(channel, hidden, bias=False),
             nn.ReLU(inplace=True),
-            nn.Linear(channel // reduction, channel, bias=False),
+            nn.Linear(hidden, channel, bias=False),
             nn.Sigmoid()
         )
 
@@ -20,10 +21,10 @@ class SELayer(nn.Module):
         return x * y.expand_as(x)
 
 
-def conv3x1(in_planes, out_planes, stride=1):
+def conv3x1(in_planes, out_planes, stride=1, kernel_size=7):
     """3x3 convolution with padding"""
-    return nn.Conv1d(in_planes, out_planes, kernel_size=7, stride=stride,
-                     padding=3, bias=False)
+    return nn.Conv1d(in_planes, out_planes, kernel_size=kernel_size, stride=stride,
+                     padding=kernel_size // 2, bias=False)
 
 
 def conv1x1(in_planes, out_planes, stride=1):
@@ -37,14 +38,14 @@ class BasicBlock(nn.Module):
     '''
     expansion = 1
 
-    def __init__(self, inplanes, planes, stride=1, downsample=None):
+    def __init__(self, inplanes, planes, stride=1, downsample=None, kernel_size=7, se=True, se_reduction=16):
         super(BasicBlock, self).__init__()
-        self.conv1 = conv3x1(inplanes, planes, stride) # 3x3 padding
+        self.conv1 = conv3x1(inplanes, planes, stride, kernel_size) # 3x3 padding
         self.bn1 = nn.BatchNorm1d(planes) # 
         self.relu = nn.ReLU(inplace=True)
-        self.conv2 = conv3x1(planes, planes)
+        self.conv2 = conv3x1(planes, planes, kernel_size=kernel_size)
         self.bn2 = nn.BatchNorm1d(planes)
-        self.se = SELayer(planes)
+        self.se = SELayer(planes, se_reduction) if se else nn.Identity()
         self.downsample = downsample
         self.stride = stride
         self.dropout = nn.Dropout(.2)
@@ -83,20 +84,24 @@ class ResNet(nn.Module):
      (Zhao et al. 2022)
     '''
 
-    def __init__(self, block, layers, in_channel=1, out_channel=10, zero_init_residual=False):
+    def __init__(self, block, layers, in_channel=1, out_channel=10, zero_init_residual=False,
+                 widths=[64, 128, 256, 512], kernel_size=7, se=True, se_reduction=16, early_exit=False):
         super(ResNet, self).__init__()
-        self.inplanes = 64
-        self.conv1 = nn.Conv1d(in_channel, 64, kernel_size=15, stride=2, padding=7, bias=False)
-        self.bn1 = nn.BatchNorm1d(64)
+        self.block_kwargs = dict(kernel_size=kernel_size, se=se, se_reduction=se_reduction)
+        self.inplanes = widths[0]
+        self.conv1 = nn.Conv1d(in_channel, widths[0], kernel_size=15, stride=2, padding=7, bias=False)
+        self.bn1 = nn.BatchNorm1d(widths[0])
         self.relu = nn.ReLU(inplace=True)
         self.maxpool = nn.MaxPool1d(kernel_size=3, stride=2, padding=1)
-        self.layer1 = self._make_layer(block, 64, layers[0]) 
-        self.layer2 = self._make_layer(block, 128, layers[1], stride=2)
-        self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
-        self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
+        self.layer1 = self._make_layer(block, widths[0], layers[0]) 
+        self.layer2 = self._make_layer(block, widths[1], layers[1], stride=2)
+        self.layer3 = self._make_layer(block, widths[2], layers[2], stride=2)
+        self.layer4 = self._make_layer(block, widths[3], layers[3], stride=2)
         self.avgpool = nn.AdaptiveAvgPool1d(1)
         self.fc1 = nn.Linear(3, 10) # AGE AND GENDER LAYER - input size the same with the array size of attributes
-        self.fc = nn.Linear(512 * block.expansion + 10, out_channel)
+        self.fc = nn.Linear(widths[3] * block.expansion + 10, out_channel)
+        # Auxiliary head after layer2 for the early exit of the recordings it calls normal
+        self.exit_head = nn.Linear(widths[1] * block.expansion + 10, 1) if early_exit else None
         #self.sig = nn.Sigmoid() ! DON'T USE HERE CAUSE IMPLEMENTED IN THE TRAINING LOOP IN ./utils/train_utils_clip_ag.py
 
         for m in self.modules():
@@ -125,14 +130,19 @@ class ResNet(nn.Module):
             )
 
         layers = []
-        layers.append(block(self.inplanes, planes, stride, downsample))
+        layers.append(block(self.inplanes, planes, stride, downsample, **self.block_kwargs))
         self.inplanes = planes * block.expansion
         for _ in range(1, blocks):
-            layers.append(block(self.inplanes, planes))
+            layers.append(block(self.inplanes, planes, **self.block_kwargs))
 
         return nn.Sequential(*layers)
 
     def forward(self, x, ag):
+        x = self.features(x)
+        return self.classify(x, ag)
+
+    def features(self, x):
+        ''' Features of the recordings up to layer2, shared by the classifier and the early exit '''
         x = self.conv1(x) # Input layer, convolution operation
         x = self.bn1(x) # Applies Batch Normalization over a 2D or 3D input
         x = self.relu(x) # Applies the rectified linear unit function element-wise
@@ -140,6 +150,10 @@ class ResNet(nn.Module):
 
         x = self.layer1(x) # 2nd convolution layer -> output size 56x56 ()
         x = self.layer2(x) # 3rd convolution layer -> output size 28x28
+        return x
+
+    def classify(self, x, ag):
+        ''' Outputs of the classifier from the features of `features` '''
         x = self.layer3(x) # 4th convolution layer -> output size 14x14
         x = self.layer4(x) # 5th convolution layer -> output size 7x7
 
@@ -151,9 +165,40 @@ class ResNet(nn.Module):
 
         return x
 
+    @torch.jit.export
+    def exit_logits(self, x, ag):
+        ''' Logit of the early exit from the features of `features` '''
+        assert self.exit_head is not None, 'The model has no early exit head'
+        x = self.avgpool(x)
+        x = x.view(x.size(0), -1)
+        ag = self.fc1(ag)
+        x = torch.cat((ag, x), dim=1)
+        return self.exit_head(x)
+
 
 def resnet18(**kwargs):
     """Constructing a ResNet-18 model.
     """
     model = ResNet(BasicBlock, [2, 2, 2, 2], **kwargs)
+    return model
+
+
+# The architecture of resnet18, the defaults of the configurable SE-ResNets
+ARCHITECTURE = {
+    'layers': [2, 2, 2, 2],     # residual blocks in each of the four stages
+    'width_multiplier': 1.0,    # multiplier of the 64, 128, 256 and 512 channels of the stages
+    'kernel_size': 7,           # kernel size of the convolutions in the residual blocks
+    'se': True,                 # Squeeze-and-Excitation blocks on or off
+    'se_reduction': 16,         # reduction ratio of the Squeeze-and-Excitation blocks
+    'early_exit': False         # auxiliary head after layer2 for the early exit of normal recordings
+}
+
+
+def seresnet(layers=[2, 2, 2, 2], width_multiplier=1.0, kernel_size=7, se=True, se_reduction=16, early_exit=False, **kwargs):
+    """Constructing an SE-ResNet of a given depth and width, the defaults give resnet18.
+    The channels of the stages are rounded to multiples of 8.
+    """
+    widths = [max(8, int(round(w * width_multiplier / 8)) * 8) for w in [64, 128, 256, 512]]
+    model = ResNet(BasicBlock, list(layers), widths=widths, kernel_size=kernel_size,
+                   se=se, se_reduction=se_reduction, early_exit=early_exit, **kwargs)
     return model
\ No newline at end of file
@@ -0,0 +1,328 @@
+import numpy as np
+import os
+import queue
+import shutil
+import struct
+import zipfile
+import threading
+
+
+def test_outputs_path(output_dir, yaml_file_name):
+    ''' Path of the array file where the raw outputs of a prediction run are saved
+
+    :param output_dir: Directory of the prediction run
+    :type output_dir: str
+    :param yaml_file_name: Name of the yaml file used in the run
+    :type yaml_file_name: str
+
+    :return: Absolute path for the array file
+    :rtype: str
+    '''
+
+    return os.path.join(output_dir, yaml_file_name + '_test_outputs.npz')
+
+
+def save_test_outputs(path, filenames, labels, y_true, y_prob):
+    ''' Save the actual labels and the predicted probabilities of a test set
+    into one array file so that the metrics can be recomputed without the model
+    or the ECG files.
+
+    :param path: Absolute path for the array file (.npz)
+    :type path: str
+    :param filenames: Paths of the ECG recordings, one per row of the arrays
+    :type filenames: list
+    :param labels: Class labels used in the classification as SNOMED CT Codes
+    :type labels: list
+    :param y_true: Actual class labels
+    :type y_true: numpy.ndarray
+    :param y_prob: Predicted probabilities
+    :type y_prob: numpy.ndarray
+    '''
+
+    assert len(filenames) == y_true.shape[0] == y_prob.shape[0], 'There should be as many recordings as there are rows in the arrays'
+
+    np.savez(path,
+             filenames=np.asarray(filenames, dtype=str),
+             labels=np.asarray(labels, dtype=str),
+             y_true=np.asarray(y_true, dtype=np.int8),
+             y_prob=np.asarray(y_prob, dtype=np.float32))
+
+
+def load_test_outputs(path):
+    ''' Load the arrays saved with `save_test_outputs`
+
+    :param path: Absolute path for the array file (.npz)
+    :type path: str
+
+    :return filenames, labels, y_true, y_prob: Paths of the ECG recordings, class labels,
+                                               actual labels and predicted probabilities
+    :rtype: list, list, numpy.ndarray, numpy.ndarray
+    '''
+
+    with np.load(path) as outputs:
+        filenames = outputs['filenames'].tolist()
+        labels = outputs['labels'].tolist()
+        y_true = outputs['y_true']
+        y_prob = outputs['y_prob']
+
+    return filenames, labels, y_true, y_prob
+
+
+def test_memmap_paths(output_dir, yaml_file_name):
+    ''' Paths of the disk-backed arrays where the actual labels and the predicted
+    probabilities are streamed in the chunked evaluation mode
+
+    :param output_dir: Directory of the prediction run
+    :type output_dir: str
+    :param yaml_file_name: Name of the yaml file used in the run
+    :type yaml_file_name: str
+
+    :return: Absolute paths for the arrays of the actual labels and the probabilities
+    :rtype: str, str
+    '''
+
+    return (os.path.join(output_dir, yaml_file_name + '_test_y_true.npy'),
+            os.path.join(output_dir, yaml_file_name + '_test_y_prob.npy'))
+
+
+def open_test_memmaps(output_dir, yaml_file_name, num_records, num_classes):
+    ''' Create the disk-backed arrays for the actual labels and the predicted probabilities
+
+    :param output_dir: Directory of the prediction run
+    :type output_dir: str
+    :param yaml_file_name: Name of the yaml file used in the run
+    :type yaml_file_name: str
+    :param num_records: Number of recordings in the test set
+    :type num_records: int
+    :param num_classes: Number of class labels
+    :type num_classes: int
+
+    :return y_true, y_prob: Writable memory-mapped arrays
+    :rtype: numpy.memmap, numpy.memmap
+    '''
+
+    true_path, prob_path = test_memmap_paths(output_dir, yaml_file_name)
+    y_true = np.lib.format.open_memmap(true_path, mode='w+', dtype=np.int8, shape=(num_records, num_classes))
+    y_prob = np.lib.format.open_memmap(prob_path, mode='w+', dtype=np.float32, shape=(num_records, num_classes))
+    return y_true, y_prob
+
+
+def load_test_memmaps(output_dir, yaml_file_name):
+    ''' Load the arrays saved in the chunked evaluation mode as read-only memory maps
+
+    :param output_dir: Directory of the prediction run
+    :type output_dir: str
+    :param yaml_file_name: Name of the yaml file used in the run
+    :type yaml_file_name: str
+
+    :return y_true, y_prob: Actual labels and predicted probabilities
+    :rtype: numpy.memmap, numpy.memmap
+    '''
+
+    true_path, prob_path = test_memmap_paths(output_dir, yaml_file_name)
+    return np.load(true_path, mmap_mode='r'), np.load(prob_path, mmap_mode='r')
+
+
+class PredictionWriter(object):
+    ''' Write the challenge predictions of whole batches in a background thread so that
+    the file I/O doesn't stall the model. The batches are written in the order they
+    were given.
+
+    :param write_fn: Function writing the prediction of one recording,
+                     called as `write_fn(filename, labels, scores)`
+    :type write_fn: function
+    :param max_pending: Number of batches which can wait for writing
+    :type max_pending: int
+    '''
+
+    def __init__(self, write_fn, max_pending=8):
+        self.write_fn = write_fn
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._write_loop, name='prediction-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, filenames, pred_labels, scores):
+        ''' Queue the predictions of a batch to be written
+
+        :param filenames: Paths of the ECG recordings
+        :type filenames: list
+        :param pred_labels: Binarized predictions, one row per recording
+        :type pred_labels: numpy.ndarray
+        :param scores: Predicted probabilities, one row per recording
+        :type scores: numpy.ndarray
+        '''
+        self._raise_error()
+        self.queue.put((filenames, pred_labels, scores))
+
+    def close(self):
+        ''' Wait until all the queued predictions are written and stop the writer thread
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+
+            try:
+                for filename, pred_label, scores in zip(*item):
+                    self.write_fn(filename, pred_label, scores)
+            except Exception as e:
+                self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('Writing the predictions failed') from self.error
+
+
+def write_challenge_prediction(filename, classes, labels, scores, pred_dir):
+    '''Save the challenge prediction of one recording in csv file with record id, 
+    diagnoses predicted and their confidence score as
+
+    #Record ID
+    164889003, 270492004, 164909002, 426783006, 59118001, 284470004,  164884008,
+    1,         1,         0,         0,         0,        0,          0,        
+    0.9,       0.6,       0.2,       0.05,      0.2,      0.35,       0.35,     
+    '''
+    
+    recording = os.path.basename(os.path.splitext(filename)[0])
+    new_file = os.path.basename(filename.replace('.mat','.csv'))
+    output_file = os.path.join(pred_dir, new_file)
+
+    # Include the filename as the recording number
+    recording_string = '#{}'.format(recording)
+    class_string = ','.join(classes)
+    label_string = ','.join(str(i) for i in labels)
+    score_string = ','.join(str(i) for i in scores)
+
+    # Write the output file
+    with open(output_file, 'w') as file:
+        file.write(recording_string + '\n' + class_string + '\n' + label_string + '\n' + score_string + '\n')
+
+
+def predictions_path(output_dir, yaml_file_name):
+    ''' Path of the single file where the predictions of a run are saved in the npz format
+    '''
+    return os.path.join(output_dir, yaml_file_name + '_predictions.npz')
+
+
+class ColumnarPredictionWriter(object):
+    ''' Write the predictions of a whole run into one uncompressed npz file instead of
+    one csv file per recording. The file holds the arrays `filenames`, `record_ids`,
+    `classes`, `pred_labels` (int8) and `scores` (float32), one row per recording,
+    and can be memory-mapped with `load_predictions`. The batches are written into
+    disk-backed arrays which are packed into the npz file in `close()`, so the memory
+    use doesn't grow with the number of recordings.
+
+    Has the same interface as `PredictionWriter`.
+
+    :param path: Absolute path for the npz file
+    :type path: str
+    :param filenames: Paths of all the ECG recordings in the order they are written
+    :type filenames: list
+    :param classes: Class labels used in the classification as SNOMED CT Codes
+    :type classes: list
+    '''
+
+    def __init__(self, path, filenames, classes):
+        self.path = path
+        self.tmp_dir = path + '.tmp'
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+        num_records, num_classes = len(filenames), len(classes)
+        np.save(os.path.join(self.tmp_dir, 'filenames.npy'), np.asarray(filenames, dtype=str))
+        np.save(os.path.join(self.tmp_dir, 'record_ids.npy'),
+                np.asarray([os.path.basename(os.path.splitext(f)[0]) for f in filenames], dtype=str))
+        np.save(os.path.join(self.tmp_dir, 'classes.npy'), np.asarray(classes, dtype=str))
+        self.pred_labels = np.lib.format.open_memmap(os.path.join(self.tmp_dir, 'pred_labels.npy'), mode='w+',
+                                                     dtype=np.int8, shape=(num_records, num_classes))
+        self.scores = np.lib.format.open_memmap(os.path.join(self.tmp_dir, 'scores.npy'), mode='w+',
+                                                dtype=np.float32, shape=(num_records, num_classes))
+        self.row = 0
+
+    def write(self, filenames, pred_labels, scores):
+        ''' Write the predictions of the next batch
+        '''
+        self.pred_labels[self.row:self.row + len(filenames)] = pred_labels
+        self.scores[self.row:self.row + len(filenames)] = scores
+        self.row += len(filenames)
+
+    def close(self):
+        ''' Pack the arrays into the npz file, the members are stored without compression
+        so that they can be memory-mapped
+        '''
+        self.pred_labels.flush()
+        self.scores.flush()
+        del self.pred_labels, self.scores
+
+        tmp_path = self.path + '.part'
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name in ['filenames', 'record_ids', 'classes', 'pred_labels', 'scores']:
+                archive.write(os.path.join(self.tmp_dir, name + '.npy'), name + '.npy')
+        os.replace(tmp_path, self.path)
+        shutil.rmtree(self.tmp_dir)
+
+
+def load_predictions(path):
+    ''' Load the arrays of a predictions file written by `ColumnarPredictionWriter` as
+    read-only memory maps, so that only the rows used are read from the disk
+
+    :param path: Absolute path for the npz file
+    :type path: str
+
+    :return arrays: Arrays of the file by their names
+    :rtype: dict
+    '''
+
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise Exception('{} in {} is compressed and can\'t be memory-mapped'.format(info.filename, path))
+
+            # The data of a member starts after its local header and the npy header
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', file.read(4))
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+
+            name = os.path.splitext(info.filename)[0]
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=file.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+
+def export_challenge_predictions(path, pred_dir, chunk_size=65536):
+    ''' Expand a predictions file into the per-recording csv files of the challenge format
+
+    :param path: Absolute path for the npz file
+    :type path: str
+    :param pred_dir: Directory for the csv files
+    :type pred_dir: str
+    :param chunk_size: Number of recordings read from the file at a time
+    :type chunk_size: int
+    '''
+
+    arrays = load_predictions(path)
+    classes = arrays['classes'].tolist()
+    os.makedirs(pred_dir, exist_ok=True)
+
+    for start in range(0, len(arrays['filenames']), chunk_size):
+        filenames = arrays['filenames'][start:start + chunk_size].tolist()
+        pred_labels = np.asarray(arrays['pred_labels'][start:start + chunk_size])
+        scores = np.asarray(arrays['scores'][start:start + chunk_size])
+        for filename, labels, recording_scores in zip(filenames, pred_labels, scores):
+            write_challenge_prediction(filename, classes, labels, recording_scores, pred_dir)
@@ -4,22 +4,111 @@ import time
 import torch
 from torch import nn
 import pandas as pd
-from torch.utils.data import DataLoader
-from .models.seresnet18 import resnet18
-from ..dataloader.dataset import ECGDataset, get_transforms
-from .metrics import cal_multilabel_metrics, roc_curves
+from torch.utils.data import DataLoader, Subset
+from ..dataloader.dataset import ECGDataset, get_transforms, get_tta_transforms, collate_by_length
+from .metrics import cal_multilabel_metrics, roc_curves, plot_roc_curves, binarize_predictions, to_numpy
+from .streaming_metrics import ChunkedMetrics
+from .model_utils import autocast, compile_model, optimize_for_inference, build_model, load_architecture
+from .profiling_utils import ProfilerController
+from .quantization_utils import quantized_model_path, quantize_dynamic_model, quantize_static_model, save_quantized_model, load_quantized_model
+from .output_utils import test_outputs_path, save_test_outputs, load_test_outputs, open_test_memmaps, load_test_memmaps, PredictionWriter, predictions_path, ColumnarPredictionWriter, write_challenge_prediction
+from .cascade_utils import early_exit_index, load_cascade
+from .tensor_file_utils import build_mmap_model
+from .cache_utils import PredictionCache, hash_prediction_config, record_key
 import pickle
 
 class Predicting(object):
     def __init__(self, args):
         self.args = args
+
+        # Recordings predicted at a time and the number of the DataLoader workers
+        self.batch_size = getattr(self.args, 'batch_size', 1)
+        self.num_workers = getattr(self.args, 'num_workers', 0)
+
+        # Challenge predictions as one csv file per recording ('csv') or one file per run ('npz')
+        self.prediction_format = getattr(self.args, 'prediction_format', 'csv')
+        if self.prediction_format not in ['csv', 'npz']:
+            raise NameError('This prediction format is not included! Use csv or npz')
+
+        # Chunked evaluation streams the predictions to the disk instead of keeping them in memory
+        self.chunked = getattr(self.args, 'chunked_evaluation', False)
+        self.chunk_size = getattr(self.args, 'chunk_size', 65536)
+
+        # Precision of the forward pass, the probabilities and the metrics are always in fp32
+        self.precision = getattr(self.args, 'precision', 'fp32')
+
+        # Folding the batch normalizations into the convolutions and removing the dropouts
+        self.optimize = getattr(self.args, 'optimize_for_inference', False)
+
+        # Memory-mapping the weights from a flat tensor file next to the trained model, so the
+        # processes predicting with the same model share one copy of the weights
+        self.mmap_weights = getattr(self.args, 'mmap_weights', False)
+
+        # Compiling the model ('eager', 'inductor' or 'torchscript') and the cache of the compiled graphs
+        self.compile = getattr(self.args, 'compile', 'eager')
+        self.compile_cache_dir = getattr(self.args, 'compile_cache_dir', os.path.join(os.getcwd(), 'experiments', 'compile_cache'))
+
+        # Sliding-window inference: the recordings longer than a window are split into overlapping
+        # windows which are run in batches of at most `window_batch_size` windows, and the
+        # probabilities of the windows are aggregated ('max' or 'mean') per recording
+        self.windowed = getattr(self.args, 'windowed_inference', False)
+        self.window_size = getattr(self.args, 'window_size', 4096)
+        self.window_stride = getattr(self.args, 'window_stride', self.window_size // 2)
+        self.window_aggregation = getattr(self.args, 'window_aggregation', 'max')
+        self.window_batch_size = getattr(self.args, 'window_batch_size', 32)
+        if self.window_aggregation not in ['max', 'mean']:
+            raise NameError('This window aggregation is not included! Use max or mean')
+
+        # Test-time augmentation: each recording is predicted as `tta_k` views, the recording
+        # itself and its copies augmented with the `tta_views` in turn, and the probabilities averaged
+        self.tta_k = getattr(self.args, 'tta_k', 1)
+        self.tta_views = getattr(self.args, 'tta_views', ['clip', 'flipy', 'roll'])
+
+        # Metrics of each model of an ensemble
+        self.member_metrics = None
+
+        # Early-exit cascade: the recordings whose early exit probability from the first layers
+        # reaches the threshold calibrated in the training (or `cascade_threshold`) are predicted
+        # as normal sinus rhythm only, with `cascade_exit_score` for the other labels, and the
+        # other recordings go through the whole model
+        self.cascade = getattr(self.args, 'cascade', False)
+        self.cascade_threshold = getattr(self.args, 'cascade_threshold', None)
+        self.cascade_exit_score = getattr(self.args, 'cascade_exit_score', 0.0)
+        self.cascade_exits = 0
+        self.cascade_records = 0
+
+        # Persistent cache of the probabilities by the model, the transforms and options, and
+        # the recording: the cached recordings are neither loaded nor run through the model
+        self.cache_path = getattr(self.args, 'prediction_cache', None)
+        self.cache_size_mb = getattr(self.args, 'prediction_cache_size_mb', 1024)
+        self.cache = None
+        self.cached_probs = {}
+
+        # Only the raw outputs are saved, without the challenge predictions and the metrics,
+        # e.g. by the shards of a sharded prediction which are evaluated together afterwards
+        self.outputs_only = getattr(self.args, 'outputs_only', False)
+        if self.outputs_only and self.chunked:
+            raise Exception('The outputs are saved as one array file with outputs_only, use chunked_evaluation: false')
+
+        # Int8 quantization of the model ('none', 'dynamic' or 'static'), only on CPU
+        self.quantize = getattr(self.args, 'quantize', 'none')
+        if self.quantize != 'none' and self.compile != 'eager':
+            raise Exception('A quantized model can\'t be compiled, use compile: eager')
+        if self.quantize != 'none' and self.cascade:
+            raise Exception('The early-exit cascade can\'t be run on a quantized model, use quantize: none')
+        if self.cascade_threshold is not None and not 0.5 <= self.cascade_threshold <= 1:
+            # Below 0.5 the exiting recordings would be predicted positive for all the other labels
+            raise Exception('The cascade threshold has to be between 0.5 and 1')
+        if not 0 <= self.cascade_exit_score < getattr(self.args, 'threshold', 0.5):
+            # The exiting recordings are never predicted positive for the other labels
+            raise Exception('The cascade exit score has to be between 0 and the threshold')
     
     def setup(self):
         ''' Initializing the device conditions and dataloader,
         loading trained model
         '''
-        # Consider the GPU or CPU condition
-        if torch.cuda.is_available():
+        # Consider the GPU or CPU condition, the quantized models run only on CPU
+        if torch.cuda.is_available() and self.quantize == 'none':
             self.device = torch.device("cuda")
             self.device_count = self.args.device_count
             print('using {} gpu(s)'.format(self.device_count))
@@ -33,105 +122,555 @@ class Predicting(object):
         filenames = pd.read_csv(self.args.test_path, usecols=['path']).values.tolist()
         self.filenames = [f for file in filenames for f in file]
 
-        # Load the test data
+        # Load the test data, the recordings of a batch are grouped by their length
+        # and the order of the recordings is kept so that they match the filenames
         testing_set = ECGDataset(self.args.test_path, 
-                                 get_transforms('test'))
+                                 get_tta_transforms(self.tta_views, self.tta_k) if self.tta_k > 1 else get_transforms('test'))
         channels = testing_set.channels
+        self.model_paths = getattr(self.args, 'model_paths', [self.args.model_path])
+
+        # Exit thresholds of the models, calibrated in the training of each model
+        if self.cascade:
+            self.normal_index = early_exit_index(self.args.labels)
+            self.exit_thresholds = [load_cascade(model_path)['threshold'] if self.cascade_threshold is None else self.cascade_threshold
+                                    for model_path in self.model_paths]
+
+        # With the prediction cache only the recordings which aren't cached are loaded,
+        # in batches of the recordings missing from each batch of the test data
+        batch_sampler = None
+        if self.cache_path is not None:
+            batch_sampler = self.cache_lookup(testing_set)
         self.test_dl = DataLoader(testing_set,
-                                  batch_size=1,
+                                  batch_size=self.batch_size if batch_sampler is None else 1,
                                   shuffle=False,
+                                  batch_sampler=batch_sampler,
+                                  num_workers=self.num_workers,
+                                  collate_fn=collate_by_length,
                                   pin_memory=(True if self.device == 'cuda' else False),
-                                  drop_last=True)
+                                  drop_last=False)
+        
+        self.sigmoid = nn.Sigmoid()
+        self.sigmoid.to(self.device)
+
+        # Load the trained model, or all the models of an ensemble (e.g. the models of the
+        # cross-validation folds) which then predict each batch of the test data together.
+        # The models aren't loaded at all if all the recordings are in the prediction cache.
+        self.models = [] if batch_sampler == [] else [self.load_model(model_path, channels) for model_path in self.model_paths]
+        self.model = self.models[0] if self.models else None
+        if self.cascade:
+            self.cascade_thresholds = {id(model): threshold for model, threshold in zip(self.models, self.exit_thresholds)}
+
+    def cache_lookup(self, testing_set):
+        ''' Open the prediction cache, compute the cache keys of the test recordings for each
+        model and find the recordings whose probabilities of all the models are cached
         
-        # Load the trained model
-        self.model = resnet18(in_channel=channels,
-                         out_channel=len(self.args.labels))
+        :param testing_set: Test data
+        :type testing_set: ECGDataset
+        
+        :return batch_sampler: Indexes of the recordings which aren't cached in each batch of
+                               the test data, the batches without any are left out
+        :rtype: list
+        '''
+
+        self.cache = PredictionCache(self.cache_path, self.cache_size_mb)
+
+        # Everything besides the model and the recording which changes the probabilities:
+        # the options, the calibration of the static quantization and the exit threshold of each model
+        options = dict(labels=list(self.args.labels),
+                       precision=self.precision,
+                       compile=self.compile,
+                       optimize_for_inference=self.optimize,
+                       quantize=self.quantize,
+                       windowed_inference=self.windowed,
+                       window=[self.window_size, self.window_stride, self.window_aggregation] if self.windowed else None)
+        if self.quantize == 'static':
+            options['calibration'] = [getattr(self.args, 'calibration_file', None), getattr(self.args, 'calibration_samples', 100)]
+        if self.cascade:
+            options['cascade_exit_score'] = self.cascade_exit_score
+        exit_thresholds = self.exit_thresholds if self.cascade else [None] * len(self.model_paths)
+        config_hashes = [hash_prediction_config(testing_set.transforms, cascade=self.cascade, exit_threshold=threshold, **options)
+                         for threshold in exit_thresholds]
+
+        model_hashes = [self.cache.file_digest(model_path) for model_path in self.model_paths]
+        record_hashes = [self.cache.file_digest(path) for path in testing_set.data]
+        self.cache_keys = [[record_key(model_hash, config_hash, record_hash, age, gender)
+                            for record_hash, age, gender in zip(record_hashes, testing_set.age, testing_set.gender)]
+                           for model_hash, config_hash in zip(model_hashes, config_hashes)]
+
+        cached = self.cache.get_many(key for keys in self.cache_keys for key in keys)
+        self.cached_probs = {i: np.stack([cached[keys[i]] for keys in self.cache_keys])
+                             for i in range(len(testing_set))
+                             if all(keys[i] in cached for keys in self.cache_keys)}
+        print('{} of {} recordings found in the prediction cache {}'.format(len(self.cached_probs), len(testing_set), self.cache.path))
+
+        self.test_batches = [list(range(start, min(start + self.batch_size, len(testing_set))))
+                             for start in range(0, len(testing_set), self.batch_size)]
+        batch_sampler = [[i for i in batch if i not in self.cached_probs] for batch in self.test_batches]
+        return [batch for batch in batch_sampler if batch]
+
+    def iterate_batches(self):
+        ''' Batches of the test data in the order of the csv file as the indexes of the
+        recordings, the positions of the recordings which aren't cached in the batch and the
+        groups of those recordings from the DataLoader
+        '''
+        if self.cache is None:
+            row = 0
+            for groups in self.test_dl:
+                batch_size = max(int(group[0].max()) for group in groups) + 1
+                indexes = list(range(row, row + batch_size))
+                yield indexes, torch.arange(batch_size), groups
+                row += batch_size
+            return
+
+        loader = iter(self.test_dl)
+        for indexes in self.test_batches:
+            missing = [position for position, i in enumerate(indexes) if i not in self.cached_probs]
+            yield indexes, torch.tensor(missing, dtype=torch.long), next(loader) if missing else []
+
+    def load_model(self, model_path, channels):
+        ''' Load a trained model and prepare it for the prediction
+        
+        :param model_path: Absolute path for the trained model
+        :type model_path: str
+        :param channels: Number of the leads
+        :type channels: int
+        
+        :return model: The model optimized, quantized and compiled as set in the yaml file
+        :rtype: torch.nn.Module
+        '''
+
+        # The architecture is read from the metadata saved with the model
+        if self.mmap_weights and self.device.type == 'cpu':
+            model = build_mmap_model(load_architecture(model_path), model_path, channels, len(self.args.labels))
+        else:
+            model = build_model(load_architecture(model_path),
+                                in_channel=channels,
+                                out_channel=len(self.args.labels))
 
         # Consider the GPU or CPU condition
-        if torch.cuda.is_available():
+        if self.device.type == 'cuda':
             if self.device_count > 1:
-                self.model = torch.nn.DataParallel(self.model)
-                self.model.module.load_state_dict(torch.load(self.args.model_path))
+                model = torch.nn.DataParallel(model)
+                model.module.load_state_dict(torch.load(model_path))
+        elif not self.mmap_weights:
+            model.load_state_dict(torch.load(model_path, map_location=self.device))
+
+        model.to(self.device)
+        if self.optimize:
+            model = optimize_for_inference(model)
+        if self.quantize != 'none':
+            model = self.quantized_model(model, model_path)
+        return compile_model(model, self.compile, self.compile_cache_dir)
+
+    def quantized_model(self, model, model_path):
+        ''' Load the quantized model saved next to the trained model, or quantize the trained
+        model and save it if there's no quantized model or it's older than the trained model.
+        The static quantization is calibrated on `calibration_samples` random recordings of
+        `calibration_file`, e.g. the validation split. The quantized model is saved for each
+        combination of these and `optimize_for_inference`, which all change the model.
+        
+        :param model: Trained float model
+        :type model: torch.nn.Module
+        :param model_path: Absolute path for the trained model
+        :type model_path: str
+        
+        :return: The quantized model
+        :rtype: torch.jit.ScriptModule
+        '''
+
+        settings = {'optimize_for_inference': self.optimize}
+        if self.quantize == 'static':
+            settings.update(calibration_file=getattr(self.args, 'calibration_file', None),
+                            calibration_samples=getattr(self.args, 'calibration_samples', 100))
+        quantized_path = quantized_model_path(model_path, self.quantize, settings)
+        if os.path.exists(quantized_path) and os.path.getmtime(quantized_path) >= os.path.getmtime(model_path):
+            print('Loading the quantized model from', quantized_path)
+            return load_quantized_model(quantized_path)
+
+        if self.quantize == 'dynamic':
+            model = quantize_dynamic_model(model)
+        elif self.quantize == 'static':
+            if not hasattr(self.args, 'calibration_file'):
+                raise Exception('Static quantization needs a calibration_file, e.g. the validation csv file.')
+            calibration_path = os.path.join(os.path.dirname(self.args.test_path), self.args.calibration_file)
+            calibration_set = ECGDataset(calibration_path, get_transforms('val'))
+            num_samples = min(getattr(self.args, 'calibration_samples', 100), len(calibration_set))
+            indices = np.random.RandomState(123).choice(len(calibration_set), num_samples, replace=False)
+            calibration_dl = DataLoader(Subset(calibration_set, indices), batch_size=1, shuffle=False)
+
+            print('Calibrating the quantized model on {} recordings of {}...'.format(num_samples, calibration_path))
+            model = quantize_static_model(model, calibration_dl)
         else:
-            self.model.load_state_dict(torch.load(self.args.model_path, map_location=self.device))
+            raise NameError('This quantization mode is not included! Use none, dynamic or static')
 
-        self.sigmoid = nn.Sigmoid()
-        self.sigmoid.to(self.device)
-        self.model.to(self.device)
+        save_quantized_model(model, quantized_path)
+        print('Saved the quantized model to', quantized_path)
+        return load_quantized_model(quantized_path)
         
     def predict(self):
         ''' Make predictions
         '''
-        print('predict() called: model={}, device={}'.format(
-              type(self.model).__name__,
-              self.device))
-
-        # Saving the history
-        history = {}
-        history['test_micro_avg_prec'] = 0.0
-        history['test_micro_auroc'] = 0.0
-        history['test_macro_avg_prec'] = 0.0
-        history['test_macro_auroc'] = 0.0
-        history['test_challenge_metric'] = 0.0
-        
-        history['labels'] = self.args.labels
-        history['test_csv'] = self.args.test_path
-        history['threshold'] = self.args.threshold
+        print('predict() called: model={} x {}, device={}, precision={}, compile={}, quantize={}'.format(
+              type(self.model).__name__ if self.models else 'cached',
+              len(self.model_paths),
+              self.device,
+              self.precision,
+              self.compile,
+              self.quantize))
         
         start_time_sec = time.time()
  
         # --- EVALUATE ON TESTING SET ------------------------------------- 
-        self.model.eval()
+        for model in self.models:
+            model.eval()
         labels_all = torch.tensor((), device=self.device)
         logits_prob_all = torch.tensor((), device=self.device)  
+
+        # Profiler capture windows over the prediction steps, no-op if there's no profiling section
+        profiler = ProfilerController(getattr(self.args, 'profiling', None),
+                                      os.path.join(self.args.output_dir, 'profiling'),
+                                      self.args.yaml_file_name + '_predict',
+                                      self.device)
+
+        # The challenge predictions are written in a background thread or into one file
+        writer = self.prediction_writer()
+        num_records = len(self.test_dl.dataset)
+        row = 0
+
+        if self.chunked:
+            # Disk-backed arrays for the outputs and incrementally computed metrics
+            y_true_mm, y_prob_mm = open_test_memmaps(self.args.output_dir, self.args.yaml_file_name,
+                                                     num_records, len(self.args.labels))
+            chunked_metrics = ChunkedMetrics(self.args.labels, self.args.threshold,
+                                             work_dir=self.args.output_dir, chunk_size=self.chunk_size)
+
+        # The probabilities of each model of an ensemble for their own metrics
+        ensemble = len(self.model_paths) > 1
+        if ensemble:
+            member_probs_all = [[] for _ in self.model_paths]
+            if self.chunked:
+                member_metrics = [ChunkedMetrics(self.args.labels, self.args.threshold,
+                                                 work_dir=self.args.output_dir, chunk_size=self.chunk_size)
+                                  for _ in self.model_paths]
         
-        for i, (ecgs, ag, labels) in enumerate(self.test_dl):
-            ecgs = ecgs.to(self.device) # ECGs
-            ag = ag.to(self.device) # age and gender
-            labels = labels.to(self.device) # diagnoses in SMONED CT codes 
+        for i, (indexes, missing, groups) in enumerate(self.iterate_batches()):
+            batch_size = len(indexes)
+            labels = torch.empty((batch_size, len(self.args.labels)), device=self.device)
+            member_prob = torch.zeros((len(self.model_paths), batch_size, len(self.args.labels)), device=self.device)
+
+            # Each group of equal-length recordings is run through the model at once
+            for positions, ecgs, ag, group_labels in groups:
+                ecgs = ecgs.to(self.device) # ECGs
+                ag = ag.to(self.device) # age and gender
+                positions = missing[positions].to(self.device) # positions in the batch
+
+                with torch.set_grad_enabled(False):  
+                    
+                    # The models of an ensemble are run on the same batch, their probabilities are averaged
+                    for k, model in enumerate(self.models):
+                        member_prob[k].index_add_(0, positions, self.predict_probabilities(model, ecgs, ag))
+                    labels[positions] = group_labels.to(self.device) # diagnoses in SMONED CT codes 
 
-            with torch.set_grad_enabled(False):  
-                
-                logits = self.model(ecgs, ag)
-                logits_prob = self.sigmoid(logits)
+            member_prob /= self.tta_k
+            if self.cache is not None:
+                self.update_cache(indexes, missing, labels, member_prob)
+
+            # Mean over the models and the test-time augmentation views
+            logits_prob = member_prob.mean(0)
+
+            if self.chunked:
+                y_true_mm[row:row+batch_size] = to_numpy(labels)
+                y_prob_mm[row:row+batch_size] = to_numpy(logits_prob)
+                chunked_metrics.update(labels, logits_prob)
+            else:
                 labels_all = torch.cat((labels_all, labels), 0)
                 logits_prob_all = torch.cat((logits_prob_all, logits_prob), 0)
 
-           
-            # ------ One-hot-encode predicted label -----------
-            # Define an empty label for predictions
-            pred_label = np.zeros(len(self.args.labels))
-
-            # Find the maximum values within the probabilities
-            _, likeliest_dx = torch.max(logits_prob, 1)
+            if ensemble:
+                for k in range(len(self.model_paths)):
+                    if self.chunked:
+                        member_metrics[k].update(labels, member_prob[k])
+                    else:
+                        member_probs_all[k].append(to_numpy(member_prob[k]))
 
             # Predicted probabilities from tensor to numpy
-            likeliest_dx = likeliest_dx.cpu().detach().numpy()
+            scores = logits_prob.cpu().detach().numpy()
 
-            # First, add the most likeliest diagnosis to the predicted label
-            pred_label[likeliest_dx] = 1
+            # One-hot-encode predicted labels of the whole batch
+            pred_labels = binarize_predictions(scores, self.args.threshold)
+            
+            # Save the predictions
+            writer.write(self.filenames[row:row+batch_size], pred_labels, scores)
+            row += batch_size
 
-            # Then, add all the others that are above the decision threshold
-            other_dx = logits_prob.cpu().detach().numpy() >= self.args.threshold
-            pred_label = pred_label + other_dx
-            pred_label[pred_label > 1.1] = 1
-            pred_label = np.squeeze(pred_label)
+            if i % max(1, 1000 // self.batch_size) == 0:
+                print('{:<4}/{:>4} predictions made'.format(row, num_records))
 
-            # --------------------------------------------------
-            
-            # Save also probabilities but return them first in numpy
-            scores = logits_prob.cpu().detach().numpy()
-            scores = np.squeeze(scores)
+            profiler.step()
+
+        profiler.close()
+        writer.close()
+
+        if self.cache is not None:
+            self.cache.evict()
+            self.cache.report()
+
+        if ensemble:
+            if self.chunked:
+                metrics = [metrics.compute() for metrics in member_metrics]
+            else:
+                metrics = [cal_multilabel_metrics(labels_all, np.concatenate(probs), self.args.labels, self.args.threshold)
+                           for probs in member_probs_all]
+            self.member_metrics = self.member_metrics_table(metrics)
+
+        if self.chunked:
+            y_true_mm.flush()
+            y_prob_mm.flush()
+            del y_true_mm, y_prob_mm
+            history = self.evaluate_chunked(chunked_metrics)
+        else:
+            # Save the raw probabilities so that the metrics can be recomputed without the model
+            save_test_outputs(test_outputs_path(self.args.output_dir, self.args.yaml_file_name),
+                              self.filenames[:len(labels_all)],
+                              self.args.labels,
+                              to_numpy(labels_all),
+                              to_numpy(logits_prob_all))
+
+            history = {} if self.outputs_only else self.evaluate(labels_all, logits_prob_all)
             
-            # Save the prediction
-            self.save_predictions(self.filenames[i], pred_label, scores, self.args.pred_save_dir)
+        torch.cuda.empty_cache()
+        
+        end_time_sec = time.time()
+        total_time_sec = end_time_sec - start_time_sec
+        records_per_sec = len(self.test_dl.dataset) / total_time_sec
+        print()
+        print('Time total:     %5.2f sec' % (total_time_sec))
+        print('Throughput:     %5.2f records/sec' % (records_per_sec))
+
+        history['test_time_sec'] = total_time_sec
+        history['test_records_per_sec'] = records_per_sec
+        if self.cascade:
+            print('Early exits:    %5.2f %%' % (100 * self.cascade_exits / max(self.cascade_records, 1)))
+
+        return history
+
+    def update_cache(self, indexes, missing, labels, member_prob):
+        ''' Fill the cached recordings of a batch with their probabilities and labels, and
+        add the probabilities of the predicted recordings into the cache
+        '''
+        missing_set = set(missing.tolist())
+        for position, i in enumerate(indexes):
+            if position not in missing_set:
+                member_prob[:, position] = torch.from_numpy(self.cached_probs[i]).to(self.device)
+                labels[position] = torch.from_numpy(self.test_dl.dataset.multi_labels[i]).float().to(self.device)
+
+        probs = to_numpy(member_prob)
+        self.cache.put_many([(keys[indexes[position]], probs[k, position])
+                             for k, keys in enumerate(self.cache_keys) for position in missing_set])
+
+    def window_starts(self, length):
+        ''' Start indexes of the windows of a recording. The windows are `window_stride` apart
+        and the last window ends at the end of the recording, so every sample is covered.
+        '''
+        starts = list(range(0, length - self.window_size + 1, self.window_stride))
+        if starts[-1] + self.window_size < length:
+            starts.append(length - self.window_size)
+        return starts
+
+    def predict_probabilities(self, model, ecgs, ag):
+        ''' Probabilities of a model for equal-length recordings, with sliding windows
+        if the recordings are longer than a window in the windowed inference
+        '''
+        if self.windowed and ecgs.size(-1) > self.window_size:
+            return self.predict_windows(model, ecgs, ag)
+        if self.cascade:
+            return self.predict_cascade(model, ecgs, ag)
+        with autocast(self.device, self.precision):
+            logits = model(ecgs, ag)
+        return self.sigmoid(logits.float())
+
+    def predict_cascade(self, model, ecgs, ag):
+        ''' Predict equal-length recordings with the early exit. The first layers of the model
+        are run on all the recordings, and only the recordings which don't exit are run through
+        the rest of the model. An exiting recording gets the exit probability for the normal
+        sinus rhythm and `cascade_exit_score` (by default 0) for the other labels.
+        
+        :param model: Trained model with an early exit head
+        :type model: torch.nn.Module
+        :param ecgs: ECG recordings
+        :type ecgs: torch.Tensor
+        :param ag: Age and gender of the recordings
+        :type ag: torch.Tensor
+        
+        :return logits_prob: Probabilities of the recordings
+        :rtype: torch.Tensor
+        '''
+
+        network = getattr(model, 'module', model)
+        with autocast(self.device, self.precision):
+            features = network.features(ecgs)
+            exit_prob = self.sigmoid(network.exit_logits(features, ag).float()).squeeze(1)
+        exits = exit_prob >= self.cascade_thresholds[id(model)]
+
+        logits_prob = torch.full((ecgs.size(0), len(self.args.labels)), self.cascade_exit_score, device=exit_prob.device)
+        logits_prob[:, self.normal_index] = exit_prob
+        if not exits.all():
+            with autocast(self.device, self.precision):
+                logits = network.classify(features[~exits], ag[~exits])
+            logits_prob[~exits] = self.sigmoid(logits.float())
+
+        self.cascade_exits += int(exits.sum())
+        self.cascade_records += ecgs.size(0)
+        return logits_prob
+
+    def predict_windows(self, model, ecgs, ag):
+        ''' Predict equal-length recordings which are longer than a window with sliding windows.
+        The windows are sliced from the recordings only when their batch is run, so the memory
+        used by the model is bounded by `window_batch_size` and not by the length of the recordings.
+        
+        :param model: Trained model
+        :type model: torch.nn.Module
+        :param ecgs: ECG recordings
+        :type ecgs: torch.Tensor
+        :param ag: Age and gender of the recordings
+        :type ag: torch.Tensor
+        
+        :return logits_prob: Aggregated probabilities of the windows per recording
+        :rtype: torch.Tensor
+        '''
+
+        # Windows as pairs of a recording and a start index
+        windows = [(i, start) for i in range(ecgs.size(0)) for start in self.window_starts(ecgs.size(-1))]
+        num_windows = torch.zeros(ecgs.size(0), 1, device=self.device)
+        logits_prob = None
+
+        for batch_start in range(0, len(windows), self.window_batch_size):
+            batch = windows[batch_start:batch_start + self.window_batch_size]
+            records = torch.tensor([i for i, _ in batch], device=self.device)
+            window_ecgs = torch.stack([ecgs[i, :, start:start + self.window_size] for i, start in batch])
+
+            with autocast(self.device, self.precision):
+                logits = model(window_ecgs, ag[records])
+            window_prob = self.sigmoid(logits.float())
+
+            # The probabilities aren't negative so zeros are neutral for both aggregations
+            if logits_prob is None:
+                logits_prob = torch.zeros(ecgs.size(0), window_prob.size(1), device=self.device)
+            if self.window_aggregation == 'max':
+                logits_prob.scatter_reduce_(0, records[:, None].expand_as(window_prob), window_prob, 'amax')
+            else:
+                logits_prob.index_add_(0, records, window_prob)
+                num_windows.index_add_(0, records, torch.ones(len(batch), 1, device=self.device))
+
+        if self.window_aggregation == 'mean':
+            logits_prob = logits_prob / num_windows
+        return logits_prob
 
-            if i % 1000 == 0:
-                print('{:<4}/{:>4} predictions made'.format(i+1, len(self.test_dl)))
+    def member_metrics_table(self, metrics):
+        ''' Table of the metrics of each model of an ensemble, saved next to the testing history
+        
+        :param metrics: Metrics of each model as returned by `cal_multilabel_metrics`
+        :type metrics: list
+        
+        :return table: The metrics of each model
+        :rtype: pandas.DataFrame
+        '''
+
+        columns = ['test_macro_avg_prec', 'test_micro_avg_prec', 'test_macro_auroc', 'test_micro_auroc', 'test_challenge_metric']
+        table = pd.DataFrame([dict(zip(columns, model_metrics)) for model_metrics in metrics],
+                             index=pd.Index([os.path.basename(path) for path in self.model_paths], name='model'))
+        table.to_csv(os.path.join(self.args.output_dir, self.args.yaml_file_name + '_member_metrics.csv'))
+
+        print('\nMetrics of the models of the ensemble\n' + '-'*10)
+        print(table.to_string(float_format=lambda x: '{:.4f}'.format(x)))
+        print('-'*10)
+        return table
+
+    def evaluate(self, labels_all, logits_prob_all):
+        ''' Compute the metrics and ROC curves for the predictions and save the testing history
+        
+        :param labels_all: Actual class labels
+        :type labels_all: torch.Tensor or numpy.ndarray
+        :param logits_prob_all: Predicted probabilities
+        :type logits_prob_all: torch.Tensor or numpy.ndarray
+        
+        :return history: Testing history
+        :rtype: dict
+        '''
+
+        # Predicting metrics
+        test_metrics = cal_multilabel_metrics(labels_all, logits_prob_all, self.args.labels, self.args.threshold)
+        
+        # Draw ROC curve for predictions
+        roc_curves(labels_all, logits_prob_all, self.args.labels, save_path = self.args.output_dir)
+        
+        return self.save_history(test_metrics)
+
+    def evaluate_chunked(self, chunked_metrics):
+        ''' Compute the metrics and ROC curves from the incrementally accumulated
+        predictions and save the testing history
+        
+        :param chunked_metrics: Predictions of the whole test set
+        :type chunked_metrics: streaming_metrics.ChunkedMetrics
+        
+        :return history: Testing history
+        :rtype: dict
+        '''
 
         # Predicting metrics
-        test_macro_avg_prec, test_micro_avg_prec, test_macro_auroc, test_micro_auroc, test_challenge_metric = cal_multilabel_metrics(labels_all, logits_prob_all, self.args.labels, self.args.threshold)
-       
+        test_metrics = chunked_metrics.compute()
+
+        # Draw ROC curve for predictions
+        plot_roc_curves(chunked_metrics.fpr, chunked_metrics.tpr, chunked_metrics.roc_auc,
+                        chunked_metrics.cls_labels, save_path = self.args.output_dir)
+
+        # Per-class counts with the binarized predictions
+        class_counts = pd.DataFrame(chunked_metrics.class_counts, index=self.args.labels)
+
+        return self.save_history(test_metrics, class_counts)
+
+    def save_history(self, test_metrics, class_counts=None):
+        ''' Print the metrics and save the testing history
+        
+        :param test_metrics: Macro and micro average precision, macro and micro AUROC and the challenge metric
+        :type test_metrics: tuple
+        :param class_counts: Per-class counts of positives, tp, fp, fn and tn
+        :type class_counts: pandas.DataFrame
+        
+        :return history: Testing history
+        :rtype: dict
+        '''
+
+        test_macro_avg_prec, test_micro_avg_prec, test_macro_auroc, test_micro_auroc, test_challenge_metric = test_metrics
+
+        # Saving the history
+        history = {}
+        history['test_micro_avg_prec'] = 0.0
+        history['test_micro_auroc'] = 0.0
+        history['test_macro_avg_prec'] = 0.0
+        history['test_macro_auroc'] = 0.0
+        history['test_challenge_metric'] = 0.0
+        
+        history['labels'] = self.args.labels
+        history['test_csv'] = self.args.test_path
+        history['threshold'] = self.args.threshold
+        history['precision'] = self.precision
+        history['compile'] = self.compile
+        history['optimize_for_inference'] = self.optimize
+        history['quantize'] = self.quantize
+        history['windowed_inference'] = self.windowed
+        history['window_aggregation'] = self.window_aggregation
+        history['tta_k'] = self.tta_k
+        history['tta_views'] = self.tta_views if self.tta_k > 1 else []
+        history['cascade'] = self.cascade
+        if self.cascade and hasattr(self, 'exit_thresholds'):
+            history['cascade_thresholds'] = self.exit_thresholds
+            history['cascade_exit_rate'] = self.cascade_exits / max(self.cascade_records, 1)
+        history['models'] = [os.path.basename(path) for path in getattr(self.args, 'model_paths', [])]
+        if self.member_metrics is not None:
+            history['test_member_metrics'] = self.member_metrics
+        if self.cache is not None:
+            history['prediction_cache'] = self.cache.stats()
         
         print('macro avg prec: {:<6.2f} micro avg prec: {:<6.2f} macro auroc: {:<6.2f} micro auroc: {:<6.2f} challenge metric: {:<6.2f}'.format(
             test_macro_avg_prec,
@@ -140,30 +679,87 @@ class Predicting(object):
             test_micro_auroc,
             test_challenge_metric))
         
-        # Draw ROC curve for predictions
-        roc_curves(labels_all, logits_prob_all, self.args.labels, save_path = self.args.output_dir)
-        
         # Add information to testing history
         history['test_micro_auroc'] = test_micro_auroc
         history['test_micro_avg_prec'] = test_micro_avg_prec
         history['test_macro_auroc'] = test_macro_auroc
         history['test_macro_avg_prec'] = test_macro_avg_prec
         history['test_challenge_metric'] = test_challenge_metric
+        if class_counts is not None:
+            history['test_class_counts'] = class_counts
         
         # Save the history
         history_savepath = os.path.join(self.args.output_dir,
                                         self.args.yaml_file_name + '_test_history.pickle')
         with open(history_savepath, mode='wb') as file:
             pickle.dump(history, file, protocol=pickle.HIGHEST_PROTOCOL)
-            
-        torch.cuda.empty_cache()
+
+        return history
+
+    def evaluate_saved(self):
+        ''' Recompute the metrics, ROC curves and the challenge predictions from the
+        probabilities saved by an earlier `predict()` run. Neither the model nor
+        the ECG files are loaded, so e.g. a new decision threshold can be evaluated in seconds.
+        '''
         
+        print('evaluate_saved() called: output_dir={}'.format(self.args.output_dir))
+        start_time_sec = time.time()
+
+        if self.chunked:
+            # The actual labels and probabilities are read from the disk chunk by chunk
+            y_true, y_prob = load_test_memmaps(self.args.output_dir, self.args.yaml_file_name)
+            filenames = pd.read_csv(self.args.test_path, usecols=['path'])['path'].tolist()
+            chunked_metrics = ChunkedMetrics(self.args.labels, self.args.threshold,
+                                             work_dir=self.args.output_dir, chunk_size=self.chunk_size)
+        else:
+            outputs_path = test_outputs_path(self.args.output_dir, self.args.yaml_file_name)
+            assert os.path.exists(outputs_path), 'No saved predictions found from {}. Run the predictions first.'.format(outputs_path)
+            filenames, self.args.labels, y_true, y_prob = load_test_outputs(outputs_path)
+
+        # Rewrite the challenge predictions with the current decision threshold
+        writer = self.prediction_writer(filenames)
+        for start in range(0, len(y_prob), self.chunk_size):
+            y_true_chunk = np.asarray(y_true[start:start + self.chunk_size])
+            y_prob_chunk = np.asarray(y_prob[start:start + self.chunk_size])
+            pred_labels = binarize_predictions(y_prob_chunk, self.args.threshold)
+            writer.write(filenames[start:start + self.chunk_size], pred_labels, y_prob_chunk)
+
+            if self.chunked:
+                chunked_metrics.update(y_true_chunk, y_prob_chunk)
+        writer.close()
+
+        if self.chunked:
+            history = self.evaluate_chunked(chunked_metrics)
+        else:
+            history = self.evaluate(y_true, y_prob)
+
         end_time_sec = time.time()
         total_time_sec = end_time_sec - start_time_sec
         print()
         print('Time total:     %5.2f sec' % (total_time_sec))
 
- 
+        return history
+
+    def prediction_writer(self, filenames=None):
+        ''' Writer for the challenge predictions in the format of the yaml file: one csv file
+        per recording written in a background thread, or one npz file for the whole run
+        
+        :param filenames: Paths of all the ECG recordings, the test files by default
+        :type filenames: list
+        
+        :return: The writer
+        :rtype: output_utils.PredictionWriter or output_utils.ColumnarPredictionWriter
+        '''
+
+        if self.outputs_only:
+            return PredictionWriter(lambda filename, pred_label, scores: None)
+        if self.prediction_format == 'npz':
+            return ColumnarPredictionWriter(predictions_path(self.args.output_dir, self.args.yaml_file_name),
+                                            self.filenames if filenames is None else filenames,
+                                            self.args.labels)
+        return PredictionWriter(lambda filename, pred_label, scores: 
+                                self.save_predictions(filename, pred_label, scores, self.args.pred_save_dir))
+
     def save_predictions(self, filename, labels, scores, pred_dir):
         '''Save the challenge predictions in csv file with record id, 
         diagnoses predicted and their confidence score as
@@ -173,18 +769,5 @@ class Predicting(object):
         1,         1,         0,         0,         0,        0,          0,        
         0.9,       0.6,       0.2,       0.05,      0.2,      0.35,       0.35,     
         '''
-        
-        recording = os.path.basename(os.path.splitext(filename)[0])
-        new_file = os.path.basename(filename.replace('.mat','.csv'))
-        output_file = os.path.join(pred_dir, new_file)
-
-        # Include the filename as the recording number
-        recording_string = '#{}'.format(recording)
-        class_string = ','.join(self.args.labels)
-        label_string = ','.join(str(i) for i in labels)
-        score_string = ','.join(str(i) for i in scores)
-
-        # Write the output file
-        with open(output_file, 'w') as file:
-            file.write(recording_string + '\n' + class_string + '\n' + label_string + '\n' + score_string + '\n')
+        write_challenge_prediction(filename, self.args.labels, labels, scores, pred_dir)
            
\ No newline at end of file
@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import signal
+import numpy as np
+import pandas as pd
+import torch
+
+
+class StepTimer(object):
+    ''' Wall-clock timers for the phases of the training and validation steps.
+    `lap(phase)` records the time elapsed since the previous lap as the duration of
+    the given phase, so the phases of a step are timed back to back. The first lap of a
+    step, taken right after the DataLoader has returned a batch, is the time spent
+    waiting for the data.
+
+    When disabled, all the methods return immediately, so the timers can be left
+    in the training loop without a noticeable overhead.
+
+    :param enabled: Whether to record the timings
+    :type enabled: boolean
+    :param device: Device the model is run on, CUDA is synchronized before each lap
+    :type device: torch.device
+    '''
+
+    def __init__(self, enabled=False, device=None):
+        self.enabled = enabled
+        self.synchronize = enabled and device is not None and device.type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.samples = 0
+        self.start_time = None
+        self.last_time = None
+
+    def start(self):
+        ''' Start the timer, e.g. right before iterating a DataLoader
+        '''
+        if not self.enabled:
+            return
+        self.start_time = self.last_time = time.perf_counter()
+
+    def lap(self, phase):
+        ''' Record the time since the previous lap as the duration of the phase
+        '''
+        if not self.enabled:
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.timings.setdefault(phase, []).append(now - self.last_time)
+        self.last_time = now
+
+    def add(self, phase, seconds):
+        ''' Record durations measured elsewhere, e.g. in the DataLoader workers
+        '''
+        if not self.enabled:
+            return
+        self.timings.setdefault(phase, []).extend(np.atleast_1d(seconds).tolist())
+
+    def count(self, samples):
+        ''' Count the samples processed in a step
+        '''
+        if not self.enabled:
+            return
+        self.samples += samples
+
+    def summary(self):
+        ''' Summarize the timings of each phase
+
+        :return: Count, total, mean and percentiles of each phase (in milliseconds),
+                 and the throughput in samples per second
+        :rtype: list
+        '''
+
+        if not self.enabled or self.start_time is None:
+            return []
+
+        elapsed = self.last_time - self.start_time
+        rows = []
+        for phase, timings in self.timings.items():
+            timings = np.asarray(timings) * 1000
+            rows.append({
+                'phase': phase,
+                'count': len(timings),
+                'total_sec': timings.sum() / 1000,
+                'mean_ms': timings.mean(),
+                'p50_ms': np.percentile(timings, 50),
+                'p90_ms': np.percentile(timings, 90),
+                'p99_ms': np.percentile(timings, 99),
+                'share': timings.sum() / 1000 / elapsed if elapsed > 0 else 0.0
+            })
+
+        for row in rows:
+            row['elapsed_sec'] = elapsed
+            row['samples'] = self.samples
+            row['samples_per_sec'] = self.samples / elapsed if elapsed > 0 else 0.0
+        return rows
+
+
+def write_timing_report(path_prefix, epoch, timers):
+    ''' Append the timing summaries of an epoch into a json file and a csv file
+
+    :param path_prefix: Path for the reports without the file extension
+    :type path_prefix: str
+    :param epoch: Epoch of the timings
+    :type epoch: int
+    :param timers: Timers keyed by the name of the loop, e.g. 'train' and 'val'
+    :type timers: dict
+    '''
+
+    rows = []
+    for loop, timer in timers.items():
+        for row in timer.summary():
+            rows.append(dict(epoch=epoch, loop=loop, **row))
+    if not rows:
+        return
+
+    # Json file with the reports of all the epochs
+    json_path = path_prefix + '.json'
+    report = []
+    if os.path.exists(json_path):
+        with open(json_path, 'r') as file:
+            report = json.load(file)
+    report = [row for row in report if row['epoch'] != epoch] + rows
+    with open(json_path, 'w') as file:
+        json.dump(report, file, indent=1, default=float)
+
+    # Same as a csv file
+    pd.DataFrame(report).to_csv(path_prefix + '.csv', index=False)
+
+    # Short report of the epoch
+    for loop, timer in timers.items():
+        summary = timer.summary()
+        if not summary:
+            continue
+        print('{} timing: {:.2f} samples/sec | '.format(loop, summary[0]['samples_per_sec']) +
+              ', '.join('{} {:.0%} (p50 {:.1f} ms)'.format(row['phase'], row['share'], row['p50_ms']) for row in summary))
+
+
+class ProfilerController(object):
+    ''' Capture windows of `torch.profiler` around the steps of a loop. The profiler
+    follows a wait/warmup/active schedule which is repeated `repeat` times: the first
+    `wait` steps are skipped, the profiler is warmed up for `warmup` steps and the
+    next `active` steps are recorded. At the end of each active window a Chrome trace
+    (open in chrome://tracing or https://ui.perfetto.dev) and a table of the top
+    operators are exported.
+
+    A capture starts from the first step if `on_start` is true. A new capture can be
+    requested on a running job by sending the signal, e.g. `kill -USR1 <pid>`, and it
+    starts from the next step.
+
+    Options of the `profiling` section in the yaml file (all optional):
+
+        wait: 1                       # steps skipped before each window
+        warmup: 1                     # steps the profiler is warmed up
+        active: 3                     # steps recorded
+        repeat: 1                     # windows per capture
+        record_shapes: true           # record the input shapes of the operators
+        profile_memory: true          # record the memory allocations
+        with_stack: false             # record the Python call stacks
+        on_start: true                # capture from the first step
+        signal: SIGUSR1               # signal requesting a capture, null to disable
+        sort_by: self_cpu_time_total  # column the top operators are sorted by
+        row_limit: 30                 # number of the top operators
+
+    :param config: The `profiling` section of the yaml file, profiling is disabled if None
+    :type config: dict or utils.obj
+    :param output_dir: Directory for the traces and the tables
+    :type output_dir: str
+    :param prefix: Prefix of the files, e.g. the name of the yaml file and the loop
+    :type prefix: str
+    :param device: Device the model is run on, CUDA kernels are recorded if CUDA
+    :type device: torch.device
+    '''
+
+    def __init__(self, config, output_dir, prefix, device=None):
+        if config is not None and not isinstance(config, dict):
+            config = vars(config)
+        self.enabled = config is not None and config.get('enabled', True)
+        config = config or {}
+
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.wait = config.get('wait', 1)
+        self.warmup = config.get('warmup', 1)
+        self.active = config.get('active', 3)
+        self.repeat = config.get('repeat', 1)
+        self.record_shapes = config.get('record_shapes', True)
+        self.profile_memory = config.get('profile_memory', True)
+        self.with_stack = config.get('with_stack', False)
+        self.sort_by = config.get('sort_by', 'self_cpu_time_total')
+        self.row_limit = config.get('row_limit', 30)
+
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if device is not None and device.type == 'cuda':
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        self.profiler = None
+        self.steps = 0
+        self.captures = 0
+        self.requested = self.enabled and config.get('on_start', True)
+
+        # Signal handler requesting a new capture
+        self.signal = None
+        self.previous_handler = None
+        signal_name = config.get('signal', 'SIGUSR1')
+        if self.enabled and signal_name and hasattr(signal, signal_name):
+            try:
+                self.signal = getattr(signal, signal_name)
+                self.previous_handler = signal.signal(self.signal, self._request)
+            except ValueError:
+                # Signal handlers can be installed only in the main thread
+                self.signal = None
+
+        if self.requested:
+            self._start()
+
+    def _request(self, signum, frame):
+        self.requested = True
+
+    def step(self):
+        ''' Mark the end of a step, e.g. at the end of an iteration of the training loop
+        '''
+        if not self.enabled:
+            return
+
+        if self.profiler is not None:
+            self.profiler.step()
+            self.steps += 1
+            if self.steps >= (self.wait + self.warmup + self.active) * self.repeat:
+                self._stop()
+        elif self.requested:
+            self._start()
+
+    def close(self):
+        ''' Stop a running capture and restore the previous signal handler
+        '''
+        if self.profiler is not None:
+            self._stop()
+        if self.signal is not None:
+            signal.signal(self.signal, self.previous_handler)
+            self.signal = None
+
+    def _start(self):
+        self.requested = False
+        self.captures += 1
+        self.steps = 0
+        os.makedirs(self.output_dir, exist_ok=True)
+        print('Profiling {} steps ({} capture {})...'.format(self.active * self.repeat, self.prefix, self.captures))
+
+        self.profiler = torch.profiler.profile(
+            activities=self.activities,
+            schedule=torch.profiler.schedule(wait=self.wait, warmup=self.warmup,
+                                             active=self.active, repeat=self.repeat),
+            on_trace_ready=self._export,
+            record_shapes=self.record_shapes,
+            profile_memory=self.profile_memory,
+            with_stack=self.with_stack)
+        self.profiler.start()
+
+    def _stop(self):
+        self.profiler.stop()
+        self.profiler = None
+
+    def _export(self, profiler):
+        ''' Export the trace and the top operators of an active window
+        '''
+        path_prefix = os.path.join(self.output_dir, '{}_capture_{}_step_{}'.format(
+                                   self.prefix, self.captures, profiler.step_num))
+
+        profiler.export_chrome_trace(path_prefix + '_trace.json')
+
+        key_averages = profiler.key_averages(group_by_input_shape=self.record_shapes)
+        with open(path_prefix + '_top_ops.txt', 'w') as file:
+            file.write(key_averages.table(sort_by=self.sort_by, row_limit=self.row_limit))
+
+        print('Saved the profiler trace and the top operators to', path_prefix + '_*')
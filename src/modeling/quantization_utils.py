@@ -0,0 +1,90 @@
+import os
+import copy
+import json
+import hashlib
+import tempfile
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+# Supported int8 quantization modes
+QUANTIZATION_MODES = ['none', 'dynamic', 'static']
+
+# Linear layers quantized in the dynamic mode: the classifier and the age and gender layer
+DYNAMIC_LAYERS = {'fc', 'fc1'}
+
+
+def quantized_model_path(model_path, mode, settings=None):
+    ''' Absolute path for the quantized model, saved next to the float model. The settings
+    the model is quantized with, e.g. the calibration data, are a part of the name as a
+    hash, so a model quantized with other settings is never reused.
+    '''
+    suffix = ''
+    if settings:
+        suffix = '_' + hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:8]
+    return os.path.splitext(model_path)[0] + '_int8_{}{}.pt'.format(mode, suffix)
+
+
+def quantize_dynamic_model(model):
+    ''' Dynamic int8 quantization of the fully connected layers. The weights are quantized
+    ahead of time and the activations on the fly, so no calibration is needed.
+
+    :param model: Trained float model
+    :type model: torch.nn.Module
+
+    :return: The quantized model
+    :rtype: torch.nn.Module
+    '''
+    model = copy.deepcopy(model).eval()
+    return quantize_dynamic(model, DYNAMIC_LAYERS, dtype=torch.qint8)
+
+
+def quantize_static_model(model, calibration_dl, backend='x86'):
+    ''' Static post-training int8 quantization of the whole model with FX graph mode.
+    The convolutions are fused with their batch normalizations and ReLUs, and the ranges
+    of the activations are calibrated on the given data.
+
+    :param model: Trained float model
+    :type model: torch.nn.Module
+    :param calibration_dl: Calibration data, e.g. a sample of the validation split
+    :type calibration_dl: torch.utils.data.DataLoader
+    :param backend: Quantized engine, 'x86' (or 'fbgemm') for x86 CPUs, 'qnnpack' for ARM
+    :type backend: str
+
+    :return: The quantized model
+    :rtype: torch.nn.Module
+    '''
+
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).eval()
+
+    ecgs, ag, _ = next(iter(calibration_dl))[:3]
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (ecgs, ag))
+
+    with torch.no_grad():
+        for batch in calibration_dl:
+            ecgs, ag = batch[:2]
+            prepared(ecgs, ag)
+
+    return convert_fx(prepared)
+
+
+def save_quantized_model(model, path):
+    ''' Save a quantized model as a TorchScript artifact which loads without the model code.
+    The model is written into a temporary file of its own and renamed, so the processes
+    quantizing the same model at a time, e.g. the shards of a prediction, don't clash.
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            torch.jit.save(torch.jit.script(model), file)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_quantized_model(path):
+    return torch.jit.load(path, map_location='cpu')
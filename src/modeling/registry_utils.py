@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import hashlib
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    # No file locks e.g. on Windows
+    fcntl = None
+
+
+def default_registry_path():
+    ''' The registry of the trained models in the 'experiments' directory
+    '''
+    return os.path.join(os.getcwd(), 'experiments', 'model_registry.json')
+
+
+def hash_config(args):
+    ''' Hash of the arguments of a training, the same arguments give the same hash
+    '''
+    # The sections of the yaml file (e.g. architecture) are objects of their own
+    config = {k: v for k, v in vars(args).items()
+              if isinstance(v, (str, int, float, bool, list, dict, type(None))) or hasattr(v, '__dict__')}
+    config.pop('resume', None)
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=vars).encode()).hexdigest()[:16]
+
+
+@contextlib.contextmanager
+def locked(path):
+    ''' Exclusive lock of a file, so that several trainings can update the registry at the same time
+    '''
+    with open(path + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_registry(path=None):
+    ''' Load the registry of the trained models
+
+    :return registry: Entries of the models by their paths relative to the registry
+                      ('models') and the relative paths by the model filenames ('names')
+    :rtype: dict
+    '''
+
+    path = path or default_registry_path()
+    if not os.path.exists(path):
+        return {'models': {}, 'names': {}}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def register_model(model_path, labels, config_hash, metrics=None, path=None, **info):
+    ''' Add a trained model into the registry, or update its entry if it's already there
+
+    :param model_path: Absolute path for the trained model (.pth)
+    :type model_path: str
+    :param labels: Class labels the model was trained with
+    :type labels: list
+    :param config_hash: Hash of the training arguments
+    :type config_hash: str
+    :param metrics: Final metrics of the training, e.g. the validation metrics of the last epoch
+    :type metrics: dict
+    :param path: Absolute path for the registry, by default in the 'experiments' directory
+    :type path: str
+    :param info: Other information saved in the entry, e.g. the name of the training yaml
+    :type info: dict
+
+    :return entry: The entry of the model
+    :rtype: dict
+    '''
+
+    path = path or default_registry_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    model_path = os.path.abspath(model_path)
+    relative_path = os.path.relpath(model_path, os.path.dirname(path))
+    name = os.path.basename(model_path)
+    entry = dict(name=name, path=model_path, relative_path=relative_path, labels=list(labels),
+                 config_hash=config_hash, metrics=metrics or {}, registered_at=time.time(), **info)
+
+    with locked(path):
+        registry = load_registry(path)
+        registry['models'][relative_path] = entry
+
+        # The latest registered model is the last one with its name
+        paths = [p for p in registry['names'].get(name, []) if p != relative_path]
+        registry['names'][name] = paths + [relative_path]
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(registry, file, indent=1)
+        os.replace(tmp_path, path)
+
+    return entry
+
+
+def resolve_model(model, path=None):
+    ''' Find a trained model from the registry by its filename (e.g. 'split_1_1.pth') or by its
+    path relative to the 'experiments' directory (e.g. 'train_stratified_smoke/split_1_1.pth').
+    If several models have the same filename, the latest registered one is used.
+
+    :param model: Filename or relative path of the model
+    :type model: str
+    :param path: Absolute path for the registry, by default in the 'experiments' directory
+    :type path: str
+
+    :return entry: The entry of the model, None if the model isn't registered or its file doesn't exist
+    :rtype: dict
+    '''
+
+    registry = load_registry(path)
+
+    if model in registry['models']:
+        entry = registry['models'][model]
+    elif registry['names'].get(model):
+        relative_paths = registry['names'][model]
+        entry = registry['models'][relative_paths[-1]]
+        if len(relative_paths) > 1:
+            print('Several models named {} registered: {}. Using the latest one, {}. '
+                  'Give the relative path to use another one.'.format(model, relative_paths, relative_paths[-1]))
+    else:
+        return None
+
+    return entry if os.path.exists(entry['path']) else None
@@ -0,0 +1,186 @@
+import os, sys
+import json
+import time
+import numbers
+import random
+import numpy as np
+import pandas as pd
+import torch
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+
+def available_cpus():
+    ''' CPUs the current process is allowed to run on
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cpus(num_jobs):
+    ''' Split the available CPUs into disjoint sets, one for each concurrent job.
+    The CPUs left over from an even split are given to the first sets.
+
+    :param num_jobs: Number of concurrent jobs
+    :type num_jobs: int
+
+    :return: CPU sets of the jobs
+    :rtype: list
+    '''
+
+    cpus = available_cpus()
+    num_jobs = max(1, min(num_jobs, len(cpus)))
+    per_job, extra = divmod(len(cpus), num_jobs)
+
+    cpu_sets, start = [], 0
+    for slot in range(num_jobs):
+        end = start + per_job + (1 if slot < extra else 0)
+        cpu_sets.append(cpus[start:end])
+        start = end
+    return cpu_sets
+
+
+def summarize_history(history):
+    ''' Numeric values of a training or testing history, the last value of each list
+    (i.e. the last epoch) so that the results of the jobs can be put into one table
+    '''
+
+    summary = {}
+    for k, v in history.items():
+        if isinstance(v, list) and v and isinstance(v[-1], numbers.Number):
+            summary[k] = v[-1]
+        elif isinstance(v, numbers.Number) and not isinstance(v, bool):
+            summary[k] = v
+    return summary
+
+
+def _run_job(target, args, kwargs, log_path, result_path, cpus, seed, device):
+    ''' Run one job in a child process with its own log, CPUs and seed
+    '''
+
+    # Redirect both the Python and the native outputs into the log of the job
+    log = open(log_path, 'a', buffering=1)
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    sys.stdout = sys.stderr = log
+
+    # Pin the job to its CPUs so that the concurrent jobs don't compete for the same cores
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    if device is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(device)
+    torch.set_num_threads(max(1, len(cpus) - kwargs['overrides']['num_workers']))
+
+    # Seed like the training and prediction scripts so that a job gives the same
+    # results as when it's run alone
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = True
+
+    history = target(*args, **kwargs)
+
+    with open(result_path, 'w') as file:
+        json.dump(summarize_history(history or {}), file, default=float)
+
+
+def run_concurrently(target, jobs, num_jobs, log_dir, summary_path, seed=123):
+    ''' Run jobs concurrently as separate processes. At most `num_jobs` jobs are run at a
+    time and the remaining ones are queued. The CPUs are split between the concurrent jobs:
+    each job is pinned to its own CPUs, half of which (rounded down) are used by the
+    DataLoader workers and the rest by the PyTorch threads. If there are GPUs, the jobs
+    are spread over them. The output of each job goes to its own log file, and the
+    results of all the jobs are saved into one summary table.
+
+    The target is called as `target(*args, overrides={'num_workers': ...})` and it
+    should return a history dictionary, e.g. `read_yaml` of the training and the
+    prediction scripts.
+
+    :param target: Function running one job
+    :type target: function
+    :param jobs: Names of the jobs and the positional arguments of the target
+    :type jobs: list
+    :param num_jobs: Maximum number of concurrent jobs
+    :type num_jobs: int
+    :param log_dir: Directory for the logs of the jobs
+    :type log_dir: str
+    :param summary_path: Absolute path for the summary csv file
+    :type summary_path: str
+    :param seed: Seed of the random number generators in each job
+    :type seed: int
+
+    :return summary: Status, run time and the results of each job
+    :rtype: pandas.DataFrame
+    '''
+
+    os.makedirs(log_dir, exist_ok=True)
+
+    cpu_sets = split_cpus(num_jobs)
+    device_count = torch.cuda.device_count() if torch.cuda.is_available() else 0
+    print('Running {} jobs, {} at a time with {} CPU(s) each'.format(
+          len(jobs), len(cpu_sets), ', '.join(str(len(cpus)) for cpus in cpu_sets)))
+
+    # Spawned processes don't inherit the threads of the parent process
+    context = mp.get_context('spawn')
+    pending = list(jobs)
+    running = {} # sentinel -> (slot, name, process, start time)
+    free_slots = list(range(len(cpu_sets)))
+    rows = []
+
+    while pending or running:
+
+        # Start queued jobs on the free slots
+        while pending and free_slots:
+            slot = free_slots.pop(0)
+            name, args = pending.pop(0)
+            cpus = cpu_sets[slot]
+            kwargs = {'overrides': {'num_workers': len(cpus) // 2}}
+            log_path = os.path.join(log_dir, name + '.log')
+            result_path = os.path.join(log_dir, name + '_result.json')
+            if os.path.exists(result_path):
+                os.remove(result_path)
+            device = slot % device_count if device_count > 0 else None
+
+            process = context.Process(target=_run_job, name=name,
+                                      args=(target, args, kwargs, log_path, result_path, cpus, seed, device))
+            process.start()
+            running[process.sentinel] = (slot, name, process, time.time())
+            print('Started {} on CPU(s) {}, log: {}'.format(name, cpus, log_path))
+
+        # Wait for any of the running jobs to finish
+        for sentinel in wait(list(running)):
+            slot, name, process, start_time = running.pop(sentinel)
+            process.join()
+            free_slots.append(slot)
+
+            row = {'job': name,
+                   'status': 'done' if process.exitcode == 0 else 'failed',
+                   'exitcode': process.exitcode,
+                   'time_sec': time.time() - start_time,
+                   'log': os.path.join(log_dir, name + '.log')}
+            result_path = os.path.join(log_dir, name + '_result.json')
+            if process.exitcode == 0 and os.path.exists(result_path):
+                with open(result_path, 'r') as file:
+                    row.update(json.load(file))
+            rows.append(row)
+            print('Finished {} ({}) in {:.1f} sec'.format(name, row['status'], row['time_sec']))
+
+    # Combined summary in the order of the jobs
+    order = {name: i for i, (name, _) in enumerate(jobs)}
+    summary = pd.DataFrame(sorted(rows, key=lambda row: order[row['job']])).set_index('job')
+    summary.to_csv(summary_path)
+
+    print('\nSummary\n' + '-'*10)
+    print(summary.drop(columns=['log']).to_string(float_format=lambda x: '{:.4f}'.format(x)))
+    print('-'*10)
+    print('Saved to', summary_path)
+
+    failed = summary.index[summary['status'] != 'done'].tolist()
+    if failed:
+        raise Exception('Jobs {} failed, see their logs in {}'.format(failed, log_dir))
+
+    return summary
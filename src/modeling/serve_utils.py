@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import asyncio
+import tempfile
+import threading
+import concurrent.futures
+import numpy as np
+import torch
+from torch import nn
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from ..dataloader.dataset import get_transforms, collate_by_length
+from ..dataloader.dataset_utils import load_data, encode_metadata
+from .metrics import binarize_predictions
+from .tensor_file_utils import build_mmap_model
+from .model_utils import autocast, compile_model, optimize_for_inference, build_model, load_architecture
+
+
+class InferenceModel(object):
+    ''' Trained model loaded once for serving. The recordings are preprocessed like in
+    the prediction phase, with the test transforms and the encoded age and gender.
+
+    :param args: Serving arguments with the path of the trained model (model_path) and its labels
+    :type args: utils.obj
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.labels = list(args.labels)
+        self.threshold = getattr(args, 'threshold', 0.5)
+        self.precision = getattr(args, 'precision', 'fp32')
+        self.transforms = get_transforms('test')
+        self.channels = 12
+
+        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+        if getattr(args, 'mmap_weights', False) and self.device.type == 'cpu':
+            # The server processes of the same model share one copy of the weights
+            self.model = build_mmap_model(load_architecture(args.model_path), args.model_path, self.channels, len(self.labels))
+        else:
+            self.model = build_model(load_architecture(args.model_path), self.channels, len(self.labels))
+            self.model.load_state_dict(torch.load(args.model_path, map_location=self.device))
+        self.model.to(self.device)
+        self.model.eval()
+        if getattr(args, 'optimize_for_inference', False):
+            self.model = optimize_for_inference(self.model)
+        self.model = compile_model(self.model, getattr(args, 'compile', 'eager'),
+                                   getattr(args, 'compile_cache_dir', os.path.join(os.getcwd(), 'experiments', 'compile_cache')))
+        self.sigmoid = nn.Sigmoid()
+
+    def preprocess(self, ecg, age, gender):
+        ''' Transform a recording and encode its age and gender
+
+        :param ecg: ECG recording, one row per lead
+        :type ecg: numpy.ndarray
+        :param age: Patient's age, negative or None if unknown
+        :type age: float
+        :param gender: Patient's gender
+        :type gender: str
+
+        :return: The recording and the age and gender as tensors
+        :rtype: tuple
+        '''
+
+        ecg = np.array(ecg, dtype=np.float64)
+        if ecg.ndim != 2 or ecg.shape[0] != self.channels:
+            raise ValueError('Expected a recording of {} leads as a 2D array, got the shape {}'.format(self.channels, ecg.shape))
+        age = -1 if age is None else float(age)
+        return self.transforms(ecg), torch.from_numpy(encode_metadata(age, gender)).float()
+
+    def predict_batch(self, items):
+        ''' Predict a batch of preprocessed recordings. The recordings are grouped by their
+        length like in the prediction phase, so they're run as they are, without extra padding.
+
+        :param items: Recordings and their ages and genders from `preprocess`
+        :type items: list
+
+        :return results: Probabilities and predicted labels of each recording
+        :rtype: list
+        '''
+
+        logits_prob = torch.zeros(len(items), len(self.labels))
+        with torch.no_grad():
+            for positions, ecgs, ag in collate_by_length(items):
+                with autocast(self.device, self.precision):
+                    logits = self.model(ecgs.to(self.device), ag.to(self.device))
+                logits_prob[positions] = self.sigmoid(logits.float()).cpu()
+
+        logits_prob = logits_prob.numpy()
+        pred_labels = binarize_predictions(logits_prob, self.threshold)
+        return [{'probabilities': dict(zip(self.labels, prob.tolist())),
+                 'labels': [label for label, pred in zip(self.labels, pred) if pred],
+                 'batch_size': len(items)}
+                for prob, pred in zip(logits_prob, pred_labels)]
+
+
+class MicroBatcher(object):
+    ''' Collect the concurrent requests into micro-batches in an asyncio event loop. A batch
+    is run when it has `max_batch_size` requests or when its oldest request has waited for
+    `max_wait_ms` milliseconds. The batches are run in their own thread, so the requests
+    arriving meanwhile are queued into the next batch.
+
+    :param predict_fn: Function predicting a list of items, e.g. `InferenceModel.predict_batch`
+    :type predict_fn: function
+    :param max_batch_size: Maximum number of requests in a batch
+    :type max_batch_size: int
+    :param max_wait_ms: Maximum time a request waits for the other requests of its batch
+    :type max_wait_ms: float
+    '''
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=10):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self.loop = asyncio.new_event_loop()
+        self.queue = asyncio.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self._batch_loop(),), daemon=True)
+        self._get_task = None
+
+        # Counters for the health endpoint
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, item, timeout=None):
+        ''' Queue an item from any thread and wait for its result
+        '''
+        future = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (time.monotonic(), item, future))
+        return future.result(timeout)
+
+    def close(self):
+        ''' Stop after the queued requests are predicted
+        '''
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+        self.thread.join()
+        self.executor.shutdown()
+
+    def stats(self):
+        return {'requests': self.num_requests,
+                'batches': self.num_batches,
+                'mean_batch_size': self.num_requests / max(self.num_batches, 1),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000}
+
+    async def _next(self, timeout=None):
+        ''' Next queued request, False if the timeout passes and None when the batcher is closed.
+        An unfinished get is kept for the next call instead of cancelling it, so no request
+        is lost on a timeout.
+        '''
+        if self._get_task is None:
+            self._get_task = asyncio.ensure_future(self.queue.get())
+        done, _ = await asyncio.wait([self._get_task], timeout=timeout)
+        if not done:
+            return False
+        entry = self._get_task.result()
+        self._get_task = None
+        return entry
+
+    async def _batch_loop(self):
+        stopping = False
+        while not stopping:
+            entry = await self._next()
+            if entry is None:
+                break
+            batch = [entry]
+
+            # Fill the batch until it's full or the deadline of its oldest request
+            deadline = entry[0] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                entry = await self._next(max(deadline - time.monotonic(), 0))
+                if entry is False:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            try:
+                results = await self.loop.run_in_executor(self.executor, self.predict_fn, [item for _, item, _ in batch])
+                for (_, _, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+            self.num_requests += len(batch)
+            self.num_batches += 1
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    ''' HTTP endpoints of the server:
+
+    * `POST /predict` with a JSON body `{"ecg": [[...], ...], "age": 63, "gender": "Male"}`, or
+      with a .mat or .h5 file as the body and the age and gender as query parameters, e.g.
+      `/predict?format=mat&age=63&gender=Male`
+    * `GET /health` with the model and the batching counters
+    '''
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            return self.send_json(404, {'error': 'Not found'})
+        self.send_json(200, {'status': 'ok',
+                             'model': self.server.model.args.model_path,
+                             'labels': self.server.model.labels,
+                             **self.server.batcher.stats()})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            return self.send_json(404, {'error': 'Not found'})
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            item = self.read_item(body, parse_qs(url.query))
+        except (ValueError, TypeError, KeyError, OSError) as e:
+            return self.send_json(400, {'error': str(e)})
+
+        try:
+            result = self.server.batcher.submit(item, timeout=self.server.request_timeout)
+        except Exception as e:
+            return self.send_json(500, {'error': str(e)})
+        self.send_json(200, result)
+
+    def read_item(self, body, query):
+        ''' Recording and age and gender of a request, preprocessed for the model
+        '''
+        params = {k: v[0] for k, v in query.items()}
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError('Expected a JSON object, got {}'.format(type(data).__name__))
+            params.update(data)
+            ecg = params['ecg']
+        else:
+            file_format = params.get('format', 'mat').lstrip('.')
+            if file_format not in ['mat', 'h5']:
+                raise ValueError('Unknown file format {}, use mat or h5'.format(file_format))
+            ecg = load_upload(body, file_format)
+
+        age = params.get('age')
+        gender = params.get('gender', params.get('sex', 'Unknown'))
+        return self.server.model.preprocess(ecg, None if age in [None, ''] else float(age), gender)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Log only the errors, not every request
+        if len(args) > 1 and str(args[1]).startswith(('4', '5')):
+            super().log_message(format, *args)
+
+
+def load_upload(body, file_format):
+    ''' Load an uploaded .mat or .h5 recording with the same loader as the ECGDataset
+    '''
+    with tempfile.NamedTemporaryFile(suffix='.' + file_format) as file:
+        file.write(body)
+        file.flush()
+        return load_data(file.name)
+
+
+def make_server(args):
+    ''' Load the trained model once and create the HTTP server with its micro-batcher
+
+    :param args: Serving arguments: the trained model (model_path) and its labels, host, port,
+                 max_batch_size, max_wait_ms, request_timeout and the prediction options
+    :type args: utils.obj
+
+    :return server: The server, run with `serve_forever()` and stopped with `shutdown()`
+    :rtype: http.server.ThreadingHTTPServer
+    '''
+
+    model = InferenceModel(args)
+    batcher = MicroBatcher(model.predict_batch,
+                           max_batch_size=getattr(args, 'max_batch_size', 16),
+                           max_wait_ms=getattr(args, 'max_wait_ms', 10)).start()
+
+    server = ThreadingHTTPServer((getattr(args, 'host', '127.0.0.1'), getattr(args, 'port', 8000)), PredictionHandler)
+    server.daemon_threads = True
+    server.model = model
+    server.batcher = batcher
+    server.request_timeout = getattr(args, 'request_timeout', 60)
+    return server
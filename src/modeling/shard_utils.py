@@ -0,0 +1,84 @@
+import os
+import numpy as np
+import pandas as pd
+from .output_utils import test_outputs_path, save_test_outputs, load_test_outputs, open_test_memmaps
+
+
+def split_test_csv(test_path, num_shards, shard_dir, batch_size=1):
+    ''' Split the recordings of a test csv file into contiguous shards of nearly equal
+    sizes, so that the shards in their order have the recordings in the original order.
+    The shards are split between the batches, so each batch is predicted as it would be
+    in a single process and the probabilities are the same.
+
+    :param test_path: Absolute path for the test csv file
+    :type test_path: str
+    :param num_shards: Number of the shards
+    :type num_shards: int
+    :param shard_dir: Directory for the csv files of the shards
+    :type shard_dir: str
+    :param batch_size: Number of the recordings predicted at a time
+    :type batch_size: int
+
+    :return shard_paths: Absolute paths for the csv files of the non-empty shards
+    :rtype: list
+    '''
+
+    os.makedirs(shard_dir, exist_ok=True)
+    df = pd.read_csv(test_path)
+    name = os.path.splitext(os.path.basename(test_path))[0]
+
+    # Indexes of the batches in each shard
+    num_batches = -(-len(df) // batch_size)
+    shard_batches = np.array_split(np.arange(num_batches), max(1, min(num_shards, num_batches)))
+
+    shard_paths = []
+    for k, batches in enumerate(shard_batches):
+        shard_path = os.path.join(shard_dir, '{}_shard_{}.csv'.format(name, k + 1))
+        rows = slice(batches[0] * batch_size, (batches[-1] + 1) * batch_size) if len(batches) else slice(0, 0)
+        df.iloc[rows].to_csv(shard_path, index=False)
+        shard_paths.append(shard_path)
+    return shard_paths
+
+
+def merge_test_outputs(shard_output_paths, output_dir, yaml_file_name, chunked=False):
+    ''' Concatenate the raw outputs saved by the shards into the outputs of the whole run,
+    as if they were saved by one `predict()` run: an array file, or with `chunked` the
+    disk-backed arrays of the chunked evaluation mode, which are filled shard by shard
+
+    :param shard_output_paths: Absolute paths for the array files of the shards in their order
+    :type shard_output_paths: list
+    :param output_dir: Directory of the prediction run
+    :type output_dir: str
+    :param yaml_file_name: Name of the yaml file used in the run
+    :type yaml_file_name: str
+    :param chunked: If True, the outputs are merged into the disk-backed arrays
+    :type chunked: boolean
+
+    :return num_records: Number of the recordings
+    :rtype: int
+    '''
+
+    if chunked:
+        # Only the sizes are needed before the arrays are filled one shard at a time
+        sizes = []
+        for path in shard_output_paths:
+            with np.load(path) as outputs:
+                sizes.append(outputs['y_prob'].shape)
+        y_true_mm, y_prob_mm = open_test_memmaps(output_dir, yaml_file_name, sum(size[0] for size in sizes), sizes[0][1])
+        row = 0
+        for path in shard_output_paths:
+            _, _, y_true, y_prob = load_test_outputs(path)
+            y_true_mm[row:row + len(y_prob)] = y_true
+            y_prob_mm[row:row + len(y_prob)] = y_prob
+            row += len(y_prob)
+        y_true_mm.flush()
+        y_prob_mm.flush()
+        return row
+
+    shards = [load_test_outputs(path) for path in shard_output_paths]
+    save_test_outputs(test_outputs_path(output_dir, yaml_file_name),
+                      [filename for shard in shards for filename in shard[0]],
+                      shards[0][1],
+                      np.concatenate([shard[2] for shard in shards]),
+                      np.concatenate([shard[3] for shard in shards]))
+    return sum(len(shard[0]) for shard in shards)
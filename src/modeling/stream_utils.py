@@ -0,0 +1,131 @@
+import numpy as np
+from ..dataloader.transforms import BandPassFilter
+
+
+class ECGStream(object):
+    ''' Ring buffer of the latest samples of one stream and the state of its filter
+
+    :param channels: Number of the leads
+    :type channels: int
+    :param window_size: Number of the samples in a window predicted by the model
+    :type window_size: int
+    :param age: Patient's age, None if unknown
+    :type age: float
+    :param gender: Patient's gender
+    :type gender: str
+    '''
+
+    def __init__(self, channels, window_size, age=None, gender='Unknown'):
+        self.buffer = np.zeros((channels, window_size), dtype=np.float32)
+        self.position = 0 # the index where the next sample is written
+        self.num_samples = 0
+        self.next_emission = window_size
+        self.zi = None
+        self.age = age
+        self.gender = gender
+
+    def write(self, samples):
+        ''' Write samples into the ring buffer over the oldest ones
+        '''
+        n, window_size = samples.shape[1], self.buffer.shape[1]
+        if n >= window_size:
+            self.buffer[:] = samples[:, -window_size:]
+            self.position = 0
+        else:
+            end = self.position + n
+            if end <= window_size:
+                self.buffer[:, self.position:end] = samples
+            else:
+                split = window_size - self.position
+                self.buffer[:, self.position:] = samples[:, :split]
+                self.buffer[:, :n - split] = samples[:, split:]
+            self.position = end % window_size
+        self.num_samples += n
+
+    def window(self):
+        ''' Copy of the latest window, the oldest sample first
+        '''
+        return np.concatenate((self.buffer[:, self.position:], self.buffer[:, :self.position]), axis=1).astype(np.float64)
+
+
+class StreamingClassifier(object):
+    ''' Classify continuous ECG streams. Each stream keeps its latest `window_size` samples
+    in a ring buffer, and once the buffer is full the window is predicted every `hop`
+    samples. The chunks of all the streams given at a time are predicted together in
+    batches, so one process can follow hundreds of streams.
+
+    With `bandpass=True` the chunks are filtered with the causal version of `BandPassFilter`,
+    whose state is carried from chunk to chunk so that no sample is filtered twice.
+
+    :param model: Trained model with the preprocessing of the prediction phase
+    :type model: src.modeling.serve_utils.InferenceModel
+    :param window_size: Number of the samples in a predicted window
+    :type window_size: int
+    :param hop: Number of the samples between the predictions of a stream
+    :type hop: int
+    :param fs: Sampling frequency of the streams
+    :type fs: int
+    :param bandpass: If True, the streams are band-pass filtered
+    :type bandpass: boolean
+    :param max_batch_size: Maximum number of the windows in a forward pass
+    :type max_batch_size: int
+    '''
+
+    def __init__(self, model, window_size=4096, hop=500, fs=500, bandpass=False, max_batch_size=64):
+        self.model = model
+        self.window_size = window_size
+        self.hop = hop
+        self.max_batch_size = max_batch_size
+        self.filter = BandPassFilter(fs) if bandpass else None
+        self.streams = {}
+
+    def open_stream(self, stream_id, age=None, gender='Unknown'):
+        self.streams[stream_id] = ECGStream(self.model.channels, self.window_size, age, gender)
+
+    def close_stream(self, stream_id):
+        self.streams.pop(stream_id, None)
+
+    def push(self, chunks):
+        ''' Add new samples to the streams and predict the windows which are due
+
+        :param chunks: New samples of the streams by the stream ids, each as an array of
+                       the shape (leads, samples)
+        :type chunks: dict
+
+        :return emissions: Predictions of the windows with the id of the stream and the
+                           number of the samples streamed at the end of the window. A chunk
+                           longer than the hop can give several predictions of a stream.
+        :rtype: list
+        '''
+
+        windows = []
+        for stream_id, chunk in chunks.items():
+            stream = self.streams[stream_id]
+            chunk = np.asarray(chunk, dtype=np.float64)
+            if chunk.ndim != 2 or chunk.shape[0] != self.model.channels:
+                raise ValueError('Expected a chunk of {} leads as a 2D array, got the shape {}'.format(self.model.channels, chunk.shape))
+
+            if self.filter is not None:
+                if stream.zi is None:
+                    stream.zi = self.filter.initial_state(chunk[:, 0])
+                chunk, stream.zi = self.filter.stream(chunk, stream.zi)
+
+            # Write the chunk up to each emission point and take the window there
+            offset = 0
+            while offset < chunk.shape[1]:
+                step = min(chunk.shape[1] - offset, stream.next_emission - stream.num_samples)
+                stream.write(chunk[:, offset:offset + step])
+                offset += step
+                if stream.num_samples == stream.next_emission:
+                    windows.append((stream_id, stream.num_samples,
+                                    self.model.preprocess(stream.window(), stream.age, stream.gender)))
+                    stream.next_emission += self.hop
+
+        emissions = []
+        for start in range(0, len(windows), self.max_batch_size):
+            batch = windows[start:start + self.max_batch_size]
+            results = self.model.predict_batch([item for _, _, item in batch])
+            for (stream_id, sample, _), result in zip(batch, results):
+                emissions.append({'stream': stream_id, 'sample': sample,
+                                  'probabilities': result['probabilities'], 'labels': result['labels']})
+        return emissions
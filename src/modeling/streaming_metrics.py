@@ -0,0 +1,330 @@
+import numpy as np
+import os, shutil, tempfile
+from .metrics import to_numpy, binarize_predictions, load_challenge_weights, challenge_labels, \
+                     challenge_confusion_matrices, normalized_challenge_score
+
+
+class ChunkedMetrics(object):
+    ''' Out-of-core evaluation of multilabel predictions. The predictions are given
+    in chunks with `update()` and nothing is kept in memory for the whole test set:
+
+     1) The challenge confusion matrices and the per-class counts are sums over the
+        recordings, so they are accumulated chunk by chunk
+     2) AUROC and average precision need the predictions in the order of the scores,
+        so each chunk is sorted and written to the disk as a sorted run. In `compute()`
+        the runs are merged block by block (external merge sort) and the ROC and the
+        precision-recall curves are accumulated from the merged stream
+
+    The peak memory depends on `chunk_size` and `block_size`, not on the size of the test set.
+
+    :param labels: Class labels used in the classification as SNOMED CT Codes
+    :type labels: list
+    :param threshold: Decision threshold
+    :type threshold: float
+    :param work_dir: Directory where the sorted runs are written
+    :type work_dir: str
+    :param chunk_size: Number of recordings in one sorted run
+    :type chunk_size: int
+    :param block_size: Number of values read at a time from each sorted run when merging
+    :type block_size: int
+    :param max_curve_points: Resolution of the ROC curves kept for plotting
+    :type max_curve_points: int
+    '''
+
+    def __init__(self, labels, threshold=0.5, work_dir=None, chunk_size=65536, block_size=8192, max_curve_points=1000):
+        self.labels = list(labels)
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.max_curve_points = max_curve_points
+        self.work_dir = tempfile.mkdtemp(prefix='sorted_runs_', dir=work_dir)
+
+        # PhysioNet Challenge 2021 confusion matrices
+        self.sinus_rhythm = '426783006'
+        self.weights, self.classes = load_challenge_weights()
+        self.observed = np.zeros(self.weights.shape)
+        self.correct = np.zeros(self.weights.shape)
+        self.inactive = np.zeros(self.weights.shape)
+
+        # Per-class counts with the binarized predictions
+        num_labels = len(self.labels)
+        self.class_counts = {key: np.zeros(num_labels, dtype=np.int64) for key in ['positives', 'tp', 'fp', 'fn', 'tn']}
+        self.num_records = 0
+
+        self.runs = []
+        self.buffer_true, self.buffer_prob = [], []
+        self.buffered = 0
+
+    def update(self, y_true, y_prob):
+        ''' Add a chunk of predictions
+
+        :param y_true: Actual class labels
+        :type y_true: torch.Tensor or numpy.ndarray
+        :param y_prob: Predicted probabilities
+        :type y_prob: torch.Tensor or numpy.ndarray
+        '''
+
+        y_true = np.atleast_2d(to_numpy(y_true)).astype(np.int8)
+        y_prob = np.atleast_2d(to_numpy(y_prob)).astype(np.float32)
+        assert y_true.shape == y_prob.shape and y_true.shape[1] == len(self.labels)
+
+        # -- Sums over the recordings
+        y_binary = binarize_predictions(y_prob, self.threshold)
+
+        self.class_counts['positives'] += y_true.sum(axis=0)
+        self.class_counts['tp'] += ((y_true == 1) & (y_binary == 1)).sum(axis=0)
+        self.class_counts['fp'] += ((y_true == 0) & (y_binary == 1)).sum(axis=0)
+        self.class_counts['fn'] += ((y_true == 1) & (y_binary == 0)).sum(axis=0)
+        self.class_counts['tn'] += ((y_true == 0) & (y_binary == 0)).sum(axis=0)
+        self.num_records += y_true.shape[0]
+
+        true_labels, binary_outputs = challenge_labels(y_true, y_binary, self.labels, self.classes)
+        observed, correct, inactive = challenge_confusion_matrices(true_labels, binary_outputs, self.classes, self.sinus_rhythm)
+        self.observed += observed
+        self.correct += correct
+        self.inactive += inactive
+
+        # -- Sorted runs for the rank based metrics
+        self.buffer_true.append(y_true)
+        self.buffer_prob.append(y_prob)
+        self.buffered += y_true.shape[0]
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        ''' Sort the buffered predictions of each class in descending order of the
+        scores and write them to the disk as one run
+        '''
+
+        if self.buffered == 0:
+            return
+
+        y_true = np.concatenate(self.buffer_true, axis=0)
+        y_prob = np.concatenate(self.buffer_prob, axis=0)
+        self.buffer_true, self.buffer_prob = [], []
+        self.buffered = 0
+
+        order = np.argsort(-y_prob, axis=0, kind='stable')
+
+        # One row per class so that a class can be read sequentially from the run
+        scores = np.ascontiguousarray(np.take_along_axis(y_prob, order, axis=0).T)
+        labels = np.ascontiguousarray(np.take_along_axis(y_true, order, axis=0).T)
+
+        run_path = os.path.join(self.work_dir, 'run_{}'.format(len(self.runs)))
+        np.save(run_path + '_scores.npy', scores)
+        np.save(run_path + '_labels.npy', labels)
+        self.runs.append(run_path)
+
+    def compute(self):
+        ''' Compute the metrics. Classes without any positive recordings are left
+        out from AUROC and average precision as in `cal_multilabel_metrics`.
+
+        :return: macro average precision, micro average precision, macro AUROC,
+                 micro AUROC and the challenge metric
+        :rtypes: float
+        '''
+
+        self.flush()
+
+        runs = [(np.load(run + '_scores.npy', mmap_mode='r'), np.load(run + '_labels.npy', mmap_mode='r')) for run in self.runs]
+
+        positives = self.class_counts['positives']
+        cls_idx = np.flatnonzero(positives > 0)
+        self.cls_labels = [self.labels[i] for i in cls_idx]
+
+        self.fpr, self.tpr, self.roc_auc = dict(), dict(), dict()
+        avg_prec = []
+
+        # AUROC and average precision for each class
+        for i, c in enumerate(cls_idx):
+            sources = [(scores[c], labels[c]) for scores, labels in runs]
+            curve = self.merge_curve(sources, positives[c], self.num_records - positives[c])
+            self.fpr[i], self.tpr[i], self.roc_auc[i] = curve.fpr, curve.tpr, curve.auroc
+            avg_prec.append(curve.avg_prec)
+
+        # Micro-average over all the values of the classes
+        sources = [(scores[c], labels[c]) for scores, labels in runs for c in cls_idx]
+        num_pos = positives[cls_idx].sum()
+        curve = self.merge_curve(sources, num_pos, self.num_records * len(cls_idx) - num_pos)
+        self.fpr['micro'], self.tpr['micro'], self.roc_auc['micro'] = curve.fpr, curve.tpr, curve.auroc
+
+        macro_avg_prec = float(np.mean(avg_prec))
+        micro_avg_prec = curve.avg_prec
+        macro_auroc = float(np.nanmean([self.roc_auc[i] for i in range(len(cls_idx))]))
+        micro_auroc = curve.auroc
+        challenge_metric = normalized_challenge_score(self.weights, self.observed, self.correct, self.inactive)
+
+        del runs
+        self.cleanup()
+
+        return macro_avg_prec, micro_avg_prec, macro_auroc, micro_auroc, challenge_metric
+
+    def merge_curve(self, sources, num_pos, num_neg):
+        ''' Merge the sorted runs and accumulate the curves from the merged values
+
+        :param sources: Pairs of scores and labels, each sorted in descending order of the scores
+        :type sources: list
+        :param num_pos: Number of positive values in the sources
+        :type num_pos: int
+        :param num_neg: Number of negative values in the sources
+        :type num_neg: int
+
+        :return curve: Accumulated curves
+        :rtype: CurveAccumulator
+        '''
+
+        curve = CurveAccumulator(num_pos, num_neg, self.max_curve_points)
+        for scores, labels in merge_descending(sources, self.block_size):
+            curve.add(scores, labels)
+        curve.finish()
+        return curve
+
+    def cleanup(self):
+        ''' Remove the sorted runs from the disk
+        '''
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.runs = []
+
+
+def merge_descending(sources, block_size=8192):
+    ''' K-way merge of score arrays sorted in descending order. The sources are read
+    `block_size` values at a time, and the merged values are yielded in batches.
+
+    :param sources: Pairs of scores and labels, each sorted in descending order of the scores
+    :type sources: list
+    :param block_size: Number of values read at a time from each source
+    :type block_size: int
+
+    :return: Batches of scores and labels in descending order of the scores
+    :rtype: generator
+    '''
+
+    positions = [0] * len(sources)
+    pending = [(np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int8)) for _ in sources]
+
+    while True:
+        # Read the next block of every source whose loaded values have been merged
+        for i, (scores, labels) in enumerate(sources):
+            if len(pending[i][0]) == 0 and positions[i] < len(scores):
+                end = min(positions[i] + block_size, len(scores))
+                pending[i] = (np.asarray(scores[positions[i]:end]), np.asarray(labels[positions[i]:end]))
+                positions[i] = end
+
+        # The values which are not read yet are at most the smallest loaded value of their source,
+        # so everything above the largest of these is safe to merge
+        unread = [pending[i][0][-1] for i, (scores, _) in enumerate(sources) if positions[i] < len(scores)]
+        frontier = max(unread) if unread else -np.inf
+
+        merged_scores, merged_labels = [], []
+        for i, (scores, labels) in enumerate(pending):
+            n = np.searchsorted(-scores, -frontier, side='right')
+            if n > 0:
+                merged_scores.append(scores[:n])
+                merged_labels.append(labels[:n])
+                pending[i] = (scores[n:], labels[n:])
+
+        if not merged_scores:
+            return
+
+        merged_scores = np.concatenate(merged_scores)
+        merged_labels = np.concatenate(merged_labels)
+        order = np.argsort(-merged_scores, kind='stable')
+        yield merged_scores[order], merged_labels[order]
+
+
+class CurveAccumulator(object):
+    ''' Accumulate the ROC curve, AUROC and average precision from scores given in
+    descending order. Equal scores form one threshold even if they are split across
+    several batches.
+
+    :param num_pos: Number of positive values
+    :type num_pos: int
+    :param num_neg: Number of negative values
+    :type num_neg: int
+    :param max_curve_points: Resolution of the ROC curve kept for plotting
+    :type max_curve_points: int
+    '''
+
+    def __init__(self, num_pos, num_neg, max_curve_points=1000):
+        self.num_pos = int(num_pos)
+        self.num_neg = int(num_neg)
+        self.max_curve_points = max_curve_points
+
+        # Counts of the closed thresholds
+        self.tp, self.fp = 0, 0
+        self.area, self.avg_prec_sum = 0.0, 0.0
+
+        # Counts of the latest score, which might continue in the next batch
+        self.open_score = None
+        self.open_tp, self.open_fp = 0, 0
+
+        self.fpr_points, self.tpr_points = [0.0], [0.0]
+        self.last_key = (0, 0)
+
+    def add(self, scores, labels):
+        ''' Add a batch of scores and labels in descending order of the scores
+        '''
+
+        if len(scores) == 0:
+            return
+
+        labels = np.asarray(labels, dtype=np.int64)
+        starts = np.r_[0, np.flatnonzero(scores[1:] != scores[:-1]) + 1]
+        group_tp = np.add.reduceat(labels, starts)
+        group_fp = np.diff(np.r_[starts, len(scores)]) - group_tp
+        group_scores = scores[starts]
+
+        # The first group continues the open threshold if the score is the same
+        if self.open_score is not None and group_scores[0] == self.open_score:
+            group_tp[0] += self.open_tp
+            group_fp[0] += self.open_fp
+        elif self.open_score is not None:
+            group_tp = np.r_[self.open_tp, group_tp]
+            group_fp = np.r_[self.open_fp, group_fp]
+
+        # The last group stays open
+        self.close(group_tp[:-1], group_fp[:-1])
+        self.open_score = group_scores[-1]
+        self.open_tp, self.open_fp = int(group_tp[-1]), int(group_fp[-1])
+
+    def close(self, group_tp, group_fp):
+        ''' Add the thresholds of the given groups to the curves
+        '''
+
+        if len(group_tp) == 0:
+            return
+
+        tps = self.tp + np.cumsum(group_tp)
+        fps = self.fp + np.cumsum(group_fp)
+        prev_tps = np.r_[self.tp, tps[:-1]]
+        prev_fps = np.r_[self.fp, fps[:-1]]
+
+        # Trapezoidal area under the ROC curve and the step-wise average precision
+        self.area += float(np.sum((fps - prev_fps) * (tps + prev_tps) / 2.0))
+        self.avg_prec_sum += float(np.sum((tps - prev_tps) * tps / (tps + fps)))
+        self.tp, self.fp = int(tps[-1]), int(fps[-1])
+
+        # Keep the points that move the curve by at least one step of the plotting resolution
+        fpr = fps / max(self.num_neg, 1)
+        tpr = tps / max(self.num_pos, 1)
+        keys = np.stack([np.floor(fpr * self.max_curve_points), np.floor(tpr * self.max_curve_points)], axis=1)
+        prev_keys = np.vstack([self.last_key, keys[:-1]])
+        keep = np.any(keys != prev_keys, axis=1)
+        self.fpr_points.extend(fpr[keep].tolist())
+        self.tpr_points.extend(tpr[keep].tolist())
+        self.last_key = tuple(keys[-1])
+
+    def finish(self):
+        ''' Close the last threshold and normalize the metrics
+        '''
+
+        if self.open_score is not None:
+            self.close(np.array([self.open_tp]), np.array([self.open_fp]))
+            self.open_score = None
+            self.fpr_points.append(self.fp / max(self.num_neg, 1))
+            self.tpr_points.append(self.tp / max(self.num_pos, 1))
+
+        self.auroc = self.area / (self.num_pos * self.num_neg) if self.num_pos > 0 and self.num_neg > 0 else np.nan
+        self.avg_prec = self.avg_prec_sum / self.num_pos if self.num_pos > 0 else np.nan
+        self.fpr = np.array(self.fpr_points)
+        self.tpr = np.array(self.tpr_points)
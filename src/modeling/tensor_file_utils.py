@@ -0,0 +1,152 @@
+import os
+import json
+import struct
+import tempfile
+import torch
+from .model_utils import build_model
+
+# Names of the dtypes in the header, as in the safetensors format
+DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool
+}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+
+
+def flat_weights_path(model_path):
+    ''' Absolute path for the flat tensor file of a trained model, saved next to the model
+    '''
+    return os.path.splitext(model_path)[0] + '.safetensors'
+
+
+def save_flat_weights(state_dict, path, metadata=None):
+    ''' Save a state dictionary as one flat file of tensors: the length of a JSON header
+    (8 bytes, little-endian), the header with the dtype, shape and byte range of each tensor,
+    and the raw bytes of the tensors one after another. This is the layout of the safetensors
+    format. The tensors are ordered by their element size, so every tensor starts at an
+    offset aligned to its dtype and can be used in place from a memory map. The file is
+    written into a temporary file of its own next to the final path and renamed, so a reader
+    never sees a partial file and the processes saving the same file don't clash.
+
+    :param state_dict: Tensors by their names, e.g. the state dictionary of a model
+    :type state_dict: dict
+    :param path: Absolute path for the file
+    :type path: str
+    :param metadata: Strings saved in the header, e.g. the name of the training yaml
+    :type metadata: dict
+    '''
+
+    tensors = {name: tensor.detach().cpu().contiguous() for name, tensor in state_dict.items()}
+    names = sorted(tensors, key=lambda name: -tensors[name].element_size())
+
+    header, offset = {}, 0
+    for name in names:
+        tensor = tensors[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': DTYPE_NAMES[tensor.dtype], 'shape': list(tensor.shape), 'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header['__metadata__'] = {k: str(v) for k, v in metadata.items()}
+
+    # The header is padded with spaces so that the data starts at a multiple of 8 bytes
+    header = json.dumps(header, separators=(',', ':')).encode()
+    header += b' ' * (-(8 + len(header)) % 8)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(struct.pack('<Q', len(header)))
+            file.write(header)
+            for name in names:
+                if tensors[name].numel() > 0:
+                    file.write(tensors[name].reshape(-1).view(torch.uint8).numpy().tobytes())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_header(path):
+    ''' Header of a flat tensor file and the offset where its data starts
+    '''
+    with open(path, 'rb') as file:
+        length = struct.unpack('<Q', file.read(8))[0]
+        header = json.loads(file.read(length))
+    return header, 8 + length
+
+
+def load_flat_weights(path):
+    ''' Load the tensors of a flat tensor file as views into a memory map of the file. Nothing
+    is read until a tensor is used, so the loading is near-instant. The file is mapped
+    copy-on-write: the processes loading the same file share its pages in the page cache,
+    and a tensor modified in place gets a private copy of its pages, leaving the file as it is.
+
+    :param path: Absolute path for the file
+    :type path: str
+
+    :return tensors: Tensors by their names, e.g. the state dictionary of a model
+    :rtype: dict
+    '''
+
+    header, data_start = read_header(path)
+    header.pop('__metadata__', None)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = DTYPES[info['dtype']]
+        begin = data_start + info['data_offsets'][0]
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        tensors[name] = torch.empty(0, dtype=dtype).set_(storage, begin // itemsize, info['shape'])
+    return tensors
+
+
+def mmap_state_dict(model_path):
+    ''' State dictionary of a trained model from its flat tensor file, which is made from
+    the trained model (.pth) if there's none or it's older than the trained model. The
+    processes making the same file at a time write identical files, and the last one is kept.
+
+    :param model_path: Absolute path for the trained model (.pth)
+    :type model_path: str
+
+    :return: Memory-mapped tensors by their names
+    :rtype: dict
+    '''
+
+    path = flat_weights_path(model_path)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(model_path):
+        print('Saving the weights of {} as a flat tensor file {}'.format(model_path, path))
+        save_flat_weights(torch.load(model_path, map_location='cpu'), path)
+    return load_flat_weights(path)
+
+
+def build_mmap_model(architecture, model_path, in_channel, out_channel):
+    ''' Build a trained model with its weights memory-mapped from its flat tensor file. The
+    initialized weights of the new model are replaced by the mapped tensors, not copied into.
+
+    :param architecture: Architecture of the model from `load_architecture`
+    :type architecture: dict
+    :param model_path: Absolute path for the trained model (.pth)
+    :type model_path: str
+    :param in_channel: Number of the leads
+    :type in_channel: int
+    :param out_channel: Number of the labels
+    :type out_channel: int
+
+    :return model: The model on CPU
+    :rtype: torch.nn.Module
+    '''
+
+    model = build_model(architecture, in_channel, out_channel)
+    model.load_state_dict(mmap_state_dict(model_path), assign=True)
+    return model
@@ -6,22 +6,67 @@ import numpy as np
 from torch import nn
 from torch import optim
 from torch.utils.data import DataLoader
-from .models.seresnet18 import resnet18
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from ..dataloader.dataset import ECGDataset, get_transforms
 from .metrics import cal_multilabel_metrics, roc_curves
+from .model_utils import autocast, compile_model, unwrap_compiled, model_architecture, build_model, save_architecture
+from .checkpoint_utils import AsyncCheckpointer, latest_checkpoint, rng_states, set_rng_states
+from .profiling_utils import StepTimer, ProfilerController, write_timing_report
+from .registry_utils import register_model, hash_config
+from .tensor_file_utils import flat_weights_path, save_flat_weights
+from .cascade_utils import early_exit_index, train_exit_head, exit_probabilities, calibrate_exit_threshold, save_cascade
+from .distributed_utils import is_distributed, get_rank, get_local_rank, get_world_size, is_main_process, gather_tensor, all_reduce_sum
 import pickle
 
 class Training(object):
     def __init__(self, args):
         self.args = args
+
+        # Precision of the forward pass, the loss and the metrics are always computed in fp32
+        self.precision = getattr(self.args, 'precision', 'fp32')
+
+        # Timers for the phases of the training and validation steps
+        self.timing = getattr(self.args, 'timing', False)
+
+        # Compiling the model ('eager', 'inductor' or 'torchscript') and the cache of the compiled graphs
+        self.compile = getattr(self.args, 'compile', 'eager')
+        self.compile_cache_dir = getattr(self.args, 'compile_cache_dir', os.path.join(os.getcwd(), 'experiments', 'compile_cache'))
+
+        # Depth, width, kernel size and SE blocks of the model, resnet18 by default
+        self.architecture = model_architecture(getattr(self.args, 'architecture', None))
+
+        # The early exit head is trained after the model for `early_exit_epochs` epochs, and its
+        # threshold calibrated on the validation split so that at most `early_exit_max_miss`
+        # of the recordings which aren't only normal would exit
+        self.early_exit_epochs = getattr(self.args, 'early_exit_epochs', 3)
+        self.early_exit_max_miss = getattr(self.args, 'early_exit_max_miss', 0.01)
+
+        # The weights are also saved as a flat tensor file which can be memory-mapped
+        # in the prediction phase (mmap_weights)
+        self.save_mmap_weights = getattr(self.args, 'save_mmap_weights', False)
   
     def setup(self):
         '''Initializing the device conditions, datasets, dataloaders, 
         model, loss, criterion and optimizer
         '''
         
+        # Multi-process training with DistributedDataParallel if launched with several processes
+        self.distributed = is_distributed()
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+
         # Consider the GPU or CPU condition
-        if torch.cuda.is_available():
+        if self.distributed:
+            # One device per process, the batch size is split between the processes
+            self.device = torch.device("cuda", get_local_rank()) if torch.cuda.is_available() else torch.device("cpu")
+            self.device_count = 1
+            if torch.cuda.is_available():
+                torch.cuda.set_device(self.device)
+            assert self.args.batch_size % self.world_size == 0, "batch size should be divided by world size"
+            if is_main_process():
+                print('using {} processes on {}'.format(self.world_size, self.device.type))
+        elif torch.cuda.is_available():
             self.device = torch.device("cuda")
             self.device_count = self.args.device_count
             print('using {} gpu(s)'.format(self.device_count))
@@ -32,14 +77,19 @@ class Training(object):
             print('using {} cpu'.format(self.device_count))
 
         # Load the datasets       
-        training_set = ECGDataset(self.args.train_path, get_transforms('train'))
-        validation_set = ECGDataset(self.args.val_path, get_transforms('val')) 
+        training_set = ECGDataset(self.args.train_path, get_transforms('train'), timing=self.timing)
+        validation_set = ECGDataset(self.args.val_path, get_transforms('val'), timing=self.timing) 
         channels = training_set.channels
         self.validation_files = validation_set.data
+
+        # In distributed training each process loads its own shard of the data
+        self.train_sampler = DistributedSampler(training_set, shuffle=True) if self.distributed else None
+        self.val_sampler = DistributedSampler(validation_set, shuffle=False) if self.distributed else None
               
         self.train_dl = DataLoader(training_set,
-                                   batch_size=self.args.batch_size,
-                                   shuffle=True,
+                                   batch_size=self.args.batch_size // self.world_size,
+                                   shuffle=(self.train_sampler is None),
+                                   sampler=self.train_sampler,
                                    num_workers=self.args.num_workers,
                                    pin_memory=(True if self.device == 'cuda' else False),
                                    drop_last=True)
@@ -47,15 +97,27 @@ class Training(object):
         self.val_dl = DataLoader(validation_set,
                                  batch_size=1,
                                  shuffle=False,
+                                 sampler=self.val_sampler,
                                  num_workers=self.args.num_workers,
                                  pin_memory=(True if self.device == 'cuda' else False),
                                  drop_last=True)
 
-        self.model = resnet18(in_channel=channels, 
-                              out_channel=len(self.args.labels))
+        self.model = build_model(self.architecture, 
+                                 in_channel=channels, 
+                                 out_channel=len(self.args.labels))
+        self.model.to(self.device)
+        if self.architecture['early_exit']:
+            # Not trained with the rest of the model, see train_early_exit
+            self.model.exit_head.requires_grad_(False)
+        self.model = compile_model(self.model, self.compile, self.compile_cache_dir)
 
+        # If several processes used, use distributed data parallelism where
+        # the gradients are all-reduced between the processes
+        if self.distributed:
+            self.model = DistributedDataParallel(self.model,
+                                                 device_ids=([self.device.index] if self.device.type == 'cuda' else None))
         # If more than 1 CUDA device used, use data parallelism
-        if self.device_count > 1:
+        elif self.device_count > 1:
             self.model = torch.nn.DataParallel(self.model) 
         
         # Optimizer
@@ -66,18 +128,89 @@ class Training(object):
         self.criterion = nn.BCEWithLogitsLoss()
         self.sigmoid = nn.Sigmoid()
         self.sigmoid.to(self.device)
-        self.model.to(self.device)
+
+        # Periodic checkpoints (every `checkpoint_every` epochs, 0 to disable) of which
+        # the last `keep_checkpoints` are kept
+        self.checkpoint_every = getattr(self.args, 'checkpoint_every', 1)
+        self.keep_checkpoints = getattr(self.args, 'keep_checkpoints', 3)
+        self.checkpoint_dir = os.path.join(self.args.model_save_dir, 'checkpoints')
+        self.start_epoch = 1
+        self.history = None
+
+        # Continue an interrupted training from a checkpoint
+        resume = getattr(self.args, 'resume', None)
+        if resume:
+            self.resume(resume)
+
+    def resume(self, checkpoint):
+        ''' Restore the model, optimizer, random number generators and the training
+        history from a checkpoint. The training continues from the next epoch.
         
-    def train(self):
-        ''' PyTorch training loop
+        :param checkpoint: Absolute path for the checkpoint or 'latest' to use
+                           the latest checkpoint of the yaml file
+        :type checkpoint: str
         '''
+
+        if checkpoint == 'latest':
+            checkpoint = latest_checkpoint(self.checkpoint_dir, self.args.yaml_file_name)
+            if checkpoint is None:
+                print('No checkpoint found from {}, training from the beginning'.format(self.checkpoint_dir))
+                return
+
+        print('Resuming the training from', checkpoint)
+        state = torch.load(checkpoint, map_location='cpu', weights_only=False)
+
+        self.unwrap_model().load_state_dict(state['model_state_dict'])
+        self.optimizer.load_state_dict(state['optimizer_state_dict'])
+        set_rng_states(state['rng_states'])
+        self.history = state['history']
+        self.start_epoch = state['epoch'] + 1
+
+    def unwrap_model(self):
+        ''' The model without the data parallelism and torch.compile wrappers
+        '''
+        return unwrap_compiled(self.model.module if hasattr(self.model, 'module') else self.model)
+
+    def train_early_exit(self):
+        ''' Train the early exit head of the trained model on the whole training split and
+        calibrate its threshold on the whole validation split, in the main process
         
-        print('train() called: model=%s, opt=%s(lr=%f), epochs=%d, device=%s\n' % \
-              (type(self.model).__name__, 
-               type(self.optimizer).__name__,
-               self.optimizer.param_groups[0]['lr'], 
-               self.args.epochs, 
-               self.device))
+        :return calibration: The threshold and the shares of the validation recordings exiting
+        :rtype: dict
+        '''
+
+        print('\nTraining the early exit head...')
+        model = self.unwrap_model()
+        normal_index = early_exit_index(self.args.labels)
+        train_dl = DataLoader(self.train_dl.dataset, batch_size=self.args.batch_size, shuffle=True,
+                              num_workers=self.args.num_workers, drop_last=True)
+        val_dl = DataLoader(self.val_dl.dataset, batch_size=1, shuffle=False, num_workers=self.args.num_workers)
+
+        train_exit_head(model, train_dl, normal_index, self.device, self.early_exit_epochs, self.args.lr)
+        probs, targets = exit_probabilities(model, val_dl, normal_index, self.device)
+        calibration = calibrate_exit_threshold(probs, targets, self.early_exit_max_miss)
+
+        print('early exit threshold: {:<6.4f} val exit rate: {:<6.2f} normal exit rate: {:<6.2f} miss rate: {:<6.2f}'.format(
+            calibration['threshold'],
+            calibration['exit_rate'],
+            calibration['normal_exit_rate'],
+            calibration['miss_rate']))
+        return calibration
+
+    def checkpoint_state(self, history, epoch):
+        ''' State of the training after the given epoch
+        '''
+        return {
+            'epoch': epoch,
+            'model_state_dict': self.unwrap_model().state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'rng_states': rng_states(),
+            'history': {k: v for k, v in history.items() if k not in ['optimizer', 'criterion']}
+        }
+
+    def init_history(self):
+        ''' Initialize the training history
+        '''
         
         # Add all wanted history information
         history = {}
@@ -98,18 +231,62 @@ class Training(object):
         history['labels'] = self.args.labels
         history['epochs'] = self.args.epochs
         history['batch_size'] = self.args.batch_size
+        history['world_size'] = self.world_size
         history['lr'] = self.args.lr
-        history['optimizer'] = self.optimizer
-        history['criterion'] = self.criterion
+        history['precision'] = self.precision
+        history['compile'] = self.compile
+        history['architecture'] = self.architecture
         history['train_csv'] = self.args.train_path
         history['val_csv'] = self.args.val_path
+
+        return history
+        
+    def train(self):
+        ''' PyTorch training loop
+        '''
+        
+        if is_main_process():
+            print('train() called: model=%s, opt=%s(lr=%f), epochs=%d, device=%s, precision=%s, compile=%s\n' % \
+                  (type(self.model).__name__, 
+                   type(self.optimizer).__name__,
+                   self.optimizer.param_groups[0]['lr'], 
+                   self.args.epochs, 
+                   self.device,
+                   self.precision,
+                   self.compile))
+        
+        # Training history, possibly restored from a checkpoint
+        history = self.history if self.history is not None else self.init_history()
+        history['epochs'] = self.args.epochs
+        history['optimizer'] = self.optimizer
+        history['criterion'] = self.criterion
+
+        # Checkpoints are written by the main process in a background thread
+        checkpointer = None
+        if self.checkpoint_every > 0 and is_main_process():
+            checkpointer = AsyncCheckpointer(self.checkpoint_dir, self.args.yaml_file_name, self.keep_checkpoints, self.start_epoch)
+        
+        # Timers of the phases, no-ops if timing is disabled
+        train_timer = StepTimer(self.timing, self.device)
+        val_timer = StepTimer(self.timing, self.device)
+        timing_path = os.path.join(self.args.model_save_dir, self.args.yaml_file_name + '_train_timing')
+
+        # Profiler capture windows over the training steps, no-op if there's no profiling section
+        profiler = ProfilerController(getattr(self.args, 'profiling', None),
+                                      os.path.join(self.args.model_save_dir, 'profiling'),
+                                      self.args.yaml_file_name + '_train' + ('_rank{}'.format(self.rank) if self.distributed else ''),
+                                      self.device)
         
         start_time_sec = time.time()
         
-        for epoch in range(1, self.args.epochs+1):
+        for epoch in range(self.start_epoch, self.args.epochs+1):
             
             # --- TRAIN ON TRAINING SET -----------------------------
             self.model.train()            
+            if self.train_sampler is not None:
+                # Shuffle the shards differently in each epoch
+                self.train_sampler.set_epoch(epoch)
+
             train_loss = 0.0
             labels_all = torch.tensor((), device=self.device) # , device=torch.device('cuda:0')
             logits_prob_all = torch.tensor((), device=self.device)
@@ -117,29 +294,48 @@ class Training(object):
             batch_loss = 0.0
             batch_count = 0
             step = 0
+
+            train_timer.reset()
+            train_timer.start()
             
-            for batch_idx, (ecgs, ag, labels) in enumerate(self.train_dl):
+            for batch_idx, batch in enumerate(self.train_dl):
+                train_timer.lap('data_wait')
+                ecgs, ag, labels = batch[:3]
+                if self.timing:
+                    # Time spent in the dataset, possibly in the DataLoader workers
+                    train_timer.add('load_data', batch[3][:, 0])
+                    train_timer.add('transforms', batch[3][:, 1])
+
                 ecgs = ecgs.to(self.device) # ECGs
                 ag = ag.to(self.device) # age and gender
                 labels = labels.to(self.device) # diagnoses in SNOMED CT codes  
+                train_timer.lap('to_device')
                
                 with torch.set_grad_enabled(True):                    
         
-                    logits = self.model(ecgs, ag) 
+                    with autocast(self.device, self.precision):
+                        logits = self.model(ecgs, ag) 
+                    logits = logits.float()
+                    train_timer.lap('forward')
                     loss = self.criterion(logits, labels)
+                    train_timer.lap('loss')
                     logits_prob = self.sigmoid(logits)      
                     loss_tmp = loss.item() * ecgs.size(0)
                     labels_all = torch.cat((labels_all, labels), 0)
                     logits_prob_all = torch.cat((logits_prob_all, logits_prob), 0)                    
                     
                     train_loss += loss_tmp
+                    train_timer.lap('accumulate')
                     
                     self.optimizer.zero_grad()
                     loss.backward()
+                    train_timer.lap('backward')
                     self.optimizer.step()
+                    train_timer.lap('optimizer')
+                    train_timer.count(ecgs.size(0))
                     
                     # Printing training information
-                    if step % 100 == 0:
+                    if step % 100 == 0 and is_main_process():
                         batch_loss += loss_tmp
                         batch_count += ecgs.size(0)
                         batch_loss = batch_loss / batch_count
@@ -153,33 +349,88 @@ class Training(object):
                         batch_loss = 0.0
                         batch_count = 0
                     step += 1
+                train_timer.lap('logging')
+                profiler.step()
 
             
+            # Gather the training outputs of all the processes into the main process
+            if self.distributed:
+                labels_all = gather_tensor(labels_all)
+                logits_prob_all = gather_tensor(logits_prob_all)
+                train_loss = all_reduce_sum(train_loss)
+                train_timer.lap('gather')
+
             train_loss = train_loss / len(self.train_dl.dataset)            
-            train_macro_avg_prec, train_micro_avg_prec, train_macro_auroc, train_micro_auroc, train_challenge_metric = cal_multilabel_metrics(labels_all, logits_prob_all, self.args.labels, self.args.threshold)
+
+            # The training metrics are computed by the main process and timed with the training
+            if is_main_process():
+                train_macro_avg_prec, train_micro_avg_prec, train_macro_auroc, train_micro_auroc, train_challenge_metric = cal_multilabel_metrics(labels_all, logits_prob_all, self.args.labels, self.args.threshold)
+                train_timer.lap('metrics')
 
             # --- EVALUATE ON VALIDATION SET ------------------------------------- 
             self.model.eval()
-            val_loss = 0.0  
+            val_losses = []
             labels_all = torch.tensor((), device=self.device)
             logits_prob_all = torch.tensor((), device=self.device)  
+
+            val_timer.reset()
+            val_timer.start()
             
-            for ecgs, ag, labels in self.val_dl:
+            for batch in self.val_dl:
+                val_timer.lap('data_wait')
+                ecgs, ag, labels = batch[:3]
+                if self.timing:
+                    val_timer.add('load_data', batch[3][:, 0])
+                    val_timer.add('transforms', batch[3][:, 1])
+
                 ecgs = ecgs.to(self.device) # ECGs
                 ag = ag.to(self.device) # age and gender
                 labels = labels.to(self.device) # diagnoses in SNOMED CT codes 
+                val_timer.lap('to_device')
                 
                 with torch.set_grad_enabled(False):  
                     
-                    logits = self.model(ecgs, ag)
+                    with autocast(self.device, self.precision):
+                        logits = self.model(ecgs, ag)
+                    logits = logits.float()
+                    val_timer.lap('forward')
                     loss = self.criterion(logits, labels)
+                    val_timer.lap('loss')
                     logits_prob = self.sigmoid(logits)
-                    val_loss += loss.item() * ecgs.size(0)                                 
+                    val_losses.append(loss.item() * ecgs.size(0))
                     labels_all = torch.cat((labels_all, labels), 0)
                     logits_prob_all = torch.cat((logits_prob_all, logits_prob), 0)
+                    val_timer.lap('accumulate')
+                    val_timer.count(ecgs.size(0))
+
+            val_losses = torch.tensor(val_losses, dtype=torch.float64)
+
+            # Gather the validation outputs of all the processes into the main process
+            if self.distributed:
+                # Indexes of the recordings in the validation set in the order they were predicted
+                val_indices = torch.tensor(list(self.val_sampler))[:len(labels_all)]
+                labels_all = gather_tensor(labels_all)
+                logits_prob_all = gather_tensor(logits_prob_all)
+                val_losses = gather_tensor(val_losses)
+                val_indices = gather_tensor(val_indices)
 
-            val_loss = val_loss / len(self.val_dl.dataset)
+                if is_main_process():
+                    # Restore the order of the validation set and leave out the recordings
+                    # which the sampler repeated to have shards of equal size
+                    _, first_idx = np.unique(val_indices.numpy(), return_index=True)
+                    first_idx = torch.from_numpy(first_idx)
+                    labels_all = labels_all[first_idx]
+                    logits_prob_all = logits_prob_all[first_idx]
+                    val_losses = val_losses[first_idx]
+                val_timer.lap('gather')
+
+            # Only the main process computes the metrics and saves the results
+            if not is_main_process():
+                continue
+
+            val_loss = val_losses.sum().item() / len(self.val_dl.dataset)
             val_macro_avg_prec, val_micro_avg_prec, val_macro_auroc, val_micro_auroc, val_challenge_metric = cal_multilabel_metrics(labels_all, logits_prob_all, self.args.labels, self.args.threshold)
+            val_timer.lap('metrics')
             
             # Create ROC Curves at the beginning, middle and end of training
             if epoch == 1 or epoch == self.args.epochs/2 or epoch == self.args.epochs:
@@ -212,6 +463,13 @@ class Training(object):
             history['val_macro_avg_prec'].append(val_macro_avg_prec)
             history['val_challenge_metric'].append(val_challenge_metric)
 
+            # Periodic checkpoint
+            if checkpointer is not None and epoch % self.checkpoint_every == 0:
+                checkpointer.save(self.checkpoint_state(history, epoch), epoch)
+
+            # Timing report of the epoch next to the training history
+            write_timing_report(timing_path, epoch, {'train': train_timer, 'val': val_timer})
+
             # Save trained model (.pth), history (.pickle) and validation logits (.csv) after the last epoch
             if epoch == self.args.epochs:
                 
@@ -219,12 +477,29 @@ class Training(object):
                     
                 # Whether or not you use data parallelism, save the state dictionary this way
                 # to have the flexibility to load the model any way you want to any device you want
-                model_state_dict = self.model.module.state_dict() if self.device_count > 1 else self.model.state_dict()
+                if self.architecture['early_exit']:
+                    history['early_exit'] = self.train_early_exit()
+                model_state_dict = self.unwrap_model().state_dict()
                     
                 # -- Save model
                 model_savepath = os.path.join(self.args.model_save_dir,
                                               self.args.yaml_file_name + '.pth')
                 torch.save(model_state_dict, model_savepath)
+                save_architecture(model_savepath, self.architecture)
+                if self.architecture['early_exit']:
+                    save_cascade(model_savepath, history['early_exit'])
+                if self.save_mmap_weights:
+                    save_flat_weights(model_state_dict, flat_weights_path(model_savepath),
+                                      metadata={'yaml_file_name': self.args.yaml_file_name})
+
+                # -- Register the model so that it's found without searching the 'experiments' directory
+                register_model(model_savepath, self.args.labels, hash_config(self.args),
+                               metrics={k: v[-1] for k, v in history.items() if k.startswith('val_') and isinstance(v, list)},
+                               yaml_file_name=self.args.yaml_file_name,
+                               epochs=epoch,
+                               train_csv=self.args.train_path,
+                               val_csv=self.args.val_path,
+                               architecture=self.architecture)
                 
                 # -- Save history
                 history_savepath = os.path.join(self.args.model_save_dir,
@@ -246,14 +521,25 @@ class Training(object):
                 logits_df = pd.DataFrame(logits_numpy, columns=self.args.labels, index=cleanup_filenames)
                 logits_df.to_csv(logits_csv_path, sep=',')
 
+        # Wait for the last checkpoints to be written
+        if checkpointer is not None:
+            checkpointer.close()
+        profiler.close()
+
         torch.cuda.empty_cache()
           
          
         # END OF TRAINING LOOP        
         
+        epochs_run         = max(self.args.epochs - self.start_epoch + 1, 1)
         end_time_sec       = time.time()
         total_time_sec     = end_time_sec - start_time_sec
-        time_per_epoch_sec = total_time_sec / self.args.epochs
-        print()
-        print('Time total:     %5.2f sec' % (total_time_sec))
-        print('Time per epoch: %5.2f sec' % (time_per_epoch_sec))
\ No newline at end of file
+        time_per_epoch_sec = total_time_sec / epochs_run
+        samples_per_sec    = epochs_run * (len(self.train_dl) * self.args.batch_size + len(self.val_dl) * self.world_size) / total_time_sec
+        if is_main_process():
+            print()
+            print('Time total:     %5.2f sec' % (total_time_sec))
+            print('Time per epoch: %5.2f sec' % (time_per_epoch_sec))
+            print('Throughput:     %5.2f samples/sec' % (samples_per_sec))
+
+        return history
\ No newline at end of file
@@ -0,0 +1,170 @@
+import numpy as np, os, sys
+import math
+import random
+import itertools
+import yaml
+import pandas as pd
+from utils import load_yaml
+from train_model import read_yaml
+from src.modeling.schedule_utils import run_concurrently
+from src.modeling.checkpoint_utils import list_checkpoints
+
+# Hyperparameters which can be searched
+SEARCH_KEYS = ['lr', 'weight_decay', 'batch_size']
+
+
+def sample_trials(sweep):
+    ''' Hyperparameters of the trials, i.e. the combinations of the searched values
+    or a random sample of them
+    
+    :param sweep: Arguments of the sweep
+    :type sweep: utils.obj
+    
+    :return trials: Names of the trials and their hyperparameters
+    :rtype: list
+    '''
+
+    keys = [key for key in SEARCH_KEYS if hasattr(sweep, key)]
+    values = [getattr(sweep, key) if isinstance(getattr(sweep, key), list) else [getattr(sweep, key)] for key in keys]
+    combinations = [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+    num_trials = getattr(sweep, 'num_trials', 0)
+    if 0 < num_trials < len(combinations):
+        combinations = random.Random(getattr(sweep, 'seed', 123)).sample(combinations, num_trials)
+
+    return [('trial_{:03d}'.format(i), params) for i, params in enumerate(combinations)]
+
+
+def write_trial_yaml(base_yaml, trial_dir, name, params, epochs):
+    ''' Write the training yaml of a trial, i.e. the base yaml with the hyperparameters
+    of the trial and the epochs of the current round
+
+    :return path: Absolute path for the yaml file
+    :rtype: str
+    '''
+
+    with open(base_yaml, 'r') as file:
+        config = yaml.safe_load(file)
+    config.update(params)
+    config['epochs'] = epochs
+    
+    # A checkpoint after each epoch so that the promoted trials continue from where they were left
+    config['checkpoint_every'] = 1
+    config['keep_checkpoints'] = 1
+
+    path = os.path.join(trial_dir, name + '.yaml')
+    with open(path, 'w') as file:
+        yaml.safe_dump(config, file, sort_keys=False)
+    return path
+
+
+def sweep(file, csv_root):
+    ''' Successive halving over the hyperparameters of a training yaml. All the trials are
+    trained for `min_epochs` epochs, the best 1/eta of them by the validation metric continue
+    from their checkpoints for eta times more epochs, and so on, until one trial is left or
+    `max_epochs` is reached. The trials of a round are trained concurrently.
+
+    :param file: Absolute path for the sweep yaml file
+    :type file: str
+    :param csv_root: Absolute path for the csv file
+    :type csv_root: str
+    
+    :return results: Hyperparameters and the results of the trials ranked by the metric
+    :rtype: pandas.DataFrame
+    '''
+
+    sweep_args = load_yaml(file)
+    sweep_name = os.path.basename(os.path.splitext(file)[0])
+    base_yaml = os.path.join(os.getcwd(), 'configs', 'training', sweep_args.base_yaml)
+    metric = getattr(sweep_args, 'metric', 'val_challenge_metric')
+    eta = getattr(sweep_args, 'eta', 2)
+    min_epochs = getattr(sweep_args, 'min_epochs', 1)
+    max_epochs = getattr(sweep_args, 'max_epochs', min_epochs * eta)
+    jobs = getattr(sweep_args, 'jobs', 1)
+
+    # Models, checkpoints, logs and the yaml files of the trials go to the same directory
+    sweep_dir = os.path.join(os.getcwd(), 'experiments', sweep_name)
+    trial_dir = os.path.join(sweep_dir, 'trials')
+    os.makedirs(trial_dir, exist_ok=True)
+
+    trials = sample_trials(sweep_args)
+    params = dict(trials)
+    results = {name: dict(trial=name, **params[name]) for name in params}
+    print('Sweeping {} trials of {}'.format(len(trials), sweep_args.base_yaml))
+
+    survivors = list(params)
+    epochs = min_epochs
+    rung = 0
+    while True:
+        print('\nRound {}: {} trial(s), {} epoch(s)'.format(rung, len(survivors), epochs))
+
+        # Trials continue from their latest checkpoints after the first round, so the
+        # checkpoints left by an earlier sweep of the same name are removed first
+        trial_jobs = []
+        for name in survivors:
+            if rung == 0:
+                for path in list_checkpoints(os.path.join(sweep_dir, 'checkpoints'), name):
+                    os.remove(path)
+            trial_yaml = write_trial_yaml(base_yaml, trial_dir, name, params[name], epochs)
+            trial_jobs.append((name, (trial_yaml, csv_root, sweep_dir, True, 'latest' if rung > 0 else None)))
+
+        summary = run_concurrently(read_yaml, trial_jobs, jobs,
+                                   log_dir=os.path.join(sweep_dir, 'logs', 'round_{}'.format(rung)),
+                                   summary_path=os.path.join(sweep_dir, 'round_{}_summary.csv'.format(rung)),
+                                   seed=getattr(sweep_args, 'seed', 123))
+
+        for name in survivors:
+            results[name].update(summary.loc[name].drop(['status', 'exitcode', 'log']).to_dict())
+            results[name]['epochs_trained'] = epochs
+            results[name]['round'] = rung
+            results[name]['round_{}_{}'.format(rung, metric)] = summary.loc[name, metric]
+
+        if len(survivors) == 1 or epochs >= max_epochs:
+            break
+
+        # Promote the best 1/eta of the trials
+        ranked = summary.loc[survivors, metric].sort_values(ascending=False, kind='stable')
+        survivors = ranked.index[:max(1, math.ceil(len(survivors) / eta))].tolist()
+        epochs = min(epochs * eta, max_epochs)
+        rung += 1
+
+    # Ranked by the round reached and then by the metric of that round
+    results = pd.DataFrame(list(results.values())).set_index('trial')
+    results = results.sort_values(['round', metric], ascending=False, kind='stable')
+    results.insert(0, 'rank', np.arange(1, len(results) + 1))
+
+    results_path = os.path.join(sweep_dir, sweep_name + '_results.csv')
+    results.to_csv(results_path)
+
+    columns = ['rank'] + [key for key in SEARCH_KEYS if key in results] + ['round', 'epochs_trained', metric]
+    print('\nSweep results\n' + '-'*10)
+    print(results[columns].to_string(float_format=lambda x: '{:.6g}'.format(x)))
+    print('-'*10)
+    print('Saved to', results_path)
+    print('Best trial: {} ({}), yaml: {}'.format(results.index[0],
+          ', '.join('{}={}'.format(key, results[key].iloc[0]) for key in SEARCH_KEYS if key in results),
+          os.path.join(trial_dir, results.index[0] + '.yaml')))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    # ----- Set the path here! -----
+
+    # Root where the needed CSV file exists
+    csv_root = os.path.join(os.getcwd(), 'data', 'split_csvs', 'stratified_smoke')
+
+    # ------------------------------
+
+    # Load args
+    given_arg = sys.argv[1]
+    print('Loading arguments from', given_arg)
+    arg_path = os.path.join(os.getcwd(), 'configs', 'sweeps', given_arg)
+
+    if os.path.exists(arg_path) and 'yaml' in given_arg:
+        sweep(arg_path, csv_root)
+    else:
+        raise Exception('No such yaml file exists! Check the arguments.')
+
+    print('Done.')
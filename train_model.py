@@ -1,11 +1,14 @@
 import torch
 import numpy as np
 import random, sys, os
+import argparse
 import pandas as pd
 from utils import load_yaml
 from src.modeling.train_utils import Training
+from src.modeling.distributed_utils import init_distributed, cleanup_distributed, is_main_process, is_distributed
+from src.modeling.schedule_utils import run_concurrently
 
-def read_yaml(file, csv_root, model_save_dir='', multiple=False):
+def read_yaml(file, csv_root, model_save_dir='', multiple=False, resume=None, overrides=None):
     ''' Read a yaml file and perform training.
     
     :param file: Absolute path for the yaml file wanted to read
@@ -17,10 +20,20 @@ def read_yaml(file, csv_root, model_save_dir='', multiple=False):
     :type model_save_dir: str
     :param multiple: Check if multiple yamls are read
     :type multiple: boolean
+    :param resume: Checkpoint to continue the training from, 'latest' for the latest one
+    :type resume: str
+    :param overrides: Arguments replacing the ones in the yaml file, e.g. the number of workers
+    :type overrides: dict
+    
+    :return history: Training history
+    :rtype: dict
     '''
     
     # Load yaml
     args = load_yaml(file)
+    args.resume = resume
+    if overrides:
+        args.__dict__.update(overrides)
 
     # Update paths
     args.train_path = os.path.join(csv_root, args.train_file)
@@ -40,29 +53,33 @@ def read_yaml(file, csv_root, model_save_dir='', multiple=False):
     args.labels = pd.read_csv(args.train_path, nrows=0).columns.tolist()[4:]
 
     # Directory for training information
-    if not os.path.exists(args.model_save_dir):
-        os.makedirs(args.model_save_dir)
+    # (several processes might create it at the same time in distributed training)
+    os.makedirs(args.model_save_dir, exist_ok=True)
     
     # Directory for ROCs
-    if not os.path.exists(args.roc_save_dir):
-        os.makedirs(args.roc_save_dir)
+    os.makedirs(args.roc_save_dir, exist_ok=True)
     
-    print('Arguments:\n' + '-'*10)
-    for k, v in args.__dict__.items():
-        print(k + ':', v)
-    print('-'*10)  
+    if is_main_process():
+        print('Arguments:\n' + '-'*10)
+        for k, v in args.__dict__.items():
+            print(k + ':', v)
+        print('-'*10)  
 
-    print('Training a model...')
+        print('Training a model...')
     trainer = Training(args)
     trainer.setup()
-    trainer.train() 
+    return trainer.train()
     
 
-def read_multiple_yamls(path, csv_root):
+def read_multiple_yamls(path, csv_root, resume=None, jobs=1):
     ''' Read multiple yaml files from the given directory
     
     :param directory: Absolute path for the directory
     :type path: str
+    :param resume: 'latest' to continue each training from its latest checkpoint
+    :type resume: str
+    :param jobs: Number of models trained concurrently in separate processes
+    :type jobs: int
     '''
     # All yaml files
     yaml_files = [os.path.join(path, file) for file in os.listdir(path) if os.path.isfile(os.path.join(path, file))]
@@ -71,9 +88,19 @@ def read_multiple_yamls(path, csv_root):
     dir_name = os.path.basename(path)
     model_save_dir = os.path.join(os.getcwd(),'experiments', dir_name) 
     
+    # Training the models concurrently, each with its own share of the CPUs and its own log
+    if jobs > 1:
+        if is_distributed():
+            raise Exception('Concurrent jobs can\'t be combined with distributed training.')
+        fold_jobs = [(os.path.splitext(os.path.basename(file))[0], (file, csv_root, model_save_dir, True, resume))
+                     for file in yaml_files]
+        return run_concurrently(read_yaml, fold_jobs, jobs,
+                                log_dir=os.path.join(model_save_dir, 'logs'),
+                                summary_path=os.path.join(model_save_dir, dir_name + '_train_summary.csv'))
+
     # Reading the yaml files and training models for each
     for file in yaml_files:
-        read_yaml(file, csv_root, model_save_dir, True)
+        read_yaml(file, csv_root, model_save_dir, True, resume)
 
 
 if __name__ == '__main__':
@@ -95,8 +122,20 @@ if __name__ == '__main__':
     
     # ------------------------------
 
+    # Distributed training if launched with several processes, e.g.
+    # torchrun --nproc_per_node=4 train_model.py train_smoke.yaml
+    init_distributed(backend='gloo')
+
     # Load args
-    given_arg = sys.argv[1]
+    parser = argparse.ArgumentParser(description='Train a model with the given yaml file or a directory of yaml files')
+    parser.add_argument('config', help='yaml file or directory in configs/training')
+    parser.add_argument('--resume', nargs='?', const='latest', default=None,
+                        help='continue an interrupted training from a checkpoint (the latest one if no path given)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of yamls of a directory trained concurrently')
+    cli_args = parser.parse_args()
+
+    given_arg = cli_args.config
     print('Loading arguments from', given_arg)
     arg_path = os.path.join(os.getcwd(), 'configs', 'training', given_arg)
 
@@ -106,12 +145,15 @@ if __name__ == '__main__':
 
         if 'yaml' in given_arg:
             # Run one yaml
-            read_yaml(arg_path, csv_root)
+            read_yaml(arg_path, csv_root, resume=cli_args.resume)
         else:
             # Run multiple yamls from a directory
-            read_multiple_yamls(arg_path, csv_root)
+            if cli_args.resume not in [None, 'latest']:
+                raise Exception('Only the latest checkpoints can be resumed when multiple yamls are run.')
+            read_multiple_yamls(arg_path, csv_root, cli_args.resume, cli_args.jobs)
             
     else:
         raise Exception('No such file nor directory exists! Check the arguments.')
 
+    cleanup_distributed()
     print('Done.')
\ No newline at end of file